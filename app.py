@@ -6,11 +6,24 @@ import requests
 import gradio as gr
 import shutil
 import argparse
+import threading
 from pydub import AudioSegment
+from preview import PreviewRegistry
+from warmup import SpeakerWarmup
+from job_queue import JobQueue, Job, QUEUED, DONE, FAILED, PRIORITY_INTERACTIVE, PRIORITY_BATCH
+from task_journal import TaskJournal, hash_file, hash_text
+from storage import LocalStorage, S3Storage, SharedFiles, StorageError
+from postprocess import ResultPostProcessor
 
 # 命令行参数解析
 parser = argparse.ArgumentParser(description='HeyGem数字人训练与合成系统')
 parser.add_argument('--lang', type=str, default='en', choices=['zh', 'en'], help='界面语言 (zh: 中文, en: 英文)')
+parser.add_argument('--storage', type=str, default='none', choices=['none', 'dir', 's3'], help='多节点共享存储 (none: 仅本地, dir: 共享目录, s3: S3兼容存储)')
+parser.add_argument('--storage-path', type=str, default=None, help='共享目录路径 (--storage dir)')
+parser.add_argument('--s3-bucket', type=str, default=None, help='S3存储桶 (--storage s3)')
+parser.add_argument('--s3-endpoint', type=str, default=None, help='S3兼容服务地址，例如MinIO (--storage s3)')
+parser.add_argument('--s3-prefix', type=str, default='heygem', help='S3对象前缀 (--storage s3)')
+parser.add_argument('--cache-size', type=float, default=20, help='共享文件本地缓存上限 (GB)')
 args = parser.parse_args()
 
 # 翻译字典
@@ -74,7 +87,19 @@ translations = {
         'synthesis_progress': '正在合成中 ({0}%)',
         'task_queuing': '任务排队中',
         'task_failed': '任务失败: {0}',
-        'query_error': '查询任务出错: {0}'
+        'query_error': '查询任务出错: {0}',
+        'synthesis_preview': '合成预览',
+        'preview_waiting': '等待渲染片段...',
+        'preview_progress': '正在渲染 ({0}%): {1}/{2} 帧',
+        'warmup_stats': '音色预热统计',
+        'refresh_warmup': '刷新统计',
+        'warmup_kind': '类型',
+        'warmup_count': '次数',
+        'batch_job': '批量任务（低优先级）',
+        'task_enqueued': '任务已加入队列，任务ID: {0}\n排队位置: {1}，预计完成时间: {2}秒',
+        'task_local_queue': '本地排队中，位置: {0}，预计完成时间: {1}秒',
+        'synthesis_result_file': '完整画质结果',
+        'task_reattached': '相同任务已提交过，已关联到任务ID: {0}'
     },
     'en': {
         'title': 'Digital Human Training and Synthesis System',
@@ -135,7 +160,19 @@ translations = {
         'synthesis_progress': 'Synthesis in progress ({0}%)',
         'task_queuing': 'Task queuing',
         'task_failed': 'Task failed: {0}',
-        'query_error': 'Query task error: {0}'
+        'query_error': 'Query task error: {0}',
+        'synthesis_preview': 'Synthesis Preview',
+        'preview_waiting': 'Waiting for rendered segments...',
+        'preview_progress': 'Rendering ({0}%): {1}/{2} frames',
+        'warmup_stats': 'Speaker Warm-up Statistics',
+        'refresh_warmup': 'Refresh Statistics',
+        'warmup_kind': 'Kind',
+        'warmup_count': 'Count',
+        'batch_job': 'Batch job (low priority)',
+        'task_enqueued': 'Task queued, Task ID: {0}\nQueue position: {1}, Estimated completion: {2}s',
+        'task_local_queue': 'Waiting in local queue, position: {0}, estimated completion: {1}s',
+        'synthesis_result_file': 'Full Quality Result',
+        'task_reattached': 'This job was already submitted, reattached to Task ID: {0}'
     }
 }
 
@@ -144,11 +181,52 @@ lang = args.lang
 t = translations[lang]
 
 # 配置
+DATA_PATH = os.path.expanduser(r"~/heygem_data")
 VOICE_DATA_PATH = os.path.expanduser(r"~/heygem_data/voice/data")
 FACE2FACE_TEMP_PATH = os.path.expanduser(r"~/heygem_data/face2face/temp")
 MODEL_INFO_FILE = "digital_human_models.json"
+# 模型使用统计，与模型注册表分开保存，合成请求不会改写注册表
+MODEL_USAGE_FILE = "digital_human_usage.json"
 API_BASE_URL = "http://localhost:18180"  # 请根据实际API地址调整
 API_BASE_URL2 = "http://localhost:8383"
+# 渲染过程中的预览，由已生成的视频片段拼接
+PREVIEW_PATH = os.path.expanduser(r"~/heygem_data/face2face/preview")
+PREVIEW_INTERVAL = 3
+# 渲染结束后等待最终视频的秒数
+PREVIEW_RESULT_TIMEOUT = 120
+PREVIEWS = PreviewRegistry(FACE2FACE_TEMP_PATH, PREVIEW_PATH)
+# 音色预热：启动时和定时为最近/常用的数字人发送短合成请求
+WARMUP_MODELS = 3
+WARMUP_INTERVAL = 1800
+WARMUP_TEXT = {'zh': '你好。', 'en': 'Hello.'}
+# 已预热音色的响应超过该秒数，视为后端已重启，所有音色需要重新预热
+WARMUP_COLD_LATENCY = 10
+# 本地任务队列：限制后端同时处理的任务数，交互任务优先于批量任务
+JOB_QUEUE_FILE = "synthesis_job_queue.json"
+JOB_MAX_OUTSTANDING = 2
+# 任务日志：记录已提交的任务，重启后继续轮询和下载，重复提交时关联到已有任务
+TASK_JOURNAL_FILE = "synthesis_task_journal.jsonl"
+TASK_RESUME_INTERVAL = 10
+# 超过此秒数仍未完成的任务视为丢失
+TASK_RESUME_TIMEOUT = 6 * 3600
+# 下载结果的后处理：重新封装为faststart（不重新编码），可选生成低码率预览版本用于播放
+RESULT_FAST_START = True
+RESULT_PREVIEW_RENDITION = False
+RESULT_PREVIEW_HEIGHT = 480
+RESULT_PREVIEW_BITRATE = "1M"
+POSTPROCESSOR = ResultPostProcessor(fast_start=RESULT_FAST_START, preview=RESULT_PREVIEW_RENDITION,
+    preview_height=RESULT_PREVIEW_HEIGHT, preview_bitrate=RESULT_PREVIEW_BITRATE)
+# 语音容器中VOICE_DATA_PATH的挂载路径
+TTS_DATA_PATH = "/code/data/"
+
+# 多节点共享存储：模型信息保存在共享存储中，视频和音频按需下载到本地目录（后端只能访问本地目录）
+if args.storage == 'dir':
+    STORAGE = LocalStorage(args.storage_path)
+elif args.storage == 's3':
+    STORAGE = S3Storage(args.s3_bucket, prefix=args.s3_prefix, endpoint_url=args.s3_endpoint)
+else:
+    STORAGE = None
+SHARED_FILES = SharedFiles(DATA_PATH, STORAGE, max_cache_bytes=int(args.cache_size * 1024**3))
 
 # 确保数据目录存在
 os.makedirs(VOICE_DATA_PATH, exist_ok=True)
@@ -156,15 +234,31 @@ os.makedirs(FACE2FACE_TEMP_PATH, exist_ok=True)
 
 # 读取已有模型信息
 def load_models():
-    if os.path.exists(MODEL_INFO_FILE):
-        with open(MODEL_INFO_FILE, "r", encoding="utf-8") as f:
-            return json.load(f)
-    return {}
+    return SHARED_FILES.read_json(MODEL_INFO_FILE, MODEL_INFO_FILE, {})
+
+# 修改模型信息：update(models)就地修改，写入时若其他节点已修改则重新读取再修改
+def modify_models(update):
+    return SHARED_FILES.update_json(MODEL_INFO_FILE, MODEL_INFO_FILE, update, {})
+
+# 模型信息加上使用统计，用于选择预热的数字人
+def load_models_with_usage():
+    usage = SHARED_FILES.read_json(MODEL_USAGE_FILE, MODEL_USAGE_FILE, {})
+    models = load_models().get("models", [])
+    return [{**model, **usage.get(model["id"], {})} for model in models]
 
-# 保存模型信息
-def save_models(models_data):
-    with open(MODEL_INFO_FILE, "w", encoding="utf-8") as f:
-        json.dump(models_data, f, ensure_ascii=False, indent=2)
+# 语音容器返回的路径对应的本地文件，不在VOICE_DATA_PATH中则返回None
+def get_voice_data_file(tts_path):
+    if not tts_path.startswith(TTS_DATA_PATH):
+        return None
+    return os.path.join(VOICE_DATA_PATH, tts_path[len(TTS_DATA_PATH):])
+
+# 确保模型文件在本节点存在（可能由其他节点训练）
+def fetch_model_files(model):
+    SHARED_FILES.fetch(model["video_path"])
+    SHARED_FILES.fetch(model["audio_path"])
+    reference_file = get_voice_data_file(model.get("reference_audio", ""))
+    if reference_file:
+        SHARED_FILES.fetch(reference_file)
 
 # 从视频中提取音频
 def extract_audio_from_video(video_path):
@@ -245,6 +339,13 @@ def train_digital_human(video_file, name):
         reference_text = result["reference_audio_text"].split("|||")[0].strip()
         reference_audio = result["asr_format_audio_url"].split("|||")[0].strip()
         
+        # 上传到共享存储，其他节点可使用此模型
+        SHARED_FILES.publish(target_video_path)
+        SHARED_FILES.publish(audio_path)
+        reference_file = get_voice_data_file(reference_audio)
+        if reference_file and os.path.exists(reference_file):
+            SHARED_FILES.publish(reference_file)
+        
         # 创建模型信息
         model_id = str(uuid.uuid4())
         model_info = {
@@ -258,12 +359,7 @@ def train_digital_human(video_file, name):
         }
         
         # 保存模型信息
-        models = load_models()
-        if "models" not in models:
-            models["models"] = []
-        
-        models["models"].append(model_info)
-        save_models(models)
+        modify_models(lambda models: models.setdefault("models", []).append(model_info))
         
         # 训练成功的消息
         return True, t['training_success'].format(model_id)
@@ -281,6 +377,53 @@ def get_model_by_name(name):
             return model
     return None
 
+# 记录模型使用情况，用于选择预热的数字人。统计失败不影响合成
+def record_model_usage(model_id):
+    def update(usage):
+        entry = usage.setdefault(model_id, {})
+        entry["last_used"] = time.time()
+        entry["use_count"] = entry.get("use_count", 0) + 1
+    try:
+        SHARED_FILES.update_json(MODEL_USAGE_FILE, MODEL_USAGE_FILE, update, {})
+    except StorageError as e:
+        print(f"记录模型使用失败: {e}")
+
+# 语音合成API请求参数
+def build_invoke_data(model, text, max_new_tokens=1024):
+    # 处理model中的reference_audio和reference_text可能包含多个项目的情况
+    reference_audio = model["reference_audio"].split("|||")[0].strip() if "|||" in model["reference_audio"] else model["reference_audio"]
+    reference_text = model["reference_text"].split("|||")[0].strip() if "|||" in model["reference_text"] else model["reference_text"]
+    
+    return {
+        "speaker": model["id"],
+        "text": text,
+        "format": "wav",
+        "topP": 0.7,
+        "max_new_tokens": max_new_tokens,
+        "chunk_length": 100,
+        "repetition_penalty": 1.2,
+        "temperature": 0.7,
+        "need_asr": False,
+        "streaming": False,
+        "is_fixed_seed": 0,
+        "is_norm": 0,
+        "reference_audio": reference_audio,
+        "reference_text": reference_text
+    }
+
+# 预热请求，失败时抛出异常
+def warmup_invoke(model, text, max_new_tokens, timeout):
+    response = requests.post(
+        f"{API_BASE_URL}/v1/invoke",
+        json=build_invoke_data(model, text, max_new_tokens),
+        timeout=timeout
+    )
+    response.raise_for_status()
+
+WARMUP = SpeakerWarmup(warmup_invoke, load_models_with_usage,
+    top_n=WARMUP_MODELS, interval=WARMUP_INTERVAL, warm_ttl=WARMUP_INTERVAL,
+    text=WARMUP_TEXT[lang], cold_latency=WARMUP_COLD_LATENCY)
+
 # 通过文字合成音频
 def synthesize_audio(model_name, text):
     model = get_model_by_name(model_name)
@@ -288,35 +431,25 @@ def synthesize_audio(model_name, text):
         return None, t['model_not_found']
     
     try:
-        # 处理model中的reference_audio和reference_text可能包含多个项目的情况
-        reference_audio = model["reference_audio"].split("|||")[0].strip() if "|||" in model["reference_audio"] else model["reference_audio"]
-        reference_text = model["reference_text"].split("|||")[0].strip() if "|||" in model["reference_text"] else model["reference_text"]
+        fetch_model_files(model)
         
         # 调用语音合成API
-        api_data = {
-            "speaker": model["id"],
-            "text": text,
-            "format": "wav",
-            "topP": 0.7,
-            "max_new_tokens": 1024,
-            "chunk_length": 100,
-            "repetition_penalty": 1.2,
-            "temperature": 0.7,
-            "need_asr": False,
-            "streaming": False,
-            "is_fixed_seed": 0,
-            "is_norm": 0,
-            "reference_audio": reference_audio,
-            "reference_text": reference_text
-        }
+        api_data = build_invoke_data(model, text)
         
         print("synthesize_audio")
         print(f"语音合成API请求: {api_data}")
         
-        response = requests.post(
-            f"{API_BASE_URL}/v1/invoke",
-            json=api_data
-        )
+        # 统计冷启动/预热后的延迟
+        token = WARMUP.begin_request(model["id"])
+        response = None
+        try:
+            response = requests.post(
+                f"{API_BASE_URL}/v1/invoke",
+                json=api_data
+            )
+        finally:
+            WARMUP.end_request(token, success=response is not None and response.status_code == 200)
+        record_model_usage(model["id"])
         
         if response.status_code != 200:
             return None, t['audio_synthesis_failed'].format(response.text)
@@ -340,8 +473,54 @@ def synthesize_audio(model_name, text):
         error_trace = traceback.format_exc()
         return None, t['audio_synthesis_error'].format(str(e), error_trace)
 
+# 发送合成任务到后端，由任务队列调用
+def send_synthesis_job(api_data):
+    print("send_synthesis_job")
+    print(f"合成任务API请求: {api_data}")
+    
+    response = requests.post(
+        f"{API_BASE_URL2}/easy/submit",
+        json=api_data
+    )
+    
+    if response.status_code != 200:
+        return False, response.text
+    
+    result = response.json()
+    
+    if not result.get("success"):
+        return False, result.get('msg')
+    
+    return True, result.get('msg')
+
+# 查询后端任务状态，未知任务返回None
+def query_backend_status(task_id):
+    response = requests.get(
+        f"{API_BASE_URL2}/easy/query",
+        params={"code": task_id}
+    )
+    
+    if response.status_code != 200:
+        return None
+    
+    result = response.json()
+    
+    if not result.get("success"):
+        return None
+    
+    return (result.get("data") or {}).get("status")
+
+TASK_JOURNAL = TaskJournal(TASK_JOURNAL_FILE)
+
+# 任务队列状态变化时写入任务日志
+def record_job_status(job):
+    TASK_JOURNAL.update(job.task_id, status=job.status, error=job.error)
+
+JOB_QUEUE = JobQueue(send_synthesis_job, query_backend_status, JOB_QUEUE_FILE,
+    max_outstanding=JOB_MAX_OUTSTANDING, on_status=record_job_status)
+
 # 提交数字人合成任务
-def submit_synthesis_job(model_name, audio_file=None, text=None):
+def submit_synthesis_job(model_name, audio_file=None, text=None, user="", priority=PRIORITY_INTERACTIVE):
     if not model_name:
         return None, t['select_model_prompt']
     
@@ -353,8 +532,21 @@ def submit_synthesis_job(model_name, audio_file=None, text=None):
         return None, t['model_not_found']
     
     try:
+        # 相同模型和输入已提交过时关联到已有任务，避免重复渲染
+        if audio_file:
+            input_hash = hash_file(audio_file.name if hasattr(audio_file, 'name') else audio_file)
+        else:
+            input_hash = hash_text(text)
+        # 快速检查，避免重复准备音频。最终以find_or_add为准
+        existing = TASK_JOURNAL.find(model["id"], input_hash)
+        if existing:
+            return existing['task_id'], t['task_reattached'].format(existing['task_id'])
+        
+        fetch_model_files(model)
+        
         # 确定音频文件路径
         audio_path = None
+        voice_audio_path = None
         
         if audio_file:
             # 使用上传的音频文件，直接存到临时目录
@@ -396,24 +588,28 @@ def submit_synthesis_job(model_name, audio_file=None, text=None):
         }
         
         print("submit_synthesis_job")
-        print(f"合成任务API请求: {api_data}")
         print(f"音频路径: {audio_path}")
         print(f"视频路径: {model['video_path']}")
         
-        response = requests.post(
-            f"{API_BASE_URL2}/easy/submit",
-            json=api_data
-        )
-        
-        if response.status_code != 200:
-            return None, t['task_submit_failed'].format(response.text)
-        
-        result = response.json()
-        
-        if not result.get("success"):
-            return None, t['task_submit_failed'].format(result.get('msg'))
-        
-        return task_id, t['task_submitted'].format(task_id)
+        # 先写入任务日志，再加入本地队列，后端有空闲时发送
+        # 查找和写入在同一把锁内完成，同时提交的相同任务只会渲染一次
+        existing, added = TASK_JOURNAL.find_or_add(task_id, model["id"], input_hash, model_name=model_name,
+            audio_hash=hash_file(audio_path), audio_path=audio_path, backend=API_BASE_URL2,
+            user=user, priority=priority)
+        if not added:
+            # 其他请求已提交相同任务，删除本次准备的音频
+            for path in (audio_path, voice_audio_path):
+                if path and os.path.exists(path):
+                    os.remove(path)
+            return existing['task_id'], t['task_reattached'].format(existing['task_id'])
+        # 跟踪渲染片段，用于预览。在发送前加入，共享输出目录中更早的文件不属于此任务
+        PREVIEWS.add(task_id, audio_path)
+        JOB_QUEUE.enqueue(Job(task_id, api_data, user, priority))
+        
+        position = JOB_QUEUE.position(task_id)
+        if position is None:
+            return task_id, t['task_submitted'].format(task_id)
+        return task_id, t['task_enqueued'].format(task_id, position + 1, int(JOB_QUEUE.eta(task_id)))
         
     except Exception as e:
         import traceback
@@ -425,6 +621,14 @@ def query_synthesis_status(task_id):
     if not task_id:
         return t['enter_task_id'], None
     
+    # 仍在本地队列中，或发送失败
+    job = JOB_QUEUE.get(task_id)
+    if job and job.status == QUEUED:
+        position = JOB_QUEUE.position(task_id)
+        return t['task_local_queue'].format(position + 1, int(JOB_QUEUE.eta(task_id))), None
+    if job and job.status == FAILED and not job.submitted:
+        return t['task_submit_failed'].format(job.error), None
+    
     try:
         response = requests.get(
             f"{API_BASE_URL2}/easy/query",
@@ -446,27 +650,46 @@ def query_synthesis_status(task_id):
         if status == 2:  # 任务完成
             video_url = data.get("result")
             if video_url:
+                video_filename = f"{task_id}.mp4"
+                video_path = os.path.join(FACE2FACE_TEMP_PATH, video_filename)
+                # 已下载并处理过的结果不再重复下载，缺少预览版本时补上
+                if os.path.exists(video_path):
+                    POSTPROCESSOR.ensure_preview(video_path)
+                    TASK_JOURNAL.update(task_id, status=DONE, result_path=video_path)
+                    return t['synthesis_complete'], video_path
+                download_path = f"{video_path}.{uuid.uuid4().hex}.download"
                 try:
                     # 尝试下载视频
-                    video_response = requests.get(f"{API_BASE_URL2}/easy/download/{video_url.lstrip('/')}")
+                    video_response = requests.get(f"{API_BASE_URL2}/easy/download/{video_url.lstrip('/')}", stream=True)
                     
                     if video_response.status_code != 200:
                         # 下载失败，显示音频和视频的路径信息
                         return t['download_failed'].format(FACE2FACE_TEMP_PATH, video_url), None
                     
                     # 下载成功，保存视频
-                    video_filename = f"{task_id}.mp4"
-                    video_path = os.path.join(FACE2FACE_TEMP_PATH, video_filename)
+                    with open(download_path, "wb") as f:
+                        for chunk in video_response.iter_content(chunk_size=1024 * 1024):
+                            f.write(chunk)
+                    
+                    # 重新封装为faststart，浏览器无需下载整个文件即可开始播放。
+                    # 处理完成后再放到最终路径，最终路径存在即表示结果已处理完
+                    POSTPROCESSOR.process(download_path, video_path)
+                    os.replace(download_path, video_path)
                     
-                    with open(video_path, "wb") as f:
-                        f.write(video_response.content)
+                    # 上传到共享存储，其他节点也可访问结果
+                    SHARED_FILES.publish(video_path)
                     
+                    TASK_JOURNAL.update(task_id, status=DONE, result_path=video_path)
                     return t['synthesis_complete'], video_path
                 except Exception as e:
                     # 捕获下载过程中的任何错误
                     error_msg = t['download_error'].format(str(e), FACE2FACE_TEMP_PATH, video_url)
                     print(error_msg)
                     return error_msg, None
+                finally:
+                    # 未完成的下载文件
+                    if os.path.exists(download_path):
+                        os.remove(download_path)
             else:
                 return t['no_video_url'].format(FACE2FACE_TEMP_PATH), None
         elif status == 1:  # 进行中
@@ -474,11 +697,74 @@ def query_synthesis_status(task_id):
         elif status == 0:  # 排队中
             return t['task_queuing'], None
         else:  # 失败
+            TASK_JOURNAL.update(task_id, status=FAILED, error=data.get('msg'))
             return t['task_failed'].format(data.get('msg')), None
             
     except Exception as e:
         return t['query_error'].format(str(e)), None
 
+# 继续跟踪任务日志中未完成的任务（包括重启前提交的）：轮询状态并下载结果
+def resume_journal_tasks():
+    while True:
+        for task in TASK_JOURNAL.pending():
+            task_id = task['task_id']
+            job = JOB_QUEUE.get(task_id)
+            if job and job.status == QUEUED:
+                # 仍在本地队列中
+                continue
+            if time.time() - task['created'] > TASK_RESUME_TIMEOUT:
+                TASK_JOURNAL.update(task_id, status=FAILED, error="Lost")
+                continue
+            try:
+                query_synthesis_status(task_id)
+            except Exception as e:
+                print(f"Task resume error: {task_id}. {e}")
+        time.sleep(TASK_RESUME_INTERVAL)
+
+# 播放用的结果视频：有预览版本时使用较小的预览版本
+def get_result_player_path(video_path):
+    preview_path = POSTPROCESSOR.preview_path(video_path)
+    if RESULT_PREVIEW_RENDITION and os.path.exists(preview_path):
+        return preview_path
+    return video_path
+
+# 更新渲染预览，进度按已生成帧数与预期帧数估算
+def update_synthesis_preview(task_id):
+    preview = PREVIEWS.get(task_id) if task_id else None
+    if not preview:
+        return None, None, True
+    
+    # 本地排队时后端还未开始渲染，片段目录可能属于其他任务
+    job = JOB_QUEUE.get(task_id)
+    if job and job.status == QUEUED:
+        return query_synthesis_status(task_id)[0], None, False
+    if job and job.status == FAILED and not job.submitted:
+        return query_synthesis_status(task_id)[0], None, True
+    
+    try:
+        preview_path = preview.update()
+    except Exception as e:
+        print(f"Preview error: {e}")
+        return None, preview.preview_path, False
+    
+    if preview.finished:
+        return None, preview.preview_path, True
+    if not preview.expected_frames():
+        return t['preview_waiting'], preview_path, False
+    percent = int(preview.progress() * 100)
+    return t['preview_progress'].format(percent, preview.frames, preview.expected_frames()), preview_path, False
+
+# 预热统计：冷启动、预热后和预热请求的延迟
+def format_warmup_stats():
+    report = WARMUP.report()
+    lines = [f"{WARMUP}", "", f"| {t['warmup_kind']} | {t['warmup_count']} | mean | p50 | p95 |", "|---|---|---|---|---|"]
+    for kind, stats in report['latency'].items():
+        if stats['count']:
+            lines.append(f"| {kind} | {stats['count']} | {stats['mean']:.2f}s | {stats['p50']:.2f}s | {stats['p95']:.2f}s |")
+        else:
+            lines.append(f"| {kind} | 0 | - | - | - |")
+    return "\n".join(lines)
+
 # 创建Gradio界面
 with gr.Blocks(title=t['title']) as app:
     gr.Markdown(f"# {t['title']}")
@@ -525,17 +811,26 @@ with gr.Blocks(title=t['title']) as app:
                         audio_input = gr.Audio(label=t['upload_audio'], type="filepath")
                         audio_submit_btn = gr.Button(t['synthesize'])
                 
+                batch_input = gr.Checkbox(label=t['batch_job'], value=False)
                 task_id_output = gr.Textbox(label=t['task_id'])
             
             with gr.Column():
                 status_output = gr.Textbox(label=t['synthesis_status'], lines=3)
+                preview_output = gr.Video(label=t['synthesis_preview'], autoplay=True)
                 video_output = gr.Video(label=t['synthesis_result'])
+                result_file_output = gr.File(label=t['synthesis_result_file'])
                 query_btn = gr.Button(t['query_status'])
+                preview_timer = gr.Timer(PREVIEW_INTERVAL, active=False)
     
     # 添加刷新按钮
     with gr.Row():
         refresh_btn = gr.Button(t['refresh_models'])
     
+    # 音色预热统计
+    with gr.Accordion(t['warmup_stats'], open=False):
+        warmup_output = gr.Markdown(format_warmup_stats())
+        warmup_btn = gr.Button(t['refresh_warmup'])
+    
     # 绑定事件
     def start_training(video_file, name):
         if not video_file:
@@ -560,39 +855,68 @@ with gr.Blocks(title=t['title']) as app:
         # 返回更新后的下拉框内容 - 使用gr.update而不是gr.Dropdown.update
         return gr.update(choices=model_names), gr.update(choices=model_names)
     
+    # 任务队列中区分用户，用于公平调度
+    def get_request_user(request):
+        if request is None:
+            return ""
+        return request.username or (request.client.host if request.client else "")
+    
     # 提交文字合成任务
-    def submit_with_text(model, text):
+    def submit_with_text(model, text, batch, request: gr.Request):
         if not model:
             return None, t['error_no_model']
         if not text:
             return None, t['error_no_text']
             
         # 提交任务
-        task_id, message = submit_synthesis_job(model, text=text)
+        task_id, message = submit_synthesis_job(model, text=text, user=get_request_user(request),
+            priority=PRIORITY_BATCH if batch else PRIORITY_INTERACTIVE)
         
         # 返回任务ID和消息
         return task_id, f"{t['processing_text']}\n{message}"
     
     # 提交音频合成任务
-    def submit_with_audio(model, audio):
+    def submit_with_audio(model, audio, batch, request: gr.Request):
         if not model:
             return None, t['error_no_model']
         if not audio:
             return None, t['error_no_audio']
             
         # 提交任务
-        task_id, message = submit_synthesis_job(model, audio_file=audio)
+        task_id, message = submit_synthesis_job(model, audio_file=audio, user=get_request_user(request),
+            priority=PRIORITY_BATCH if batch else PRIORITY_INTERACTIVE)
         
         # 返回任务ID和消息
         return task_id, f"{t['processing_audio']}\n{message}"
     
-    # 修改状态查询函数，返回结果
+    # 修改状态查询函数，返回播放用的视频和完整画质结果
     def query_task_status(task_id):
         if not task_id:
-            return t['enter_task_id'], None
+            return t['enter_task_id'], None, None
             
         status, video_path = query_synthesis_status(task_id)
-        return status, video_path if video_path else None
+        if not video_path:
+            return status, None, None
+        return status, get_result_player_path(video_path), video_path
+    
+    # 提交后开始刷新预览
+    def start_preview(task_id):
+        return gr.Timer(active=bool(task_id))
+    
+    # 定时刷新预览，渲染结束后获取最终结果
+    def refresh_preview(task_id):
+        status, preview_path, finished = update_synthesis_preview(task_id)
+        if not finished:
+            return status or gr.update(), preview_path or gr.update(), gr.update(), gr.update(), gr.Timer(active=True)
+        
+        status, video_path, result_path = query_task_status(task_id)
+        if video_path:
+            PREVIEWS.remove(task_id)
+            return status, None, video_path, result_path, gr.Timer(active=False)
+        # 等待最终视频，任务失败时超时停止
+        preview = PREVIEWS.get(task_id)
+        waiting = preview is not None and time.time() - preview.finished_time < PREVIEW_RESULT_TIMEOUT
+        return status, preview_path or gr.update(), gr.update(), gr.update(), gr.Timer(active=waiting)
     
     # 训练按钮点击事件
     train_btn.click(
@@ -615,28 +939,59 @@ with gr.Blocks(title=t['title']) as app:
     # 提交合成任务事件
     text_submit_btn.click(
         submit_with_text,
-        inputs=[synth_model, text_input],
+        inputs=[synth_model, text_input, batch_input],
         outputs=[task_id_output, status_output]
+    ).then(
+        start_preview,
+        inputs=[task_id_output],
+        outputs=[preview_timer]
     )
     
     audio_submit_btn.click(
         submit_with_audio,
-        inputs=[synth_model, audio_input],
+        inputs=[synth_model, audio_input, batch_input],
         outputs=[task_id_output, status_output]
+    ).then(
+        start_preview,
+        inputs=[task_id_output],
+        outputs=[preview_timer]
+    )
+    
+    # 预览定时刷新事件
+    preview_timer.tick(
+        refresh_preview,
+        inputs=[task_id_output],
+        outputs=[status_output, preview_output, video_output, result_file_output, preview_timer]
     )
     
     # 手动查询状态事件
     query_btn.click(
         query_task_status,
         inputs=[task_id_output],
-        outputs=[status_output, video_output]
+        outputs=[status_output, video_output, result_file_output]
+    )
+    
+    # 预热统计刷新事件
+    warmup_btn.click(
+        format_warmup_stats,
+        inputs=None,
+        outputs=[warmup_output]
     )
 
 # 启动应用
 if __name__ == "__main__":
+    # 后台预热最近/常用的数字人
+    WARMUP.start()
+    # 按优先级和并发上限向后端发送排队的任务
+    JOB_QUEUE.start()
+    # 重启前提交的任务继续轮询和下载
+    print(TASK_JOURNAL)
+    threading.Thread(target=resume_journal_tasks, name="task-resume", daemon=True).start()
     app.launch(
         # server_name="0.0.0.0",
         # server_port=7860,
         inbrowser=True,
+        # 预览文件位于PREVIEW_PATH
+        allowed_paths=[PREVIEW_PATH],
         # share=True
     )
@@ -0,0 +1,299 @@
+"""Local synthesis job queue in front of the gen-video `/easy/submit` API.
+
+Jobs wait here until the backend has a free slot. Interactive jobs go before batch jobs,
+users take turns within a priority class, and the number of jobs outstanding on the
+backend is capped. The queue is saved to a json file, so it survives restarts"""
+import os
+import json
+import time
+import threading
+
+PRIORITY_INTERACTIVE = "interactive"
+PRIORITY_BATCH = "batch"
+PRIORITIES = (PRIORITY_INTERACTIVE, PRIORITY_BATCH)
+
+# Job status
+QUEUED = "queued"
+SUBMITTED = "submitted"
+DONE = "done"
+FAILED = "failed"
+
+# Backend task status, from /easy/query
+BACKEND_QUEUED = 0
+BACKEND_RUNNING = 1
+BACKEND_DONE = 2
+
+class Job(object):
+    """A synthesis job and its place in the queue"""
+    def __init__(self, task_id, api_data, user="", priority=PRIORITY_INTERACTIVE):
+        if priority not in PRIORITIES:
+            raise ValueError(f"Unknown priority: {priority}")
+        self.task_id = task_id
+        self.api_data = api_data
+        self.user = user
+        self.priority = priority
+        self.status = QUEUED
+        self.created = time.time()
+        self.submitted = 0
+        self.finished = 0
+        self.error = None
+
+    def __str__(self):
+        return f"Job {self.task_id}. User: {self.user}, Priority: {self.priority}, Status: {self.status}"
+
+    def to_dict(self):
+        """Job as saved in the queue file"""
+        return dict(self.__dict__)
+
+    @classmethod
+    def from_dict(cls, data):
+        """Job from the queue file"""
+        job = cls(data['task_id'], data['api_data'], data.get('user', ""),
+            data.get('priority', PRIORITY_INTERACTIVE))
+        job.__dict__.update(data)
+        return job
+
+class JobQueue(object):
+    """Admission control for the gen-video backend"""
+    def __init__(self, submit, query, queue_file, max_outstanding=2, poll_interval=5.0,
+                 default_duration=120.0, keep_finished=200, lost_timeout=600.0, on_status=None):
+        # submit(api_data) -> (success, message) sends a job to the backend
+        self.submit = submit
+        # query(task_id) -> backend status (0 queued, 1 running, 2 done, other failed), or None if unknown
+        self.query = query
+        self.queue_file = queue_file
+        self.max_outstanding = max_outstanding
+        self.poll_interval = poll_interval
+        # Seconds per job until durations have been measured
+        self.default_duration = default_duration
+        self.keep_finished = keep_finished
+        # Seconds a submitted job may stay unknown to the backend before it's given up
+        self.lost_timeout = lost_timeout
+        # on_status(job) is called after a job is sent, finishes or fails
+        self.on_status = on_status
+        self.jobs = {}
+        # Last dispatch time per user, for turns within a priority class
+        self.last_dispatch = {}
+        self.durations = []
+        self.lock = threading.RLock()
+        self.wakeup = threading.Event()
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.load()
+
+    def __str__(self):
+        return f"Job queue. Queued: {len(self.queued())}, Outstanding: {len(self.outstanding())}" \
+            f"/{self.max_outstanding}, Average duration: {self.average_duration():.0f}s"
+
+    def load(self):
+        """Read the saved queue"""
+        if not os.path.exists(self.queue_file):
+            return
+        with open(self.queue_file, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        with self.lock:
+            self.jobs = {job['task_id']: Job.from_dict(job) for job in data.get('jobs', [])}
+            self.last_dispatch = data.get('last_dispatch', {})
+            self.durations = data.get('durations', [])
+
+    def save(self):
+        """Write the queue. Replaced atomically, so a crash never leaves half a file"""
+        with self.lock:
+            data = {
+                'jobs': [job.to_dict() for job in self.jobs.values()],
+                'last_dispatch': self.last_dispatch,
+                'durations': self.durations
+            }
+            tmp_file = self.queue_file + ".tmp"
+            with open(tmp_file, "w", encoding="utf-8") as f:
+                json.dump(data, f, ensure_ascii=False, indent=2)
+            os.replace(tmp_file, self.queue_file)
+
+    def enqueue(self, job):
+        """Add a job. It's sent to the backend when a slot is free"""
+        with self.lock:
+            self.jobs[job.task_id] = job
+            self.save()
+        self.wakeup.set()
+        return job
+
+    def get(self, task_id):
+        """Job of a task, or None"""
+        with self.lock:
+            return self.jobs.get(task_id)
+
+    def queued(self):
+        """Jobs waiting to be sent"""
+        with self.lock:
+            return [job for job in self.jobs.values() if job.status == QUEUED]
+
+    def outstanding(self):
+        """Jobs sent to the backend and not finished"""
+        with self.lock:
+            return [job for job in self.jobs.values() if job.status == SUBMITTED]
+
+    def _pick(self, queued, outstanding_users, last_dispatch):
+        """Next job: best priority class, then the user with fewest outstanding jobs
+        and longest since their last dispatch, then that user's oldest job"""
+        if not queued:
+            return None
+        best = min(PRIORITIES.index(job.priority) for job in queued)
+        candidates = [job for job in queued if PRIORITIES.index(job.priority) == best]
+        users = {job.user for job in candidates}
+        user = min(users, key=lambda user: (outstanding_users.get(user, 0), last_dispatch.get(user, 0), user))
+        return min((job for job in candidates if job.user == user), key=lambda job: job.created)
+
+    def ordered(self):
+        """Queued jobs in the order they will be sent, if nothing else is added"""
+        with self.lock:
+            queued = self.queued()
+            outstanding_users = {}
+            for job in self.outstanding():
+                outstanding_users[job.user] = outstanding_users.get(job.user, 0) + 1
+            last_dispatch = dict(self.last_dispatch)
+        order = []
+        # Picked jobs are dispatched later than anything so far
+        clock = max(list(last_dispatch.values()) + [time.time()])
+        while queued:
+            job = self._pick(queued, outstanding_users, last_dispatch)
+            queued.remove(job)
+            order.append(job)
+            clock += 1
+            last_dispatch[job.user] = clock
+            outstanding_users[job.user] = outstanding_users.get(job.user, 0) + 1
+        return order
+
+    def position(self, task_id):
+        """0-based place in the queue, or None if not queued"""
+        for position, job in enumerate(self.ordered()):
+            if job.task_id == task_id:
+                return position
+        return None
+
+    def average_duration(self):
+        """Seconds a job takes on the backend"""
+        return sum(self.durations) / len(self.durations) if self.durations else self.default_duration
+
+    def eta(self, task_id):
+        """Estimated seconds until the job is done, or None if it isn't waiting or running"""
+        job = self.get(task_id)
+        if job is None:
+            return None
+        duration = self.average_duration()
+        if job.status == SUBMITTED:
+            return max(duration - (time.time() - job.submitted), 0.0)
+        if job.status != QUEUED:
+            return None
+        position = self.position(task_id)
+        # Each wave of max_outstanding jobs takes one average duration
+        waves = (position + len(self.outstanding())) // self.max_outstanding
+        return waves * duration + duration
+
+    def dispatch(self):
+        """Send queued jobs while there are free slots. Returns the jobs sent"""
+        sent = []
+        while True:
+            with self.lock:
+                if len(self.outstanding()) >= self.max_outstanding:
+                    break
+                order = self.ordered()
+                if not order:
+                    break
+                job = order[0]
+                # Taken out of the queue while the request runs
+                job.status = SUBMITTED
+                job.submitted = time.time()
+                self.last_dispatch[job.user] = job.submitted
+            try:
+                success, message = self.submit(job.api_data)
+            except Exception as e:
+                success, message = False, str(e)
+            with self.lock:
+                if not success:
+                    # Never reached the backend
+                    job.status = FAILED
+                    job.submitted = 0
+                    job.finished = time.time()
+                    job.error = message
+                    print(f"Job submit failed: {job}. {message}")
+                else:
+                    print(f"Job submitted: {job}")
+                    sent.append(job)
+                self.save()
+            self._notify(job)
+        return sent
+
+    def poll(self):
+        """Check outstanding jobs on the backend, freeing slots of finished ones"""
+        changed = []
+        for job in self.outstanding():
+            try:
+                status = self.query(job.task_id)
+            except Exception as e:
+                print(f"Job query failed: {job}. {e}")
+                continue
+            if status in (BACKEND_QUEUED, BACKEND_RUNNING):
+                continue
+            if status is None and time.time() - job.submitted < self.lost_timeout:
+                continue
+            with self.lock:
+                job.finished = time.time()
+                if status is None:
+                    # e.g. interrupted while being submitted
+                    job.status = FAILED
+                    job.error = "Unknown to the backend"
+                elif status == BACKEND_DONE:
+                    job.status = DONE
+                    self.durations = (self.durations + [job.finished - job.submitted])[-50:]
+                else:
+                    job.status = FAILED
+                    job.error = f"Backend status: {status}"
+                changed.append(job)
+        if changed:
+            self._forget_finished()
+            self.save()
+        for job in changed:
+            self._notify(job)
+        return bool(changed)
+
+    def _notify(self, job):
+        """Report a status change"""
+        if self.on_status is None:
+            return
+        try:
+            self.on_status(job)
+        except Exception as e:
+            print(f"Job status callback failed: {job}. {e}")
+
+    def _forget_finished(self):
+        """Keep only the latest finished jobs"""
+        with self.lock:
+            finished = sorted((job for job in self.jobs.values() if job.status in (DONE, FAILED)),
+                key=lambda job: job.finished)
+            for job in finished[:-self.keep_finished] if self.keep_finished else finished:
+                del self.jobs[job.task_id]
+
+    def start(self):
+        """Run the scheduler on a background thread"""
+        if self.thread and self.thread.is_alive():
+            return self
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self._run, name="job-queue", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """Stop the scheduler. Queued jobs stay saved"""
+        self.stop_event.set()
+        self.wakeup.set()
+
+    def _run(self):
+        """Worker: poll and dispatch until stopped"""
+        while not self.stop_event.is_set():
+            try:
+                self.poll()
+                self.dispatch()
+            except Exception as e:
+                print(f"Job queue error: {e}")
+            self.wakeup.wait(self.poll_interval)
+            self.wakeup.clear()
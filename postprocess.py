@@ -0,0 +1,121 @@
+"""Post-processing of downloaded synthesis results.
+
+The index of an mp4 (`moov` box) may come after the media data (`mdat`), and then a
+browser has to fetch the whole file before playback can start. Results are remuxed
+with the index first, without re-encoding, and can get a lower bitrate preview
+rendition for the player"""
+import os
+import shutil
+import struct
+import subprocess
+
+def read_top_level_boxes(path):
+    """(type, offset, size) of the top-level boxes of an mp4 file"""
+    boxes = []
+    file_size = os.path.getsize(path)
+    with open(path, "rb") as f:
+        offset = 0
+        while offset + 8 <= file_size:
+            f.seek(offset)
+            size, box_type = struct.unpack(">I4s", f.read(8))
+            if size == 1: # 64-bit size follows the type
+                size = struct.unpack(">Q", f.read(8))[0]
+            elif size == 0: # Box runs to the end of the file
+                size = file_size - offset
+            if size < 8:
+                break
+            boxes.append((box_type.decode("latin-1"), offset, size))
+            offset += size
+    return boxes
+
+def is_fast_start(path):
+    """The index comes before the media data, so playback can start from the first bytes"""
+    types = [box_type for box_type, _, _ in read_top_level_boxes(path)]
+    if "moov" not in types:
+        return False
+    return "mdat" not in types or types.index("moov") < types.index("mdat")
+
+class ResultPostProcessor(object):
+    """Fast-start remux and optional preview rendition of result videos. Needs ffmpeg,
+    without it results are left as they are"""
+    def __init__(self, fast_start=True, preview=False, preview_height=480, preview_bitrate="1M",
+                 ffmpeg=None):
+        self.fast_start = fast_start
+        self.preview = preview
+        self.preview_height = preview_height
+        self.preview_bitrate = preview_bitrate
+        self.ffmpeg = ffmpeg or shutil.which("ffmpeg")
+        self.remuxed = 0
+        self.previews = 0
+        self.failed = 0
+
+    def __str__(self):
+        return f"Result post-processor. Fast start: {self.fast_start}, Preview: {self.preview}, " \
+            f"Remuxed: {self.remuxed}, Previews: {self.previews}, Failed: {self.failed}"
+
+    def _run(self, command):
+        """Run ffmpeg, True if it succeeded"""
+        result = subprocess.run(command, capture_output=True, check=False)
+        if result.returncode != 0:
+            self.failed += 1
+            print(f"Post-process ffmpeg failed: {result.stderr.decode(errors='ignore')}")
+        return result.returncode == 0
+
+    def preview_path(self, path):
+        """Path of the preview rendition of a result"""
+        base, _ = os.path.splitext(path)
+        return f"{base}.preview.mp4"
+
+    def remux_fast_start(self, path):
+        """Move the index to the front, in place. True if the file is fast-start afterwards"""
+        if is_fast_start(path):
+            return True
+        if not self.ffmpeg:
+            return False
+        tmp_path = f"{os.path.splitext(path)[0]}.faststart.mp4"
+        ok = self._run([self.ffmpeg, "-y", "-loglevel", "error", "-i", path,
+            "-map", "0", "-c", "copy", "-movflags", "+faststart", tmp_path])
+        if not ok:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return False
+        os.replace(tmp_path, path)
+        self.remuxed += 1
+        return True
+
+    def make_preview(self, path, result_path=None):
+        """Lower resolution and bitrate rendition, fast-start. Returns its path, or None.
+        It's named after result_path, the final path of a file still being processed"""
+        if not self.ffmpeg:
+            return None
+        preview_path = self.preview_path(result_path or path)
+        tmp_path = f"{os.path.splitext(preview_path)[0]}.tmp.mp4"
+        ok = self._run([self.ffmpeg, "-y", "-loglevel", "error", "-i", path,
+            "-vf", f"scale=-2:'min({self.preview_height},ih)'",
+            "-c:v", "libx264", "-preset", "veryfast", "-pix_fmt", "yuv420p",
+            "-b:v", self.preview_bitrate, "-maxrate", self.preview_bitrate, "-bufsize", self.preview_bitrate,
+            "-c:a", "aac", "-b:a", "96k", "-movflags", "+faststart", tmp_path])
+        if not ok:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return None
+        os.replace(tmp_path, preview_path)
+        self.previews += 1
+        return preview_path
+
+    def process(self, path, result_path=None):
+        """Post-process a downloaded result in place, before it's moved to result_path.
+        Returns (result path, preview path or None)"""
+        if self.fast_start:
+            self.remux_fast_start(path)
+        preview_path = self.make_preview(path, result_path) if self.preview else None
+        return result_path or path, preview_path
+
+    def ensure_preview(self, path):
+        """Preview rendition of a result processed earlier, made now if it's missing"""
+        if not self.preview:
+            return None
+        preview_path = self.preview_path(path)
+        if os.path.exists(preview_path):
+            return preview_path
+        return self.make_preview(path)
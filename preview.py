@@ -0,0 +1,247 @@
+"""Progressive preview of a synthesis task, stitched from the segments rendered so far.
+
+The gen-video container writes `output/avi/N.avi` segments into the shared temp directory
+while it renders, and deletes `output` when it's done. New segments are encoded once into
+MPEG-TS parts, and each preview joins the parts without re-encoding, with the matching
+span of the submitted audio"""
+import os
+import time
+import wave
+import shutil
+import contextlib
+import threading
+import subprocess
+import cv2
+from pydub import AudioSegment
+
+# Seconds a segment must be unchanged before it's considered fully written
+SEGMENT_SETTLE_TIME = 0.5
+# Seconds the audio of the shared output may differ from the submitted audio
+SHARED_AUDIO_TOLERANCE = 0.1
+
+def get_segment_number(path):
+    """Numeric index of a segment file (`12.avi` -> 12), or None"""
+    name, _ = os.path.splitext(os.path.basename(path))
+    return int(name) if name.isdigit() else None
+
+def get_wav_duration(path):
+    """Length of a .wav in seconds, or None if it can't be read yet"""
+    try:
+        with contextlib.closing(wave.open(path, 'rb')) as f:
+            return f.getnframes() / float(f.getframerate())
+    except (OSError, EOFError, wave.Error):
+        return None
+
+def probe_video(path):
+    """(frame_count, fps) of a video file"""
+    vidcap = cv2.VideoCapture(path)
+    try:
+        return int(vidcap.get(cv2.CAP_PROP_FRAME_COUNT)), vidcap.get(cv2.CAP_PROP_FPS)
+    finally:
+        vidcap.release()
+
+class TaskPreview(object):
+    """Preview and progress of one synthesis task"""
+    def __init__(self, task_id, audio_path, segment_dirs, preview_dir, ffmpeg=None, shared_output_dir=None):
+        self.task_id = task_id
+        self.audio_path = audio_path
+        # Candidate directories with the task segments, first existing one is used
+        self.segment_dirs = segment_dirs
+        # `output` directory shared by all tasks in the single job layout.
+        # Only used once its audio shows it's rendering this task
+        self.shared_output_dir = shared_output_dir
+        self.shared_audio_mtime = None
+        self.rejected_audio_mtime = None
+        self.submitted = time.time()
+        self.preview_dir = os.path.join(preview_dir, task_id)
+        self.ffmpeg = ffmpeg or shutil.which("ffmpeg")
+        self.audio_duration = AudioSegment.from_file(audio_path).duration_seconds
+        self.lock = threading.Lock()
+        self.fps = 0.0
+        # Segments encoded into parts, in order
+        self.segments = []
+        self.frames = 0
+        self.parts = []
+        self.preview_path = None
+        self.seen_segments = False
+        self.finished = False
+        self.finished_time = 0
+        self.updated = 0
+
+    def __str__(self):
+        return f"Preview {self.task_id}. Segments: {len(self.segments)}, " \
+            f"Frames: {self.frames}/{self.expected_frames()}, Progress: {self.progress():.0%}"
+
+    def expected_frames(self):
+        """Frames of the whole render, from the audio length. 0 until the fps is known"""
+        return int(self.audio_duration * self.fps) if self.fps > 0 else 0
+
+    def progress(self):
+        """Fraction of the expected frames rendered so far"""
+        expected = self.expected_frames()
+        if self.finished:
+            return 1.0
+        return min(self.frames / expected, 1.0) if expected else 0.0
+
+    def segment_dir(self):
+        """Directory the task is rendering into, or None"""
+        for segment_dir in self.segment_dirs:
+            if os.path.isdir(segment_dir):
+                return segment_dir
+        if self.shared_output_dir and self.owns_shared_output():
+            segment_dir = os.path.join(self.shared_output_dir, "avi")
+            if os.path.isdir(segment_dir):
+                return segment_dir
+        return None
+
+    def owns_shared_output(self):
+        """The shared `output` directory is rendering this task: its temp.wav was written
+        after the task was submitted, with the length of the submitted audio.
+        Once another job rewrites it, the directory isn't ours anymore"""
+        audio_path = os.path.join(self.shared_output_dir, "temp.wav")
+        try:
+            mtime = os.path.getmtime(audio_path)
+        except OSError:
+            return False
+        if self.shared_audio_mtime is not None:
+            return mtime == self.shared_audio_mtime
+        if mtime < self.submitted or mtime == self.rejected_audio_mtime:
+            return False
+        duration = get_wav_duration(audio_path)
+        if duration is None:
+            # Still being written
+            return False
+        if abs(duration - self.audio_duration) > SHARED_AUDIO_TOLERANCE:
+            self.rejected_audio_mtime = mtime
+            return False
+        self.shared_audio_mtime = mtime
+        return True
+
+    def ready_segments(self):
+        """New segments that can be added: consecutive after the last added one, fully written"""
+        segment_dir = self.segment_dir()
+        if segment_dir is None:
+            if self.seen_segments and not self.finished:
+                # Output is deleted once the render is done
+                self.finished = True
+                self.finished_time = time.time()
+            return []
+        self.seen_segments = True
+        numbers = {}
+        for name in os.listdir(segment_dir):
+            number = get_segment_number(name)
+            if number is not None:
+                numbers[number] = os.path.join(segment_dir, name)
+        ready = []
+        now = time.time()
+        number = len(self.segments)
+        while number in numbers:
+            path = numbers[number]
+            try:
+                if now - os.path.getmtime(path) < SEGMENT_SETTLE_TIME:
+                    break
+            except OSError:
+                break
+            ready.append(path)
+            number += 1
+        return ready
+
+    def update(self):
+        """Add new segments and rebuild the preview. Returns the preview path, or None"""
+        with self.lock:
+            segments = self.ready_segments()
+            if not segments:
+                return self.preview_path
+            frames = 0
+            for path in segments:
+                frame_count, fps = probe_video(path)
+                if fps > 0 and self.fps <= 0:
+                    self.fps = fps
+                frames += frame_count
+            if self.ffmpeg:
+                os.makedirs(self.preview_dir, exist_ok=True)
+                part = self._encode_part(segments)
+                if part is None:
+                    return self.preview_path
+                self.parts.append(part)
+            self.segments.extend(segments)
+            self.frames += frames
+            self.updated = time.time()
+            if self.ffmpeg:
+                self._build_preview()
+            return self.preview_path
+
+    def _run(self, command):
+        """Run ffmpeg, True if it succeeded"""
+        result = subprocess.run(command, capture_output=True, check=False)
+        if result.returncode != 0:
+            print(f"Preview ffmpeg failed: {result.stderr.decode(errors='ignore')}")
+        return result.returncode == 0
+
+    def _encode_part(self, segments):
+        """Encode segments into one MPEG-TS part, or None"""
+        list_path = os.path.join(self.preview_dir, f"part_{len(self.parts):04d}.txt")
+        part_path = os.path.join(self.preview_dir, f"part_{len(self.parts):04d}.ts")
+        with open(list_path, "w", encoding="utf-8") as f:
+            for path in segments:
+                f.write(f"file '{os.path.abspath(path)}'\n")
+        ok = self._run([self.ffmpeg, "-y", "-loglevel", "error",
+            "-f", "concat", "-safe", "0", "-i", list_path,
+            "-c:v", "libx264", "-preset", "veryfast", "-pix_fmt", "yuv420p",
+            "-an", "-f", "mpegts", part_path])
+        os.remove(list_path)
+        return part_path if ok else None
+
+    def _build_preview(self):
+        """Join the parts and the matching audio span into a new mp4"""
+        duration = self.frames / self.fps if self.fps > 0 else 0.0
+        # A new name each time, so the browser reloads it
+        preview_path = os.path.join(self.preview_dir, f"preview_{len(self.parts):04d}.mp4")
+        list_path = os.path.join(self.preview_dir, "parts.txt")
+        with open(list_path, "w", encoding="utf-8") as f:
+            for part in self.parts:
+                f.write(f"file '{os.path.abspath(part)}'\n")
+        ok = self._run([self.ffmpeg, "-y", "-loglevel", "error",
+            "-f", "concat", "-safe", "0", "-i", list_path,
+            "-t", f"{duration:.3f}", "-i", self.audio_path,
+            "-map", "0:v:0", "-map", "1:a:0", "-c:v", "copy", "-c:a", "aac",
+            "-movflags", "+faststart", preview_path])
+        if not ok:
+            return
+        previous = self.preview_path
+        self.preview_path = preview_path
+        if previous and os.path.exists(previous):
+            os.remove(previous)
+
+    def cleanup(self):
+        """Delete the preview files"""
+        shutil.rmtree(self.preview_dir, ignore_errors=True)
+
+class PreviewRegistry(object):
+    """Previews of submitted tasks"""
+    def __init__(self, temp_path, preview_path):
+        self.temp_path = temp_path
+        self.preview_path = preview_path
+        self.previews = {}
+        self.lock = threading.Lock()
+
+    def add(self, task_id, audio_path):
+        """Track a submitted task"""
+        segment_dirs = [os.path.join(self.temp_path, task_id, "output", "avi")]
+        preview = TaskPreview(task_id, audio_path, segment_dirs, self.preview_path,
+            shared_output_dir=os.path.join(self.temp_path, "output"))
+        with self.lock:
+            self.previews[task_id] = preview
+        return preview
+
+    def get(self, task_id):
+        """Preview of a task, or None"""
+        with self.lock:
+            return self.previews.get(task_id)
+
+    def remove(self, task_id):
+        """Stop tracking a task and delete its preview files"""
+        with self.lock:
+            preview = self.previews.pop(task_id, None)
+        if preview:
+            preview.cleanup()
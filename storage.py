@@ -0,0 +1,382 @@
+"""Shared storage for models and media, so several app nodes can use the same data.
+
+The backends only see local directories (`~/heygem_data/voice/data`, `~/heygem_data/face2face/temp`).
+SharedFiles keeps those paths: files are published from them to a shared storage,
+and fetched into them on demand. Fetched files are a local cache, evicted least
+recently used first when over a size limit"""
+import os
+import copy
+import json
+import time
+import uuid
+import shutil
+import random
+import hashlib
+import threading
+import contextlib
+
+try:
+    import boto3
+    from boto3.s3.transfer import TransferConfig
+except ImportError:
+    boto3 = None
+
+COPY_BUFFER_SIZE = 1024 * 1024
+# Seconds after which a lock file of a crashed writer is broken
+LOCK_TIMEOUT = 30
+# Conditional json updates retried on conflicts, with a short random wait
+UPDATE_RETRIES = 10
+# write_bytes without a version condition
+ANY_VERSION = object()
+
+class StorageError(Exception):
+    """Shared storage operation failed"""
+
+class PreconditionFailed(StorageError):
+    """Object was changed by another writer since it was read"""
+
+class LocalStorage(object):
+    """Storage in a directory, e.g. a shared network mount"""
+    def __init__(self, root):
+        self.root = os.path.abspath(os.path.expanduser(root))
+        os.makedirs(self.root, exist_ok=True)
+
+    def __str__(self):
+        return f"Local storage: {self.root}"
+
+    def _path(self, key):
+        path = os.path.abspath(os.path.join(self.root, key))
+        if not path.startswith(self.root + os.sep):
+            raise StorageError(f"Key outside storage: {key}")
+        return path
+
+    def exists(self, key):
+        """Object exists"""
+        return os.path.isfile(self._path(key))
+
+    def put_file(self, key, path):
+        """Upload a local file"""
+        target = self._path(key)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        tmp = f"{target}.{uuid.uuid4().hex}.tmp"
+        with open(path, "rb") as fsrc, open(tmp, "wb") as fdst:
+            shutil.copyfileobj(fsrc, fdst, COPY_BUFFER_SIZE)
+        os.replace(tmp, target)
+
+    def get_file(self, key, path):
+        """Download to a local file"""
+        source = self._path(key)
+        if not os.path.isfile(source):
+            raise StorageError(f"Object not found: {key}")
+        with open(source, "rb") as fsrc, open(path, "wb") as fdst:
+            shutil.copyfileobj(fsrc, fdst, COPY_BUFFER_SIZE)
+
+    def read_bytes(self, key):
+        """Small object content, or None if it doesn't exist"""
+        return self.read_versioned(key)[0]
+
+    def read_versioned(self, key):
+        """(content, version) of a small object, (None, None) if it doesn't exist"""
+        path = self._path(key)
+        if not os.path.isfile(path):
+            return None, None
+        with open(path, "rb") as f:
+            data = f.read()
+        return data, hashlib.sha256(data).hexdigest()
+
+    def write_bytes(self, key, data, version=ANY_VERSION):
+        """Replace a small object. With a version, only if the object still has it,
+        None meaning it must not exist. Raises PreconditionFailed otherwise"""
+        target = self._path(key)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        tmp = f"{target}.{uuid.uuid4().hex}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        try:
+            if version is ANY_VERSION:
+                os.replace(tmp, target)
+                return
+            # Other nodes share the directory, a lock file orders their writes
+            with self._lock(target):
+                if self.read_versioned(key)[1] != version:
+                    raise PreconditionFailed(f"Object changed: {key}")
+                os.replace(tmp, target)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+    @contextlib.contextmanager
+    def _lock(self, target):
+        """Lock file next to an object, created exclusively"""
+        lock_path = target + ".lock"
+        deadline = time.time() + LOCK_TIMEOUT
+        while True:
+            try:
+                fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+                os.close(fd)
+                break
+            except FileExistsError:
+                try:
+                    if time.time() - os.path.getmtime(lock_path) > LOCK_TIMEOUT:
+                        # Left by a writer that crashed
+                        os.remove(lock_path)
+                        continue
+                except OSError:
+                    continue
+                if time.time() > deadline:
+                    raise StorageError(f"Timed out waiting for lock: {lock_path}")
+                time.sleep(0.01)
+        try:
+            yield
+        finally:
+            os.remove(lock_path)
+
+    def delete(self, key):
+        """Remove an object, if it exists"""
+        path = self._path(key)
+        if os.path.isfile(path):
+            os.remove(path)
+
+class S3Storage(object):
+    """Storage in an S3-compatible bucket (AWS S3, MinIO, ...).
+    Credentials come from the usual AWS environment variables or config files"""
+    def __init__(self, bucket, prefix="", endpoint_url=None, region=None,
+                 multipart_threshold=16 * 1024 * 1024, max_concurrency=4, client=None):
+        if client is None and boto3 is None:
+            raise StorageError("S3 storage needs boto3: pip install boto3")
+        self.bucket = bucket
+        self.prefix = prefix.strip("/")
+        # client is an already configured S3 client, boto3's by default
+        self.client = client or boto3.client("s3", endpoint_url=endpoint_url, region_name=region)
+        # Large files are streamed in parts, never held in memory
+        self.transfer_config = TransferConfig(multipart_threshold=multipart_threshold,
+            multipart_chunksize=multipart_threshold, max_concurrency=max_concurrency) if boto3 else None
+
+    def __str__(self):
+        return f"S3 storage: s3://{self.bucket}/{self.prefix}"
+
+    def _key(self, key):
+        return f"{self.prefix}/{key}" if self.prefix else key
+
+    def _error_code(self, error):
+        return getattr(error, 'response', {}).get('Error', {}).get('Code')
+
+    def _not_found(self, error):
+        return self._error_code(error) in ("404", "NoSuchKey", "NotFound")
+
+    def _conflict(self, error):
+        # 412 when the condition fails, 409 when a concurrent conditional write won
+        return self._error_code(error) in ("412", "PreconditionFailed", "409", "ConditionalRequestConflict")
+
+    def exists(self, key):
+        """Object exists"""
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=self._key(key))
+            return True
+        except Exception as e:
+            if self._not_found(e):
+                return False
+            raise StorageError(f"S3 head failed for {key}: {e}") from e
+
+    def put_file(self, key, path):
+        """Upload a local file"""
+        try:
+            self.client.upload_file(path, self.bucket, self._key(key), Config=self.transfer_config)
+        except Exception as e:
+            raise StorageError(f"S3 upload failed for {key}: {e}") from e
+
+    def get_file(self, key, path):
+        """Download to a local file"""
+        try:
+            self.client.download_file(self.bucket, self._key(key), path, Config=self.transfer_config)
+        except Exception as e:
+            raise StorageError(f"S3 download failed for {key}: {e}") from e
+
+    def read_bytes(self, key):
+        """Small object content, or None if it doesn't exist"""
+        return self.read_versioned(key)[0]
+
+    def read_versioned(self, key):
+        """(content, ETag) of a small object, (None, None) if it doesn't exist"""
+        try:
+            response = self.client.get_object(Bucket=self.bucket, Key=self._key(key))
+            return response['Body'].read(), response['ETag']
+        except Exception as e:
+            if self._not_found(e):
+                return None, None
+            raise StorageError(f"S3 read failed for {key}: {e}") from e
+
+    def write_bytes(self, key, data, version=ANY_VERSION):
+        """Replace a small object. With a version (ETag), only if the object still has it,
+        None meaning it must not exist. Raises PreconditionFailed otherwise"""
+        condition = {}
+        if version is None:
+            condition['IfNoneMatch'] = "*"
+        elif version is not ANY_VERSION:
+            condition['IfMatch'] = version
+        try:
+            self.client.put_object(Bucket=self.bucket, Key=self._key(key), Body=data, **condition)
+        except Exception as e:
+            if condition and self._conflict(e):
+                raise PreconditionFailed(f"Object changed: {key}") from e
+            raise StorageError(f"S3 write failed for {key}: {e}") from e
+
+    def delete(self, key):
+        """Remove an object, if it exists"""
+        try:
+            self.client.delete_object(Bucket=self.bucket, Key=self._key(key))
+        except Exception as e:
+            raise StorageError(f"S3 delete failed for {key}: {e}") from e
+
+class SharedFiles(object):
+    """Local data directory backed by a shared storage.
+    Without a storage, everything stays local, as on a single node"""
+    INDEX_FILE = ".shared_cache.json"
+
+    def __init__(self, root, storage=None, max_cache_bytes=20 * 1024**3, min_age=600):
+        self.root = os.path.abspath(os.path.expanduser(root))
+        self.storage = storage
+        self.max_cache_bytes = max_cache_bytes
+        # Recently used files are kept even over the limit, a backend may be reading them
+        self.min_age = min_age
+        self.lock = threading.Lock()
+        self.json_lock = threading.Lock()
+        # Local files that also exist in the storage, so they can be evicted: key -> [size, last access]
+        self.cached = {}
+        self.fetched = 0
+        self.published = 0
+        self.evicted = 0
+        self.conflicts = 0
+        self._load_index()
+
+    def __str__(self):
+        return f"Shared files: {self.root}. Storage: {self.storage or 'none'}, " \
+            f"Cache: {self.cache_bytes() / 1024**2:.0f}MB / {self.max_cache_bytes / 1024**2:.0f}MB"
+
+    def key(self, path):
+        """Storage key of a data file. Paths from other nodes map by their part under `heygem_data`"""
+        path = os.path.abspath(os.path.expanduser(path))
+        if path.startswith(self.root + os.sep):
+            return os.path.relpath(path, self.root).replace(os.sep, "/")
+        parts = path.replace("\\", "/").split("/")
+        name = os.path.basename(self.root)
+        if name in parts:
+            return "/".join(parts[len(parts) - parts[::-1].index(name):])
+        raise StorageError(f"Not a shared data path: {path}")
+
+    def local_path(self, path):
+        """Path of a data file on this node"""
+        return os.path.join(self.root, *self.key(path).split("/"))
+
+    def cache_bytes(self):
+        """Size of evictable local files"""
+        with self.lock:
+            return sum(size for size, _ in self.cached.values())
+
+    def _load_index(self):
+        index_path = os.path.join(self.root, self.INDEX_FILE)
+        if self.storage and os.path.exists(index_path):
+            with open(index_path, "r", encoding="utf-8") as f:
+                self.cached = json.load(f)
+
+    def _save_index(self):
+        index_path = os.path.join(self.root, self.INDEX_FILE)
+        with open(index_path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(self.cached, f)
+        os.replace(index_path + ".tmp", index_path)
+
+    def _touch(self, key, path):
+        with self.lock:
+            self.cached[key] = [os.path.getsize(path), time.time()]
+            self._save_index()
+
+    def fetch(self, path):
+        """Make sure a data file is present locally. Returns its local path"""
+        local_path = self.local_path(path)
+        if self.storage is None:
+            return local_path
+        key = self.key(path)
+        if not os.path.exists(local_path):
+            os.makedirs(os.path.dirname(local_path), exist_ok=True)
+            tmp = f"{local_path}.{uuid.uuid4().hex}.tmp"
+            try:
+                self.storage.get_file(key, tmp)
+                os.replace(tmp, local_path)
+            finally:
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+            self.fetched += 1
+            print(f"Fetched from shared storage: {key}")
+        self._touch(key, local_path)
+        self.evict()
+        return local_path
+
+    def publish(self, path):
+        """Upload a local data file, so other nodes can fetch it"""
+        if self.storage is None:
+            return
+        key = self.key(path)
+        self.storage.put_file(key, path)
+        self.published += 1
+        self._touch(key, path)
+        self.evict()
+
+    def evict(self):
+        """Delete least recently used local copies until under the size limit"""
+        with self.lock:
+            total = sum(size for size, _ in self.cached.values())
+            if total <= self.max_cache_bytes:
+                return 0
+            now = time.time()
+            evicted = 0
+            for key, (size, accessed) in sorted(self.cached.items(), key=lambda item: item[1][1]):
+                if total <= self.max_cache_bytes or now - accessed < self.min_age:
+                    break
+                path = os.path.join(self.root, *key.split("/"))
+                if os.path.exists(path):
+                    os.remove(path)
+                del self.cached[key]
+                total -= size
+                evicted += 1
+            self.evicted += evicted
+            self._save_index()
+            return evicted
+
+    def read_json(self, key, local_path, default=None):
+        """Small shared json document. Without a storage it's read from local_path"""
+        if self.storage is None:
+            if not os.path.exists(local_path):
+                return copy.deepcopy(default)
+            with open(local_path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        data = self.storage.read_bytes(key)
+        return json.loads(data.decode("utf-8")) if data is not None else copy.deepcopy(default)
+
+    def update_json(self, key, local_path, update, default=None):
+        """Read, change and write back a small shared json document, without losing
+        concurrent updates. update(data) changes data in place, or returns False to skip the write.
+        The write only succeeds if nobody wrote since the read, otherwise it's retried.
+        Returns the document as written"""
+        if self.storage is None:
+            # A single node, its threads take turns
+            with self.json_lock:
+                data = self.read_json(key, local_path, default)
+                if update(data) is not False:
+                    tmp = f"{local_path}.{uuid.uuid4().hex}.tmp"
+                    with open(tmp, "w", encoding="utf-8") as f:
+                        json.dump(data, f, ensure_ascii=False, indent=2)
+                    os.replace(tmp, local_path)
+                return data
+        for attempt in range(UPDATE_RETRIES):
+            content, version = self.storage.read_versioned(key)
+            data = json.loads(content.decode("utf-8")) if content is not None else copy.deepcopy(default)
+            if update(data) is False:
+                return data
+            try:
+                self.storage.write_bytes(key, json.dumps(data, ensure_ascii=False, indent=2).encode("utf-8"),
+                    version=version)
+                return data
+            except PreconditionFailed:
+                self.conflicts += 1
+                time.sleep(random.uniform(0, 0.05 * (attempt + 1)))
+        raise StorageError(f"Too many concurrent updates of {key}")
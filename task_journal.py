@@ -0,0 +1,154 @@
+"""Append-only journal of submitted synthesis tasks.
+
+Each line is a json record with the fields of a task that changed. Replaying the
+file gives the latest state of every task, so after a restart unfinished tasks
+are polled again, and a resubmitted job reattaches to its task instead of
+rendering twice. Records are flushed to disk before a call returns"""
+import os
+import json
+import time
+import hashlib
+import threading
+from job_queue import QUEUED, SUBMITTED, DONE, FAILED
+
+HASH_BUFFER_SIZE = 1024 * 1024
+
+def hash_file(path):
+    """sha256 of a file's content"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(HASH_BUFFER_SIZE), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def hash_text(text):
+    """sha256 of a text"""
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+class TaskJournal(object):
+    """Latest state of synthesis tasks, backed by an append-only json lines file"""
+    def __init__(self, journal_file, compact_ratio=4):
+        self.journal_file = journal_file
+        # Rewrite the file at startup once it has this many records per task
+        self.compact_ratio = compact_ratio
+        self.tasks = {}
+        self.records = 0
+        self.lock = threading.Lock()
+        self.replay()
+        if self.tasks and self.records > self.compact_ratio * len(self.tasks):
+            self.compact()
+
+    def __str__(self):
+        return f"Task journal: {self.journal_file}. Tasks: {len(self.tasks)}, Pending: {len(self.pending())}"
+
+    def replay(self):
+        """Rebuild task states from the file"""
+        if not os.path.exists(self.journal_file):
+            return
+        tasks = {}
+        records = 0
+        with open(self.journal_file, "rb") as f:
+            data = f.read()
+        if data and not data.endswith(b"\n"):
+            # Last record cut short by a crash. Dropped, so the next one starts on its own line
+            cut = data.rfind(b"\n") + 1
+            print(f"Dropping partial journal record: {data[cut:].decode('utf-8', errors='replace')}")
+            os.truncate(self.journal_file, cut)
+            data = data[:cut]
+        for line in data.decode("utf-8").splitlines():
+            try:
+                record = json.loads(line)
+            except ValueError:
+                print(f"Skipping damaged journal record: {line}")
+                continue
+            tasks.setdefault(record['task_id'], {}).update(record)
+            records += 1
+        with self.lock:
+            self.tasks = tasks
+            self.records = records
+
+    def _append(self, record):
+        """Write one record and flush it to disk"""
+        with open(self.journal_file, "a", encoding="utf-8") as f:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        self.records += 1
+
+    def _add(self, task_id, fields):
+        """Track a new task. Called with the lock held"""
+        record = dict(fields, task_id=task_id, status=fields.get('status', QUEUED),
+            created=time.time(), updated=time.time())
+        self.tasks[task_id] = dict(record)
+        self._append(record)
+        return record
+
+    def add(self, task_id, **fields):
+        """Start tracking a task"""
+        with self.lock:
+            return self._add(task_id, fields)
+
+    def update(self, task_id, **fields):
+        """Record changed fields of a tracked task. Returns False if nothing changed"""
+        with self.lock:
+            task = self.tasks.get(task_id)
+            if task is None:
+                return False
+            changed = {name: value for name, value in fields.items() if task.get(name) != value}
+            if not changed:
+                return False
+            record = dict(changed, task_id=task_id, updated=time.time())
+            task.update(record)
+            self._append(record)
+        return True
+
+    def get(self, task_id):
+        """State of a task, or None"""
+        with self.lock:
+            task = self.tasks.get(task_id)
+            return dict(task) if task else None
+
+    def _find(self, model_id, input_hash):
+        """Newest usable task of a model and input. Called with the lock held"""
+        tasks = [task for task in self.tasks.values()
+            if task.get('model_id') == model_id and task.get('input_hash') == input_hash]
+        for task in sorted(tasks, key=lambda task: task['created'], reverse=True):
+            if task['status'] == FAILED:
+                continue
+            if task.get('result_path') and not os.path.exists(task['result_path']):
+                continue
+            return dict(task)
+        return None
+
+    def find(self, model_id, input_hash):
+        """Newest task of the same model and input that didn't fail, or None.
+        Downloaded results count only while the file exists"""
+        with self.lock:
+            return self._find(model_id, input_hash)
+
+    def find_or_add(self, task_id, model_id, input_hash, **fields):
+        """Task of the same model and input like find, otherwise start tracking task_id.
+        Returns (task, added). Concurrent submissions of one job get a single task"""
+        with self.lock:
+            task = self._find(model_id, input_hash)
+            if task:
+                return task, False
+            return self._add(task_id, dict(fields, model_id=model_id, input_hash=input_hash)), True
+
+    def pending(self):
+        """Tasks not finished yet, or whose result hasn't been downloaded"""
+        with self.lock:
+            return [dict(task) for task in self.tasks.values() if task['status'] in (QUEUED, SUBMITTED)
+                or (task['status'] == DONE and not task.get('result_path'))]
+
+    def compact(self):
+        """Rewrite the file with one record per task. Replaced atomically"""
+        with self.lock:
+            tmp_file = self.journal_file + ".tmp"
+            with open(tmp_file, "w", encoding="utf-8") as f:
+                for task in self.tasks.values():
+                    f.write(json.dumps(task, ensure_ascii=False) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_file, self.journal_file)
+            self.records = len(self.tasks)
@@ -0,0 +1,8 @@
+"""Modules are imported by bare name, as app.py and watchdog_app.py run them"""
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for path in (ROOT, os.path.join(ROOT, "watchdog")):
+    if path not in sys.path:
+        sys.path.insert(0, path)
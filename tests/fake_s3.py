@@ -0,0 +1,60 @@
+"""In-memory stand-in for a boto3 S3 client, with the conditional writes of S3 and MinIO"""
+import io
+import shutil
+import hashlib
+import threading
+
+class ClientError(Exception):
+    """Error shaped like botocore's ClientError"""
+    def __init__(self, code, operation):
+        super().__init__(f"An error occurred ({code}) when calling the {operation} operation")
+        self.response = {'Error': {'Code': code}}
+
+class FakeS3Client(object):
+    """The S3 client calls S3Storage makes. Objects of all buckets share one dict"""
+    def __init__(self):
+        self.objects = {}
+        self.lock = threading.Lock()
+        self.puts = 0
+
+    def _get(self, bucket, key, operation):
+        with self.lock:
+            if (bucket, key) not in self.objects:
+                raise ClientError("NoSuchKey" if operation == "GetObject" else "404", operation)
+            return self.objects[(bucket, key)]
+
+    def _put(self, bucket, key, data, if_match=None, if_none_match=None):
+        etag = f'"{hashlib.md5(data).hexdigest()}"'
+        with self.lock:
+            current = self.objects.get((bucket, key))
+            if if_none_match == "*" and current is not None:
+                raise ClientError("PreconditionFailed", "PutObject")
+            if if_match is not None and (current is None or current[1] != if_match):
+                raise ClientError("PreconditionFailed", "PutObject")
+            self.objects[(bucket, key)] = (data, etag)
+            self.puts += 1
+        return etag
+
+    def head_object(self, Bucket, Key):
+        data, etag = self._get(Bucket, Key, "HeadObject")
+        return {'ContentLength': len(data), 'ETag': etag}
+
+    def get_object(self, Bucket, Key):
+        data, etag = self._get(Bucket, Key, "GetObject")
+        return {'Body': io.BytesIO(data), 'ETag': etag}
+
+    def put_object(self, Bucket, Key, Body, IfMatch=None, IfNoneMatch=None):
+        return {'ETag': self._put(Bucket, Key, bytes(Body), IfMatch, IfNoneMatch)}
+
+    def delete_object(self, Bucket, Key):
+        with self.lock:
+            self.objects.pop((Bucket, Key), None)
+
+    def upload_file(self, Filename, Bucket, Key, Config=None):
+        with open(Filename, "rb") as f:
+            self._put(Bucket, Key, f.read())
+
+    def download_file(self, Bucket, Key, Filename, Config=None):
+        data, _ = self._get(Bucket, Key, "HeadObject")
+        with open(Filename, "wb") as f:
+            shutil.copyfileobj(io.BytesIO(data), f)
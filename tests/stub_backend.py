@@ -0,0 +1,35 @@
+"""Stand-in for the gen-video API, for testing the job queue without a GPU"""
+import time
+import threading
+from job_queue import BACKEND_QUEUED, BACKEND_RUNNING, BACKEND_DONE
+
+class StubBackend(object):
+    """Jobs run for `duration` seconds, at most `capacity` at a time"""
+    def __init__(self, duration=5.0, capacity=1):
+        self.duration = duration
+        self.capacity = capacity
+        self.tasks = {}
+        self.lock = threading.Lock()
+
+    def submit(self, api_data):
+        """Accept a job, like /easy/submit"""
+        with self.lock:
+            self.tasks[api_data['code']] = time.time()
+        return True, "ok"
+
+    def query(self, task_id):
+        """Status of a job, like /easy/query. Jobs beyond capacity wait for a free worker"""
+        with self.lock:
+            if task_id not in self.tasks:
+                return None
+            workers = [0.0] * self.capacity
+            for code in sorted(self.tasks, key=self.tasks.get):
+                worker = workers.index(min(workers))
+                start = max(self.tasks[code], workers[worker])
+                workers[worker] = start + self.duration
+                if code == task_id:
+                    break
+        now = time.time()
+        if now < start:
+            return BACKEND_QUEUED
+        return BACKEND_DONE if now >= start + self.duration else BACKEND_RUNNING
@@ -0,0 +1,58 @@
+"""Requests passed from the async stream server to the WSGI app"""
+import socket
+import threading
+import pytest
+from flask import Flask, Response
+from async_server import AsyncStreamServer
+from sessions import SessionRegistry
+
+@pytest.fixture
+def server(tmp_path):
+    app = Flask(__name__)
+
+    @app.route("/ok")
+    def ok():
+        return "ok"
+
+    @app.route("/fail")
+    def fail():
+        # Raised while the body is iterated, past the error handling of Flask
+        def chunks():
+            raise ValueError("broken stream")
+            yield b""
+        return Response(chunks())
+
+    sessions = SessionRegistry(tmp_path / "copy", tmp_path / "sessions")
+    server = AsyncStreamServer(app, sessions, lambda camera, restart: None, 25.0,
+        host="127.0.0.1", port=0, wsgi_workers=2)
+    # Port 0 binds any free port, read back from the listening socket
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    assert server.started.wait(10)
+    server.port = server.server.sockets[0].getsockname()[1]
+    yield server
+    server.shutdown()
+    thread.join(5)
+
+def request(server, head:bytes):
+    with socket.create_connection(("127.0.0.1", server.port), timeout=10) as conn:
+        conn.sendall(head)
+        response = b""
+        while True:
+            data = conn.recv(65536)
+            if not data:
+                return response
+            response += data
+
+def test_app_response(server):
+    response = request(server, b"GET /ok HTTP/1.1\r\nHost: test\r\n\r\n")
+    assert response.startswith(b"HTTP/1.1 200")
+    assert response.endswith(b"ok")
+
+def test_app_error_is_500(server):
+    response = request(server, b"GET /fail HTTP/1.1\r\nHost: test\r\n\r\n")
+    assert response.startswith(b"HTTP/1.1 500")
+
+def test_bad_content_length_is_400(server):
+    response = request(server, b"POST /ok HTTP/1.1\r\nContent-Length: -1\r\n\r\n")
+    assert response.startswith(b"HTTP/1.1 400")
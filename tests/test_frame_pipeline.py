@@ -0,0 +1,93 @@
+"""Frame pipeline rings shared by cameras on one worker, and segments the worker gave up on"""
+import time
+import cv2
+import numpy as np
+import pytest
+import metrics
+from camera import VideoCamera, CameraStatus
+from frame_pipeline import FramePipeline, SegmentJob, PipelineCapture, \
+    RING_STALL_TIMEOUT, READ_TIMEOUT, WORKER_TIMEOUT
+
+FRAMES = 10
+# Noise doesn't compress, two frames of 320x240 fill the ring
+RING_SIZE = 200 * 1024
+
+@pytest.fixture(scope="module")
+def segments(tmp_path_factory):
+    root = tmp_path_factory.mktemp("segments")
+    paths = []
+    for index in range(5):
+        path = str(root / f"{index}.avi")
+        writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'MJPG'), 25, (320, 240))
+        for _ in range(FRAMES):
+            writer.write(np.random.randint(0, 255, (240, 320, 3), dtype=np.uint8))
+        writer.release()
+        paths.append(path)
+    return paths
+
+@pytest.fixture
+def pipeline():
+    pipeline = FramePipeline(1, ring_size=RING_SIZE).start()
+    yield pipeline
+    pipeline.stop()
+
+def playing_camera(name, pipeline, segments):
+    camera = VideoCamera(name)
+    camera.log_progress = False
+    camera.pipeline = pipeline
+    camera.status = CameraStatus.PLAYING
+    camera.load_videos(segments, time.time())
+    return camera
+
+def play(camera):
+    """(segment, frame) of every frame played until the queue is empty"""
+    played = []
+    while True:
+        success, jpeg, _, video = camera.get_frame()
+        if success:
+            assert isinstance(jpeg, bytes)
+            played.append((video['path'], video['current_frame']))
+        elif not camera.video and not camera.video_queue:
+            return played
+
+def play_first(camera):
+    """Play the first frame. Reads don't wait for the worker, late frames are repeats"""
+    while not camera.get_frame()[0]:
+        time.sleep(0.001)
+
+def expected(segments):
+    return [(path, frame) for path in segments for frame in range(1, FRAMES + 1)]
+
+def test_unread_camera_doesnt_block_worker(pipeline, segments):
+    unread = playing_camera("unread", pipeline, segments)
+    play_first(unread)
+    camera = playing_camera("read", pipeline, segments)
+    start = time.time()
+    assert play(camera) == expected(segments)
+    # The worker gives up the unread ring once, not once per prefetched segment
+    assert time.time() - start < RING_STALL_TIMEOUT * 4
+    for camera in (unread, camera):
+        camera.clear_videos()
+        camera.release_frame_ring()
+
+def test_stalled_segment_is_played_again(pipeline, segments):
+    camera = playing_camera("stalled", pipeline, segments)
+    play_first(camera)
+    # Nothing reads it, the worker gives up the segments that don't fit
+    time.sleep(RING_STALL_TIMEOUT * 3)
+    played = play(camera)
+    assert [(segments[0], 1)] + played == expected(segments)
+    assert metrics.PIPELINE_STALLS.labels("stalled").value >= 1
+    camera.clear_videos()
+    camera.release_frame_ring()
+
+def test_late_frame_doesnt_wait_for_worker():
+    # A job the worker hasn't reported on, read under the camera lock
+    capture = PipelineCapture(SegmentJob(0, None, "0.avi"))
+    start = time.time()
+    assert capture.read() == (False, None)
+    assert time.time() - start < READ_TIMEOUT * 10
+    assert capture.late() and not capture.incomplete()
+    # The worker died, the rest of the segment is submitted again
+    capture.job.last_report -= WORKER_TIMEOUT + 1
+    assert capture.incomplete() and not capture.late()
@@ -0,0 +1,126 @@
+"""Job queue ordering, admission, persistence and lost jobs"""
+import time
+import pytest
+from job_queue import JobQueue, Job, QUEUED, SUBMITTED, DONE, FAILED, \
+    PRIORITY_INTERACTIVE, PRIORITY_BATCH
+from stub_backend import StubBackend
+
+def make_job(task_id, user="", priority=PRIORITY_INTERACTIVE):
+    return Job(task_id, {'code': task_id}, user, priority)
+
+@pytest.fixture
+def queue_file(tmp_path):
+    return str(tmp_path / "queue.json")
+
+@pytest.fixture
+def backend():
+    return StubBackend(duration=0.2, capacity=1)
+
+def make_queue(backend, queue_file, **kwargs):
+    return JobQueue(backend.submit, backend.query, queue_file, **kwargs)
+
+def order(queue):
+    return [job.task_id for job in queue.ordered()]
+
+def test_interactive_before_batch(backend, queue_file):
+    queue = make_queue(backend, queue_file)
+    queue.enqueue(make_job("batch1", "a", PRIORITY_BATCH))
+    queue.enqueue(make_job("batch2", "b", PRIORITY_BATCH))
+    queue.enqueue(make_job("live1", "c", PRIORITY_INTERACTIVE))
+    assert order(queue) == ["live1", "batch1", "batch2"]
+    assert queue.position("live1") == 0
+
+def test_unknown_priority():
+    with pytest.raises(ValueError):
+        make_job("x", priority="urgent")
+
+def test_users_take_turns(backend, queue_file):
+    queue = make_queue(backend, queue_file)
+    for task_id in ("a1", "a2", "a3"):
+        queue.enqueue(make_job(task_id, "alice"))
+    queue.enqueue(make_job("b1", "bob"))
+    assert order(queue) == ["a1", "b1", "a2", "a3"]
+
+def test_user_with_outstanding_job_waits(backend, queue_file):
+    queue = make_queue(backend, queue_file, max_outstanding=1)
+    queue.enqueue(make_job("a1", "alice"))
+    queue.enqueue(make_job("a2", "alice"))
+    assert [job.task_id for job in queue.dispatch()] == ["a1"]
+    queue.enqueue(make_job("b1", "bob"))
+    assert order(queue) == ["b1", "a2"]
+
+def test_outstanding_jobs_are_capped(backend, queue_file):
+    queue = make_queue(backend, queue_file, max_outstanding=2)
+    for index in range(4):
+        queue.enqueue(make_job(f"t{index}", f"user{index}"))
+    assert len(queue.dispatch()) == 2
+    assert queue.dispatch() == []
+    assert len(queue.outstanding()) == 2
+    assert len(queue.queued()) == 2
+
+def test_finished_jobs_free_slots(backend, queue_file):
+    queue = make_queue(backend, queue_file, max_outstanding=1)
+    queue.enqueue(make_job("t1"))
+    queue.enqueue(make_job("t2"))
+    queue.dispatch()
+    assert not queue.poll()
+    time.sleep(backend.duration + 0.05)
+    assert queue.poll()
+    assert queue.get("t1").status == DONE
+    assert [job.task_id for job in queue.dispatch()] == ["t2"]
+    assert queue.average_duration() < 1.0
+
+def test_failed_submit(queue_file):
+    queue = JobQueue(lambda api_data: (False, "busy"), lambda task_id: None, queue_file)
+    queue.enqueue(make_job("t1"))
+    assert queue.dispatch() == []
+    job = queue.get("t1")
+    assert job.status == FAILED
+    assert job.error == "busy"
+
+def test_queue_survives_restart(backend, queue_file):
+    queue = make_queue(backend, queue_file, max_outstanding=1)
+    queue.enqueue(make_job("a1", "alice"))
+    queue.enqueue(make_job("b1", "bob", PRIORITY_BATCH))
+    queue.enqueue(make_job("a2", "alice"))
+    queue.dispatch()
+    expected = order(queue)
+
+    reloaded = make_queue(backend, queue_file, max_outstanding=1)
+    assert reloaded.get("a1").status == SUBMITTED
+    assert reloaded.get("a1").api_data == {'code': "a1"}
+    assert order(reloaded) == expected
+    assert reloaded.last_dispatch == queue.last_dispatch
+
+def test_lost_job_times_out(queue_file):
+    # The backend never heard of the job, e.g. the app stopped while submitting
+    queue = JobQueue(lambda api_data: (True, "ok"), lambda task_id: None, queue_file,
+        lost_timeout=60)
+    queue.enqueue(make_job("t1"))
+    queue.dispatch()
+    assert not queue.poll()
+    assert queue.get("t1").status == SUBMITTED
+
+    queue.get("t1").submitted -= 61
+    assert queue.poll()
+    job = queue.get("t1")
+    assert job.status == FAILED
+    assert job.error == "Unknown to the backend"
+    assert queue.outstanding() == []
+
+def test_status_callback(backend, queue_file):
+    statuses = []
+    queue = make_queue(backend, queue_file, on_status=lambda job: statuses.append((job.task_id, job.status)))
+    queue.enqueue(make_job("t1"))
+    queue.dispatch()
+    time.sleep(backend.duration + 0.05)
+    queue.poll()
+    assert statuses == [("t1", SUBMITTED), ("t1", DONE)]
+
+def test_eta_of_queued_job(backend, queue_file):
+    queue = make_queue(backend, queue_file, max_outstanding=1, default_duration=100)
+    queue.enqueue(make_job("t1"))
+    queue.enqueue(make_job("t2"))
+    assert queue.get("t2").status == QUEUED
+    # One wave ahead of it, then its own
+    assert queue.eta("t2") == 200
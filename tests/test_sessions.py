@@ -0,0 +1,34 @@
+"""Session keys of watched paths"""
+import pytest
+import metrics
+from sessions import SessionRegistry, DEFAULT_SESSION
+
+@pytest.fixture
+def registry(tmp_path):
+    return SessionRegistry(tmp_path / "copy", tmp_path / "sessions")
+
+def test_default_and_task_sessions(registry):
+    assert registry.split_path("output/avi/0.avi") == (DEFAULT_SESSION, "output/avi/0.avi")
+    assert registry.split_path("task1/output/temp.wav") == ("task1", "output/temp.wav")
+    assert registry.split_path("task1/result.mp4") == (None, "task1/result.mp4")
+
+def test_nested_tasks_dont_share_a_session(registry):
+    assert registry.split_path("a_b/output/temp.wav") == ("a_b", "output/temp.wav")
+    assert registry.split_path("a/b/output/temp.wav")[0] is None
+
+def test_task_named_like_default_is_ignored(registry):
+    assert registry.split_path(f"{DEFAULT_SESSION}/output/temp.wav")[0] is None
+
+def test_invalid_key_is_ignored(registry):
+    assert registry.split_path("../output/temp.wav")[0] is None
+
+def test_cleanup_removes_session_metrics(registry):
+    session = registry.get_or_create("task1")
+    metrics.FRAMES_PLAYED.labels("task1").inc()
+    metrics.VIEWERS.labels("task1", "mjpeg").inc()
+    metrics.AUDIO_TO_FIRST_SEGMENT.labels("task1").observe(0.5)
+    metrics.FRAMES_PLAYED.labels("task2").inc()
+    registry.cleanup(session.key)
+    text = metrics.REGISTRY.render()
+    assert 'session="task1"' not in text
+    assert 'session="task2"' in text
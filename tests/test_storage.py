@@ -0,0 +1,122 @@
+"""Shared storage backends, and shared json documents updated by several nodes at once.
+S3 runs against an in-memory stand-in, or a MinIO server when HEYGEM_TEST_S3_ENDPOINT is set"""
+import os
+import uuid
+import threading
+import pytest
+import storage as storage_module
+from storage import LocalStorage, S3Storage, SharedFiles, StorageError, PreconditionFailed
+from fake_s3 import FakeS3Client
+
+S3_ENDPOINT = os.environ.get("HEYGEM_TEST_S3_ENDPOINT")
+S3_BUCKET = os.environ.get("HEYGEM_TEST_S3_BUCKET", "heygem-test")
+
+def minio_storage():
+    if not S3_ENDPOINT:
+        pytest.skip("HEYGEM_TEST_S3_ENDPOINT not set")
+    if storage_module.boto3 is None:
+        pytest.skip("boto3 not installed")
+    client = storage_module.boto3.client("s3", endpoint_url=S3_ENDPOINT)
+    try:
+        client.head_bucket(Bucket=S3_BUCKET)
+    except Exception:
+        client.create_bucket(Bucket=S3_BUCKET)
+    return S3Storage(S3_BUCKET, prefix=f"test-{uuid.uuid4().hex}", endpoint_url=S3_ENDPOINT)
+
+@pytest.fixture(params=["local", "s3", "minio"])
+def storage(request, tmp_path):
+    if request.param == "local":
+        return LocalStorage(tmp_path / "shared")
+    if request.param == "s3":
+        return S3Storage("heygem", prefix="test", client=FakeS3Client())
+    return minio_storage()
+
+def test_file_round_trip(storage, tmp_path):
+    source = tmp_path / "source.bin"
+    source.write_bytes(os.urandom(4096))
+    assert not storage.exists("voice/a.bin")
+    storage.put_file("voice/a.bin", str(source))
+    assert storage.exists("voice/a.bin")
+    target = tmp_path / "target.bin"
+    storage.get_file("voice/a.bin", str(target))
+    assert target.read_bytes() == source.read_bytes()
+    storage.delete("voice/a.bin")
+    assert not storage.exists("voice/a.bin")
+
+def test_missing_object(storage, tmp_path):
+    assert storage.read_bytes("missing.json") is None
+    assert storage.read_versioned("missing.json") == (None, None)
+    with pytest.raises(StorageError):
+        storage.get_file("missing.json", str(tmp_path / "missing.json"))
+
+def test_conditional_write(storage):
+    storage.write_bytes("doc.json", b"1", version=None)
+    with pytest.raises(PreconditionFailed):
+        # Must not exist
+        storage.write_bytes("doc.json", b"2", version=None)
+    data, version = storage.read_versioned("doc.json")
+    assert data == b"1"
+    storage.write_bytes("doc.json", b"2", version=version)
+    with pytest.raises(PreconditionFailed):
+        # Written since it was read
+        storage.write_bytes("doc.json", b"3", version=version)
+    assert storage.read_bytes("doc.json") == b"2"
+    # Unconditional writes still replace it
+    storage.write_bytes("doc.json", b"4")
+    assert storage.read_bytes("doc.json") == b"4"
+
+def test_local_key_outside_storage(tmp_path):
+    with pytest.raises(StorageError):
+        LocalStorage(tmp_path / "shared").read_bytes("../outside.json")
+
+def increment(data):
+    data['count'] = data.get('count', 0) + 1
+
+def run_nodes(nodes, updates):
+    """Each node updates the same document from its own thread"""
+    def run(files):
+        for _ in range(updates):
+            files.update_json("counter.json", files.root + "/counter.json", increment, {})
+    threads = [threading.Thread(target=run, args=(files,)) for files in nodes]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+def test_concurrent_updates_are_not_lost(storage, tmp_path):
+    nodes = [SharedFiles(tmp_path / f"node{index}", storage) for index in range(4)]
+    run_nodes(nodes, 10)
+    assert nodes[0].read_json("counter.json", None)['count'] == 40
+
+def test_concurrent_updates_without_storage(tmp_path):
+    files = SharedFiles(tmp_path / "node")
+    os.makedirs(files.root, exist_ok=True)
+    run_nodes([files] * 4, 10)
+    assert files.read_json("counter.json", files.root + "/counter.json")['count'] == 40
+
+def test_skipped_update_is_not_written(tmp_path):
+    client = FakeS3Client()
+    files = SharedFiles(tmp_path / "node", S3Storage("heygem", client=client))
+    assert files.update_json("doc.json", None, lambda data: False, {'a': 1}) == {'a': 1}
+    assert client.puts == 0
+
+def test_default_is_not_shared(tmp_path):
+    files = SharedFiles(tmp_path / "node", S3Storage("heygem", client=FakeS3Client()))
+    default = {}
+    files.update_json("doc.json", None, increment, default)
+    assert default == {}
+
+def test_nodes_fetch_published_files(storage, tmp_path):
+    first = SharedFiles(tmp_path / "first" / "heygem_data", storage)
+    second = SharedFiles(tmp_path / "second" / "heygem_data", storage)
+    path = os.path.join(first.root, "voice", "data", "a.wav")
+    os.makedirs(os.path.dirname(path))
+    with open(path, "wb") as f:
+        f.write(b"RIFF")
+    first.publish(path)
+    # Paths of other nodes map by their part under heygem_data
+    local_path = second.fetch(path)
+    assert local_path == os.path.join(second.root, "voice", "data", "a.wav")
+    with open(local_path, "rb") as f:
+        assert f.read() == b"RIFF"
+    assert second.fetched == 1
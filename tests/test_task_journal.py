@@ -0,0 +1,60 @@
+"""Task journal replay, reattaching and pending tasks after a restart"""
+import threading
+import pytest
+from task_journal import TaskJournal
+from job_queue import QUEUED, SUBMITTED, DONE, FAILED
+
+@pytest.fixture
+def journal_file(tmp_path):
+    return str(tmp_path / "journal.jsonl")
+
+def test_torn_last_record_is_dropped(journal_file):
+    journal = TaskJournal(journal_file)
+    journal.add("a", model_id=1, input_hash="x")
+    journal.update("a", status=SUBMITTED)
+    # Crash while writing the next record
+    with open(journal_file, "a", encoding="utf-8") as f:
+        f.write('{"task_id": "a", "status": "do')
+    journal = TaskJournal(journal_file)
+    assert journal.get("a")['status'] == SUBMITTED
+    # The next record starts on its own line
+    journal.update("a", status=DONE)
+    assert TaskJournal(journal_file).get("a")['status'] == DONE
+
+def test_pending_and_reattach_after_restart(journal_file, tmp_path):
+    journal = TaskJournal(journal_file)
+    journal.add("queued", model_id=1, input_hash="q")
+    journal.add("submitted", model_id=1, input_hash="s")
+    journal.update("submitted", status=SUBMITTED)
+    journal.add("failed", model_id=1, input_hash="f")
+    journal.update("failed", status=FAILED)
+    journal.add("downloaded", model_id=1, input_hash="d")
+    result = tmp_path / "downloaded.mp4"
+    result.write_bytes(b"")
+    journal.update("downloaded", status=DONE, result_path=str(result))
+
+    journal = TaskJournal(journal_file)
+    assert sorted(task['task_id'] for task in journal.pending()) == ["queued", "submitted"]
+    task, added = journal.find_or_add("again", 1, "s")
+    assert not added and task['task_id'] == "submitted"
+    task, added = journal.find_or_add("retry", 1, "f")
+    assert added and task['status'] == QUEUED
+    # A removed result renders again
+    result.unlink()
+    assert journal.find(1, "d") is None
+
+def test_concurrent_submissions_make_one_task(journal_file):
+    journal = TaskJournal(journal_file)
+    start = threading.Barrier(8)
+    results = []
+    def submit(task_id):
+        start.wait()
+        results.append(journal.find_or_add(task_id, 1, "same"))
+    threads = [threading.Thread(target=submit, args=(f"t{i}",)) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sum(added for _, added in results) == 1
+    assert len({task['task_id'] for task, _ in results}) == 1
+    assert len(TaskJournal(journal_file).tasks) == 1
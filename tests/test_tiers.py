@@ -0,0 +1,83 @@
+"""Automatic tier switching of MJPEG viewers"""
+import time
+import numpy as np
+from tiers import TierLadder, TieredFrame, TierSelector, AUTO_TIER
+from camera import CameraStatus
+import watchdog_app
+
+STREAM_TIERS = [("full", 1.0, 95), ("medium", 0.75, 80), ("low", 0.5, 60)]
+
+class PlayingCamera(object):
+    """Camera that always has the next frame ready. Tier encodings are their names"""
+    def __init__(self, ladder:TierLadder):
+        self.name = "test"
+        self.status = CameraStatus.PLAYING
+        self.tiers = ladder
+        self.latest_frame = TieredFrame(np.zeros((8, 8, 3), dtype=np.uint8), ladder)
+        self.latest_frame.encoded = [tier.name.encode() for tier in ladder]
+        self.frames = 0
+        self.video = {'path': "0.avi", 'index': 0, 'current_frame': 0}
+
+    def get_frame_rate(self):
+        return 25.0
+
+    def playback_rate(self):
+        return 1.0
+
+    def get_tiered_frame(self):
+        self.frames += 1
+        return True, self.latest_frame, self.frames, self.video
+
+def tier_of(chunk:bytes):
+    return chunk.split(b'\r\n\r\n')[1].decode()
+
+def watch(consumer_time:float, frames:int):
+    """Tiers a viewer taking consumer_time per frame gets from gen"""
+    camera = PlayingCamera(TierLadder.from_config(STREAM_TIERS))
+    stream = watchdog_app.gen(camera, 25, AUTO_TIER)
+    tiers = []
+    try:
+        for _ in range(frames):
+            tiers.append(tier_of(next(stream)))
+            time.sleep(consumer_time)
+    finally:
+        stream.close()
+    return tiers
+
+def test_slow_viewer_steps_down():
+    # 200ms per frame of a 25fps stream, 5 frames behind on every frame
+    tiers = watch(0.2, 4)
+    assert tiers[0] == "full"
+    assert tiers[-1] == "low"
+
+def test_viewer_on_time_stays_on_top():
+    assert set(watch(0.0, 10)) == {"full"}
+
+class RacedCamera(PlayingCamera):
+    """Another viewer advances the camera right after this viewer's frame"""
+    def get_tiered_frame(self):
+        result = super().get_tiered_frame()
+        self.latest_frame = TieredFrame(None, self.tiers, b"next")
+        return result
+
+def test_viewer_sends_the_frame_it_advanced():
+    camera = RacedCamera(TierLadder.from_config(STREAM_TIERS))
+    stream = watchdog_app.gen(camera, 25, AUTO_TIER)
+    try:
+        assert tier_of(next(stream)) == "full"
+    finally:
+        stream.close()
+
+def test_selector_steps_down_and_recovers():
+    selector = TierSelector(TierLadder.from_config(STREAM_TIERS), AUTO_TIER, max_behind=2.0, recover_frames=3)
+    assert selector.update(5.0) == 1
+    assert selector.update(5.0) == 2
+    # Already at the lowest tier
+    assert selector.update(5.0) == 2
+    assert [selector.update(0.0) for _ in range(3)] == [2, 2, 1]
+    assert selector.switches == 3
+
+def test_fixed_tier_never_switches():
+    selector = TierSelector(TierLadder.from_config(STREAM_TIERS), "medium")
+    assert selector.update(10.0) == 1
+    assert selector.switches == 0
@@ -0,0 +1,58 @@
+"""Viewers joining the stream of a session"""
+import time
+import pytest
+from camera import CameraStatus
+import watchdog_app
+
+@pytest.fixture
+def session():
+    session = watchdog_app.SESSIONS.get_or_create("viewer-test")
+    yield session
+    with watchdog_app.SESSIONS.lock:
+        watchdog_app.SESSIONS.sessions.pop(session.key, None)
+    session.camera.clear_videos()
+
+def render_started(camera):
+    """Camera of a render whose first segments are queued, like handle_captured_files leaves it"""
+    camera.log_progress = False
+    camera.set_status(CameraStatus.BUFFERING)
+    camera.video_start = time.time()
+    camera.load_videos(["0.avi", "1.avi"], time.time())
+
+def open_feed(session, query=""):
+    """Response of `/video_feed`. Its stream only yields once the camera plays, so it isn't read"""
+    with watchdog_app.app.test_request_context(f"/video_feed/{session.key}{query}"):
+        return watchdog_app.video_feed(session.key)
+
+def test_viewer_joins_running_render(session):
+    camera = session.camera
+    render_started(camera)
+    response = open_feed(session)
+    try:
+        assert response.status_code == 200
+        assert camera.status == CameraStatus.BUFFERING
+        assert len(camera.video_queue) == 2
+    finally:
+        response.close()
+
+def test_viewer_restarts_stream(session):
+    camera = session.camera
+    render_started(camera)
+    response = open_feed(session, "?restart=1")
+    try:
+        assert camera.status == CameraStatus.IDLE
+        assert camera.video_queue == []
+    finally:
+        response.close()
+
+def test_unknown_session():
+    response = watchdog_app.app.test_client().get("/video_feed/missing-session")
+    assert response.status_code == 404
+
+def test_viewers_dont_advance_playback_rate(session):
+    camera = session.camera
+    camera.jitter.fps = 25.0
+    camera.jitter.rate = 0.9
+    # Every viewer reads the rate of each frame
+    rates = [camera.playback_rate() for _ in range(10)]
+    assert rates == [0.9] * 10
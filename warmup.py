@@ -0,0 +1,213 @@
+"""Speaker warm-up for recently and frequently used digital humans.
+
+The first `/v1/invoke` for a speaker after a TTS backend restart is much slower than
+later ones. A background worker sends short synthesis requests for the top models,
+at startup and on a schedule, and latency stats show the effect on real requests"""
+import time
+import threading
+import statistics
+
+def summarize(values):
+    """Count, mean, p50, p95 of latencies in seconds"""
+    if not values:
+        return {'count': 0}
+    values = sorted(values)
+    return {
+        'count': len(values),
+        'mean': statistics.fmean(values),
+        'p50': values[len(values) // 2],
+        'p95': values[min(int(0.95 * len(values)), len(values) - 1)]
+    }
+
+class LatencyStats(object):
+    """Latency of synthesis requests, by whether the speaker was warm"""
+    def __init__(self, max_samples=500):
+        self.max_samples = max_samples
+        self.samples = {'cold': [], 'warm': [], 'warmup': []}
+        self.lock = threading.Lock()
+
+    def record(self, kind, latency):
+        """Add a latency sample. Kind: cold, warm or warmup"""
+        with self.lock:
+            samples = self.samples[kind]
+            samples.append(latency)
+            if len(samples) > self.max_samples:
+                del samples[0]
+
+    def report(self):
+        """Summary per kind"""
+        with self.lock:
+            return {kind: summarize(samples) for kind, samples in self.samples.items()}
+
+class SpeakerWarmup(object):
+    """Keeps the speakers most likely to be used warm on the TTS backend.
+    Cost is bounded by the number of models, a short text, a few tokens,
+    and skipping speakers that real requests keep warm already.
+    Warmth is taken from the backend responses, not only from when requests were sent:
+    a response slower than cold_latency means the speaker wasn't loaded, and if it was
+    thought to be warm, the backend has restarted and no other speaker is trusted either"""
+    def __init__(self, invoke, load_models, top_n=3, interval=1800, warm_ttl=1800,
+                 text="Hello.", max_new_tokens=32, timeout=60, cold_latency=10.0, probe_tokens=4):
+        # invoke(model, text, max_new_tokens, timeout) sends a synthesis request, raises on failure
+        self.invoke = invoke
+        # load_models() returns the model registry entries
+        self.load_models = load_models
+        self.top_n = top_n
+        self.interval = interval
+        # Seconds a speaker stays warm after a request
+        self.warm_ttl = warm_ttl
+        self.text = text
+        self.max_new_tokens = max_new_tokens
+        self.timeout = timeout
+        # Seconds above which a response shows the speaker had to be loaded
+        self.cold_latency = cold_latency
+        # Tokens of the probe that confirms a speaker is still warm before its warm-up is skipped
+        self.probe_tokens = probe_tokens
+        self.stats = LatencyStats()
+        # Last response time per speaker id, from real requests and warm-ups
+        self.last_request = {}
+        # Last time the backend showed it lost its loaded speakers. Older responses don't count
+        self.backend_reset = 0
+        self.in_flight = 0
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.cycles = 0
+        self.warmed = 0
+        self.failed = 0
+        self.probed = 0
+        self.resets = 0
+
+    def __str__(self):
+        return f"Speaker warm-up. Top: {self.top_n}, Interval: {self.interval}s, " \
+            f"Cycles: {self.cycles}, Warmed: {self.warmed}, Failed: {self.failed}, " \
+            f"Probed: {self.probed}, Resets: {self.resets}"
+
+    def is_warm(self, model_id, now=None):
+        """The speaker had a response within warm_ttl, since the backend last lost its speakers"""
+        now = time.time() if now is None else now
+        with self.lock:
+            last = self.last_request.get(model_id, 0)
+            return last > self.backend_reset and now - last < self.warm_ttl
+
+    def record_response(self, model_id, start, warm, success=True):
+        """Update warmth from a backend response to a request sent at start.
+        warm tells whether the speaker was thought to be warm when it was sent"""
+        now = time.time()
+        with self.lock:
+            if not success:
+                # Backend down or restarting, its speakers may be gone
+                self.backend_reset = now
+                return
+            if warm and now - start > self.cold_latency and start > self.backend_reset:
+                # A warm speaker answered like a cold one, the backend was restarted
+                self.backend_reset = start
+                self.resets += 1
+                print(f"Speaker warm-up: slow response of a warm speaker, {now - start:.2f}s. " \
+                    "Backend speakers are considered cold")
+            self.last_request[model_id] = now
+
+    def begin_request(self, model_id):
+        """Called before a real synthesis request. Returns a token for end_request"""
+        start = time.time()
+        warm = self.is_warm(model_id, start)
+        with self.lock:
+            self.in_flight += 1
+        return model_id, start, warm
+
+    def end_request(self, token, success=True):
+        """Called after a real synthesis request"""
+        model_id, start, warm = token
+        with self.lock:
+            self.in_flight -= 1
+        self.record_response(model_id, start, warm, success)
+        if success:
+            self.stats.record('warm' if warm else 'cold', time.time() - start)
+
+    def select(self, models):
+        """Models to warm: most recently used, then most used. Never used ones are skipped"""
+        used = [model for model in models if model.get('use_count', 0) > 0]
+        used.sort(key=lambda model: (model.get('last_used', 0), model.get('use_count', 0)), reverse=True)
+        return used[:self.top_n]
+
+    def warm(self, model):
+        """Send one warm-up request. Returns the latency, or None if it failed"""
+        start = time.time()
+        try:
+            self.invoke(model, self.text, self.max_new_tokens, self.timeout)
+        except Exception as e:
+            self.failed += 1
+            self.record_response(model['id'], start, False, success=False)
+            print(f"Warm-up failed for {model.get('name')}: {e}")
+            return None
+        latency = time.time() - start
+        self.record_response(model['id'], start, False)
+        self.stats.record('warmup', latency)
+        self.warmed += 1
+        print(f"Warm-up of {model.get('name')}: {latency:.2f}s")
+        return latency
+
+    def probe(self, model):
+        """Send a minimal request to a speaker thought to be warm. True if it's loaded now.
+        A slow answer loaded it, and marks the other speakers cold"""
+        start = time.time()
+        try:
+            self.invoke(model, self.text, self.probe_tokens, self.timeout)
+        except Exception as e:
+            self.record_response(model['id'], start, True, success=False)
+            print(f"Warm-up probe failed for {model.get('name')}: {e}")
+            return False
+        self.probed += 1
+        self.record_response(model['id'], start, True)
+        return True
+
+    def run_cycle(self):
+        """Warm the selected models that aren't warm. Returns the number warmed"""
+        self.cycles += 1
+        models = self.load_models()
+        warmed = 0
+        for model in self.select(models):
+            if self.stop_event.is_set():
+                break
+            if self.in_flight > 0:
+                # Real requests first, the next cycle catches up
+                break
+            if self.is_warm(model['id']) and self.probe(model):
+                # Confirmed by the backend, instead of trusting the last request time
+                continue
+            if self.warm(model) is not None:
+                warmed += 1
+        return warmed
+
+    def start(self):
+        """Warm up now, then every interval, on a background thread"""
+        if self.thread and self.thread.is_alive():
+            return self
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self._run, name="speaker-warmup", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """Stop the schedule"""
+        self.stop_event.set()
+
+    def _run(self):
+        """Worker: run cycles until stopped"""
+        while not self.stop_event.is_set():
+            try:
+                self.run_cycle()
+            except Exception as e:
+                print(f"Warm-up cycle error: {e}")
+            self.stop_event.wait(self.interval)
+
+    def report(self):
+        """Warm-up counters and latency stats"""
+        return {
+            'cycles': self.cycles,
+            'warmed': self.warmed,
+            'failed': self.failed,
+            'probed': self.probed,
+            'resets': self.resets,
+            'latency': self.stats.report()
+        }
@@ -0,0 +1,383 @@
+"""Module to serve the live streams from an asyncio event loop.
+
+One frame publisher per session camera paces frames on the event loop and shares
+each encoded frame with all its MJPEG viewers, instead of one thread and one
+`time.sleep` loop per connection. Viewers get the frame in their encode tier,
+encoded once for all viewers of the tier. Other routes are passed to the Flask app"""
+import io
+import re
+import sys
+import asyncio
+import traceback
+import contextlib
+import threading
+from urllib.parse import unquote, parse_qs
+from concurrent.futures import ThreadPoolExecutor
+from camera import VideoCamera, CameraStatus
+from sessions import SessionRegistry, DEFAULT_SESSION
+from tiers import TieredFrame, TierSelector, AUTO_TIER
+import metrics
+
+# Live routes served natively, everything else goes to the WSGI app
+STREAM_ROUTE = re.compile(r"^/(video_feed|wav)(?:/([^/]+))?/?$")
+MAX_HEADER_SIZE = 65536
+# Seconds a client has to send the request head, and then its body
+REQUEST_TIMEOUT = 10.0
+WAV_CHUNK_SIZE = 16384
+# Seconds between status checks of streams waiting for playback
+IDLE_POLL = 0.02
+
+BAD_REQUEST = b"HTTP/1.1 400 Bad Request\r\nContent-Length: 0\r\nConnection: close\r\n\r\n"
+INTERNAL_ERROR = b"HTTP/1.1 500 Internal Server Error\r\nContent-Length: 0\r\nConnection: close\r\n\r\n"
+MJPEG_PART_HEAD = b'--frame\r\nContent-Type: image/jpeg\r\n\r\n'
+MJPEG_PART_TAIL = b'\r\n\r\n'
+
+def mjpeg_part(frame:bytes):
+    """Multipart chunk for one jpeg frame, as buffers written with `writelines`.
+    The jpeg isn't copied, every viewer writes the same bytes"""
+    return (MJPEG_PART_HEAD, frame, MJPEG_PART_TAIL)
+
+class PublishedFrame(object):
+    """Multipart chunks of one frame, per tier. The top tier is ready, others are made on request"""
+    def __init__(self, tiered:TieredFrame, top_part:tuple):
+        self.tiered = tiered
+        self.parts = [top_part] + [None] * (len(tiered.ladder) - 1)
+
+    def part(self, index:int):
+        """Multipart chunk of a tier. Encodes it if needed, so it may block"""
+        if self.parts[index] is None:
+            self.parts[index] = mjpeg_part(self.tiered.get(index))
+        return self.parts[index]
+
+class FramePublisher(object):
+    """Paces frames of one camera on the event loop, for all of its viewers.
+    Slow viewers skip to the latest frame instead of holding back the others"""
+    def __init__(self, camera:VideoCamera, frame_rate:float, executor:ThreadPoolExecutor):
+        self.camera = camera
+        self.frame_rate = frame_rate
+        self.executor = executor
+        self.frame = None
+        self.sequence = 0
+        self.viewers = 0
+        self.task = None
+        self.condition = asyncio.Condition()
+
+    def __str__(self):
+        return f"Frame publisher: {self.camera.name}. Viewers: {self.viewers}, Frames: {self.sequence}"
+
+    def add_viewer(self):
+        """Count a viewer in. Returns True for the first one, which starts publishing"""
+        self.viewers += 1
+        if self.task is None or self.task.done():
+            self.task = asyncio.get_running_loop().create_task(self._run())
+        return self.viewers == 1
+
+    def remove_viewer(self):
+        """Count a viewer out"""
+        self.viewers -= 1
+        if self.viewers == 0 and self.task:
+            # Frames only advance while someone is watching, as with one thread per viewer
+            self.task.cancel()
+            self.task = None
+
+    async def next_frame(self, sequence:int):
+        """Returns (sequence, PublishedFrame) of the first frame after sequence"""
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.sequence != sequence)
+            if self.sequence > sequence + 1:
+                metrics.FRAMES_DROPPED.labels("viewer").inc(self.sequence - sequence - 1)
+            return self.sequence, self.frame
+
+    async def _run(self):
+        """Publish frames at the camera frame rate, adjusted by the jitter buffer"""
+        loop = asyncio.get_running_loop()
+        camera = self.camera
+        deadline = loop.time()
+        while True:
+            sleep_time = 1.0 / (camera.get_frame_rate() or self.frame_rate)
+            if camera.status != CameraStatus.PLAYING:
+                await asyncio.sleep(IDLE_POLL)
+                deadline = loop.time()
+                continue
+            # Decoding and encoding release the GIL, so they don't hold the loop
+            success, tiered, _, _ = await loop.run_in_executor(self.executor, camera.get_tiered_frame)
+            if success:
+                sleep_time = sleep_time / camera.playback_rate()
+                metrics.FRAMES_PLAYED.labels(camera.name).inc()
+            else:
+                # Underrun or end of stream. Repeat last frame
+                metrics.FRAMES_DUPLICATED.labels(camera.name).inc()
+            async with self.condition:
+                self.frame = PublishedFrame(tiered, mjpeg_part(tiered.get(0)))
+                self.sequence += 1
+                self.condition.notify_all()
+            deadline += sleep_time
+            delay = deadline - loop.time()
+            if delay < -sleep_time:
+                # Too far behind, don't burst frames to catch up
+                deadline = loop.time()
+                delay = 0
+            await asyncio.sleep(max(delay, 0))
+            metrics.PACING_ERROR.observe(abs(loop.time() - deadline))
+
+async def stream_wav(camera:VideoCamera, filepath):
+    """Yield audio chunks of a .wav while the camera is playing"""
+    viewers = metrics.VIEWERS.labels(camera.name, "wav")
+    viewers.inc()
+    try:
+        with open(filepath, "rb") as fwav:
+            data = fwav.read(WAV_CHUNK_SIZE)
+            while data:
+                if camera.status == CameraStatus.PLAYING:
+                    yield data
+                    data = fwav.read(WAV_CHUNK_SIZE)
+                else:
+                    await asyncio.sleep(IDLE_POLL)
+    finally:
+        viewers.dec()
+
+class AsyncStreamServer(object):
+    """HTTP server on asyncio. `/video_feed` and `/wav` are streamed from the event loop,
+    other requests are handled by the WSGI app on a pool of `wsgi_workers` threads"""
+    def __init__(self, app, sessions:SessionRegistry, attach_camera, frame_rate:float,
+                 host:str="0.0.0.0", port:int=5000, decode_workers:int=4,
+                 tier_max_behind:float=2.0, tier_recover_frames:int=100, wsgi_workers:int=16):
+        self.app = app
+        self.sessions = sessions
+        # attach_camera(camera, restart) prepares a camera for a new viewer, like `/video_feed` does
+        self.attach_camera = attach_camera
+        self.frame_rate = frame_rate
+        self.host = host
+        self.port = port
+        # Automatic tier switching of viewers that don't pick one
+        self.tier_max_behind = tier_max_behind
+        self.tier_recover_frames = tier_recover_frames
+        self.executor = ThreadPoolExecutor(max_workers=decode_workers, thread_name_prefix="frame-decoder")
+        # Requests beyond it wait for a thread, replay streams hold theirs until they end
+        self.wsgi_executor = ThreadPoolExecutor(max_workers=wsgi_workers, thread_name_prefix="wsgi-request")
+        self.publishers = {}
+        self.loop = None
+        self.server = None
+        self.started = threading.Event()
+
+    def __str__(self):
+        return f"Async stream server: http://{self.host}:{self.port}. Publishers: {len(self.publishers)}"
+
+    def serve_forever(self):
+        """Run the server until shutdown()"""
+        asyncio.run(self.serve())
+
+    def shutdown(self):
+        """Stop the server, from any thread"""
+        if self.loop and self.server:
+            self.loop.call_soon_threadsafe(self.server.close)
+
+    async def serve(self):
+        """Accept connections until the server is closed"""
+        self.loop = asyncio.get_running_loop()
+        self.server = await asyncio.start_server(self.handle_connection, self.host, self.port,
+            limit=MAX_HEADER_SIZE)
+        print(self)
+        self.started.set()
+        try:
+            await self.server.serve_forever()
+        except asyncio.CancelledError:
+            pass
+        finally:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.wsgi_executor.shutdown(wait=False, cancel_futures=True)
+
+    def get_publisher(self, camera:VideoCamera):
+        """Publisher of a camera. Cleaned sessions get a new camera, and a new publisher"""
+        publisher = self.publishers.get(camera.name)
+        if publisher is None or publisher.camera is not camera:
+            publisher = FramePublisher(camera, self.frame_rate, self.executor)
+            self.publishers[camera.name] = publisher
+        return publisher
+
+    async def handle_connection(self, reader:asyncio.StreamReader, writer:asyncio.StreamWriter):
+        """Serve one request, then close the connection"""
+        try:
+            request = await self.read_request(reader)
+            if request is None:
+                writer.write(BAD_REQUEST)
+                await writer.drain()
+                return
+            method, path, query, headers, body = request
+            match = STREAM_ROUTE.match(path)
+            if method == "GET" and match:
+                # Sessions are created by watchdog events, viewers only get existing ones
+                session = self.sessions.get(unquote(match.group(2) or DEFAULT_SESSION))
+                if session is None:
+                    writer.write(b"HTTP/1.1 404 Not Found\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
+                    await writer.drain()
+                elif match.group(1) == "video_feed":
+                    params = parse_qs(query)
+                    tier = params.get("tier", [AUTO_TIER])[0]
+                    restart = params.get("restart", ["0"])[0] not in ("", "0")
+                    await self.stream_video(session.camera, writer, tier, restart)
+                else:
+                    await self.stream_audio(session, writer)
+            else:
+                await self.call_wsgi(writer, method, path, query, headers, body)
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+            # Viewer went away
+            pass
+        except asyncio.TimeoutError:
+            # Client too slow to send its request
+            pass
+        except asyncio.CancelledError:
+            # Server shutting down with viewers still connected
+            pass
+        finally:
+            writer.close()
+
+    async def read_request(self, reader:asyncio.StreamReader):
+        """Returns (method, path, query, headers, body), or None for a bad request"""
+        head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), REQUEST_TIMEOUT)
+        lines = head.decode("latin-1").split("\r\n")
+        parts = lines[0].split(" ")
+        if len(parts) != 3:
+            return None
+        method, target, _ = parts
+        path, _, query = target.partition("?")
+        headers = {}
+        for line in lines[1:]:
+            name, sep, value = line.partition(":")
+            if sep:
+                headers[name.strip().lower()] = value.strip()
+        try:
+            length = int(headers.get("content-length") or 0)
+        except ValueError:
+            return None
+        if length < 0:
+            return None
+        body = await asyncio.wait_for(reader.readexactly(length), REQUEST_TIMEOUT) if length > 0 else b""
+        return method, path, query, headers, body
+
+    async def stream_video(self, camera:VideoCamera, writer:asyncio.StreamWriter, tier:str=AUTO_TIER,
+                           restart:bool=False):
+        """MJPEG stream shared by all viewers of a camera, in the viewer tier"""
+        # Before the publisher reads frames. Viewers join the running stream, like `/video_feed`
+        await self.loop.run_in_executor(self.executor, self.attach_camera, camera, restart)
+        publisher = self.get_publisher(camera)
+        viewers = metrics.VIEWERS.labels(camera.name, "mjpeg")
+        viewers.inc()
+        publisher.add_viewer()
+        try:
+            writer.write(b"HTTP/1.1 200 OK\r\n"
+                b"Content-Type: multipart/x-mixed-replace; boundary=frame\r\n"
+                b"Cache-Control: no-cache\r\nConnection: close\r\n\r\n")
+            await writer.drain()
+            selector = TierSelector(camera.tiers, tier, self.tier_max_behind, self.tier_recover_frames)
+            sequence = publisher.sequence
+            while True:
+                previous = sequence
+                sequence, frame = await publisher.next_frame(sequence)
+                # Frames skipped while writing the last one
+                index = selector.update(sequence - previous - 1)
+                chunk = frame.parts[index]
+                if chunk is None:
+                    chunk = await self.loop.run_in_executor(self.executor, frame.part, index)
+                metrics.TIER_FRAMES_SENT.labels(frame.tiered.ladder[index].name).inc()
+                writer.writelines(chunk)
+                await writer.drain()
+        finally:
+            publisher.remove_viewer()
+            viewers.dec()
+
+    async def stream_audio(self, session, writer:asyncio.StreamWriter):
+        """Live .wav of a session"""
+        filepath = session.copy_path / "output/temp.wav"
+        if not filepath.exists():
+            writer.write(b"HTTP/1.1 404 Not Found\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
+            await writer.drain()
+            return
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: audio/x-wav\r\nConnection: close\r\n\r\n")
+        await writer.drain()
+        async with contextlib.aclosing(stream_wav(session.camera, filepath)) as chunks:
+            async for chunk in chunks:
+                writer.write(chunk)
+                await writer.drain()
+
+    async def call_wsgi(self, writer:asyncio.StreamWriter, method:str, path:str, query:str,
+                        headers:dict, body:bytes):
+        """Run the WSGI app on a pool thread, streaming its response back through the loop.
+        Replay routes hold their thread for the whole stream, as on the Flask server"""
+        peer = writer.get_extra_info("peername") or ("", 0)
+        environ = {
+            'REQUEST_METHOD': method,
+            'SCRIPT_NAME': '',
+            'PATH_INFO': unquote(path, encoding="latin-1"),
+            'QUERY_STRING': query,
+            'SERVER_NAME': self.host,
+            'SERVER_PORT': str(self.port),
+            'SERVER_PROTOCOL': "HTTP/1.1",
+            'REMOTE_ADDR': peer[0],
+            'CONTENT_TYPE': headers.get("content-type", ""),
+            'CONTENT_LENGTH': str(len(body)),
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': "http",
+            'wsgi.input': io.BytesIO(body),
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False
+        }
+        for name, value in headers.items():
+            if name not in ("content-type", "content-length"):
+                environ["HTTP_" + name.upper().replace("-", "_")] = value
+        await self.loop.run_in_executor(self.wsgi_executor, self._run_wsgi, environ, writer)
+
+    def _run_wsgi(self, environ:dict, writer:asyncio.StreamWriter):
+        """Worker: call the app and write each chunk from the loop.
+        App errors are answered with a 500, unless the response has started"""
+        response = {}
+        def start_response(status, response_headers, exc_info=None):
+            response['status'] = status
+            response['headers'] = response_headers
+            return lambda data: None
+        async def write(data:bytes):
+            writer.write(data)
+            await writer.drain()
+        def send(data:bytes):
+            try:
+                future = asyncio.run_coroutine_threadsafe(write(data), self.loop)
+            except RuntimeError as e:
+                # Loop closed by shutdown, like a client that went away
+                raise ConnectionError(str(e)) from e
+            future.result()
+        app_iter = None
+        head_sent = False
+        try:
+            app_iter = self.app(environ, start_response)
+            for data in app_iter:
+                if not head_sent:
+                    send(self._response_head(response))
+                    head_sent = True
+                if data:
+                    send(data)
+            if not head_sent:
+                send(self._response_head(response))
+        except ConnectionError:
+            # Client went away, or the loop was stopped
+            pass
+        except Exception: # pylint: disable=broad-exception-caught
+            print(f"Error handling {environ['REQUEST_METHOD']} {environ['PATH_INFO']}:\n{traceback.format_exc()}")
+            if not head_sent:
+                try:
+                    send(INTERNAL_ERROR)
+                except (ConnectionError, asyncio.CancelledError):
+                    pass
+        finally:
+            if hasattr(app_iter, 'close'):
+                # Runs the generator cleanup of streaming routes
+                app_iter.close()
+
+    def _response_head(self, response:dict):
+        """HTTP status line and headers. Bodies end when the connection closes"""
+        lines = [f"HTTP/1.1 {response['status']}"]
+        lines.extend(f"{name}: {value}" for name, value in response['headers']
+            if name.lower() != "connection")
+        lines.append("Connection: close")
+        return ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1")
@@ -0,0 +1,597 @@
+"""Benchmark the watchdog camera pipeline by replaying the gen-video file protocol.
+
+Emulates the heygem-gen-video container in a temporary VIDEO_TEMP_PATH:
+writes `output/temp.wav`, then `output/avi/N.avi` segments at a configurable rate
+and jitter, then deletes `output`. Headless MJPEG and WAV clients are attached
+and end-to-end latency, frame pacing, total CPU with the viewer count, and memory are reported.
+The server mode follows watchdog_app.ASYNC_SERVER unless --async or --threaded is given.
+
+With --soak N, a single camera plays N segments as fast as it can instead, and
+the run fails unless open captures, file descriptors and memory stay flat.
+
+With --frame-workers N, segments are decoded and encoded by the frame pipeline
+worker processes, to compare throughput and latency with the single process path.
+
+Usage: python benchmark.py --viewers 4 --rate 14 --jitter 0.2 [--async | --threaded] [--frame-workers 2]
+       python benchmark.py --soak 5000 [--reuse-capture] [--frame-workers 2]
+"""
+import os
+import sys
+import time
+import json
+import wave
+import random
+import shutil
+import argparse
+import tempfile
+import threading
+import statistics
+import http.client
+import multiprocessing
+from pathlib import Path
+
+import cv2
+from metrics import get_rss, get_open_fds
+
+SAMPLES_PATH = Path(__file__).parent / "samples"
+SAMPLE_VIDEO = SAMPLES_PATH / "sample.mp4"
+SAMPLE_AUDIO = SAMPLES_PATH / "sample.wav"
+FRAME_BOUNDARY = b'--frame\r\n'
+WATCH_DELAY = 0.1 # Seconds between creating a directory and writing into it
+VIEWER_RETRY = 0.2 # Seconds between viewer connection attempts
+
+def split_segments(video_path: os.PathLike, output_dir: os.PathLike, frames_per_segment:int=2, loops:int=1):
+    """Split a video into numbered .avi segments, like the gen-video container does.
+    Returns (segment paths, fps)"""
+    os.makedirs(output_dir, exist_ok=True)
+    vidcap = cv2.VideoCapture(os.fspath(video_path))
+    fps = vidcap.get(cv2.CAP_PROP_FPS)
+    frames = []
+    while True:
+        success, image = vidcap.read()
+        if not success:
+            break
+        frames.append(image)
+    vidcap.release()
+    frames = frames * loops
+    height, width = frames[0].shape[:2]
+    segments = []
+    for start in range(0, len(frames), frames_per_segment):
+        path = os.path.join(output_dir, f"{len(segments)}.avi")
+        writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'MJPG'), fps, (width, height))
+        for image in frames[start:start + frames_per_segment]:
+            writer.write(image)
+        writer.release()
+        segments.append(path)
+    return segments, fps
+
+def write_looped_wav(audio_path: os.PathLike, output_path: os.PathLike, loops:int=1, duration:float=None):
+    """Write audio repeated loops times, cut to duration seconds if given"""
+    with wave.open(os.fspath(audio_path), 'rb') as fin:
+        params = fin.getparams()
+        data = fin.readframes(fin.getnframes()) * loops
+    if duration is not None:
+        data = data[:int(duration * params.framerate) * params.sampwidth * params.nchannels]
+    with wave.open(os.fspath(output_path), 'wb') as fout:
+        fout.setparams(params)
+        fout.writeframes(data)
+
+def configure_paths(watchdog_app, root: os.PathLike):
+    """Point the watchdog at a temporary heygem_data directory"""
+    # Imported here, after the watchdog module
+    from sessions import SessionRegistry
+    root = Path(root)
+    watchdog_app.VIDEO_TEMP_PATH   = root / "face2face/temp"
+    watchdog_app.COPIED_VIDEO_PATH = root / "face2face/copy"
+    watchdog_app.FRAMEIMAGE_PATH   = root / "face2face/frameimages"
+    watchdog_app.SESSIONS_PATH     = root / "face2face/sessions"
+    watchdog_app.RECORDINGS_PATH   = root / "face2face/recordings"
+    watchdog_app.SESSIONS = SessionRegistry(watchdog_app.COPIED_VIDEO_PATH,
+        watchdog_app.SESSIONS_PATH, watchdog_app.SESSION_RETENTION)
+    os.makedirs(watchdog_app.VIDEO_TEMP_PATH, exist_ok=True)
+
+def get_cpu_time():
+    """User and system CPU seconds of this process"""
+    times = os.times()
+    return times.user + times.system
+
+def get_workers_cpu_time(pipeline):
+    """User and system CPU seconds of the frame pipeline workers, while they run"""
+    if pipeline is None:
+        return 0.0
+    cpu_time = 0.0
+    for worker in pipeline.workers:
+        try:
+            with open(f"/proc/{worker.process.pid}/stat", encoding="utf-8") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+        except OSError:
+            # Not on Linux, or the worker is gone
+            continue
+        cpu_time += (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+    return cpu_time
+
+def percentile(values:list, fraction:float):
+    """Nearest rank percentile"""
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(int(fraction * len(values)), len(values) - 1)]
+
+def summarize(values:list):
+    """Mean, p50, p95, max"""
+    if not values:
+        return {'count': 0}
+    return {
+        'count': len(values),
+        'mean': statistics.fmean(values),
+        'p50': percentile(values, 0.5),
+        'p95': percentile(values, 0.95),
+        'max': max(values)
+    }
+
+class Emulator(object):
+    """Writes files into VIDEO_TEMP_PATH following the gen-video container protocol"""
+    def __init__(self, temp_path: os.PathLike, segments:list, audio_path: os.PathLike,
+                 rate:float, jitter:float, session:str=None, seed:int=0):
+        self.output_dir = Path(temp_path) / session / "output" if session else Path(temp_path) / "output"
+        self.segments = segments
+        self.audio_path = audio_path
+        self.rate = rate
+        self.jitter = jitter
+        self.random = random.Random(seed)
+        self.audio_time = 0
+        self.segment_times = []
+        self.finish_time = 0
+
+    def run(self, linger:float=1.0):
+        """Emit the whole job"""
+        # The observer watches new directories once it sees them, files written
+        # right after mkdir would be missed. The container also pauses here
+        os.makedirs(self.output_dir, exist_ok=True)
+        time.sleep(WATCH_DELAY)
+        shutil.copy(self.audio_path, self.output_dir / "temp.wav")
+        self.audio_time = time.time()
+        os.makedirs(self.output_dir / "avi", exist_ok=True)
+        time.sleep(WATCH_DELAY)
+        interval = 1.0 / self.rate
+        for i, segment in enumerate(self.segments):
+            # Gaussian jitter around the mean interval, as a fraction of it
+            time.sleep(max(interval * (1.0 + self.random.gauss(0, self.jitter)), 0))
+            shutil.copy(segment, self.output_dir / "avi" / f"{i}.avi")
+            self.segment_times.append(time.time())
+        time.sleep(linger)
+        shutil.rmtree(self.output_dir)
+        self.finish_time = time.time()
+
+def read_mjpeg(host:str, port:int, path:str, stop_time:float, results:dict):
+    """Headless MJPEG viewer. Records frame arrival times.
+    Reconnects until the session has been created by the first watchdog event"""
+    frames = []
+    nbytes = 0
+    while not nbytes and time.time() < stop_time:
+        conn = http.client.HTTPConnection(host, port, timeout=10)
+        try:
+            conn.request("GET", path)
+            response = conn.getresponse()
+            if response.status != 200:
+                results['error'] = f"HTTP {response.status}"
+            tail = b''
+            while response.status == 200 and time.time() < stop_time:
+                chunk = response.read1(65536)
+                if not chunk:
+                    break
+                nbytes += len(chunk)
+                data = tail + chunk
+                now = time.time()
+                frames.extend([now] * data.count(FRAME_BOUNDARY))
+                tail = data[-(len(FRAME_BOUNDARY) - 1):]
+        except OSError as e:
+            results['error'] = str(e)
+        finally:
+            conn.close()
+        if not nbytes:
+            time.sleep(VIEWER_RETRY)
+    if nbytes and results.get('error', '').startswith("HTTP"):
+        results.pop('error')
+    results['frames'] = frames
+    results['bytes'] = nbytes
+
+def read_wav(host:str, port:int, path:str, start_after:float, stop_time:float, results:dict):
+    """Headless WAV listener. Reconnects until temp.wav has been captured"""
+    time.sleep(max(start_after - time.time(), 0))
+    first_byte = 0
+    nbytes = 0
+    while not nbytes and time.time() < stop_time:
+        conn = http.client.HTTPConnection(host, port, timeout=10)
+        try:
+            conn.request("GET", path)
+            response = conn.getresponse()
+            # Until the session and temp.wav are there
+            while response.status == 200 and time.time() < stop_time:
+                chunk = response.read1(65536)
+                if not chunk:
+                    break
+                if not first_byte:
+                    first_byte = time.time()
+                nbytes += len(chunk)
+        except OSError as e:
+            results['error'] = str(e)
+        finally:
+            conn.close()
+        if not nbytes:
+            time.sleep(VIEWER_RETRY)
+    if nbytes:
+        results.pop('error', None)
+    results['first_byte'] = first_byte
+    results['bytes'] = nbytes
+
+def run_clients(host:str, port:int, video_path:str, wav_path:str, viewers:int, wav_viewers:int,
+                wav_after:float, stop_time:float, queue):
+    """Client process: run all viewers and send back their results"""
+    threads = []
+    video_results = [{} for _ in range(viewers)]
+    wav_results = [{} for _ in range(wav_viewers)]
+    for results in video_results:
+        threads.append(threading.Thread(target=read_mjpeg,
+            args=(host, port, video_path, stop_time, results), daemon=True))
+    for results in wav_results:
+        threads.append(threading.Thread(target=read_wav,
+            args=(host, port, wav_path, wav_after, stop_time, results), daemon=True))
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(max(stop_time - time.time(), 0) + 5)
+    queue.put({'video': video_results, 'wav': wav_results})
+
+def serve(watchdog_app, host:str, port:int, async_server:bool=False):
+    """Run the watchdog app with a threaded werkzeug server, or the async stream server.
+    Returns the server"""
+    if async_server:
+        server = watchdog_app.AsyncStreamServer(watchdog_app.app, watchdog_app.SESSIONS,
+            watchdog_app.attach_camera, watchdog_app.DEFAULT_FPS, host, port,
+            watchdog_app.ASYNC_DECODE_WORKERS, wsgi_workers=watchdog_app.ASYNC_WSGI_WORKERS)
+    else:
+        from werkzeug.serving import make_server
+        server = make_server(host, port, watchdog_app.app, threaded=True)
+    threading.Thread(target=server.serve_forever, name="benchmark-server", daemon=True).start()
+    if async_server:
+        server.started.wait(10)
+    return server
+
+def report_viewers(video_results:list, emulator:Emulator, fps:float, frames_per_segment:int):
+    """End-to-end latency and frame pacing of MJPEG viewers"""
+    first_frame_latency = []
+    segment_latency = []
+    intervals = []
+    pacing_error = []
+    for results in video_results:
+        frames = results.get('frames', [])
+        # Frames before the job started are placeholders
+        frames = [t for t in frames if t >= emulator.audio_time]
+        if not frames:
+            continue
+        first_frame_latency.append(frames[0] - emulator.audio_time)
+        for i, arrival in enumerate(frames):
+            segment = i // frames_per_segment
+            if segment < len(emulator.segment_times):
+                segment_latency.append(arrival - emulator.segment_times[segment])
+        frame_intervals = [b - a for a, b in zip(frames, frames[1:])]
+        intervals.extend(frame_intervals)
+        pacing_error.extend(abs(interval - 1.0 / fps) for interval in frame_intervals)
+    return {
+        'audio_to_first_frame': summarize(first_frame_latency),
+        'segment_to_frame': summarize(segment_latency),
+        'frame_interval': summarize(intervals),
+        'frame_interval_stdev': statistics.pstdev(intervals) if len(intervals) > 1 else 0.0,
+        'pacing_error': summarize(pacing_error),
+        'frames_received': [len(results.get('frames', [])) for results in video_results],
+        'errors': [results['error'] for results in video_results if 'error' in results]
+    }
+
+def report_tiers():
+    """Encoded frames, encode cost and bytes per frame of each tier, from the metrics"""
+    import metrics
+    tiers = {}
+    for (name,), encode in list(metrics.TIER_ENCODE.children.items()):
+        size = metrics.TIER_FRAME_BYTES.labels(name)
+        tiers[name] = {
+            'frames_encoded': encode.count,
+            'encode_mean': encode.sum / encode.count if encode.count else 0.0,
+            'bytes_mean': size.sum / size.count if size.count else 0.0,
+            'frames_sent': metrics.TIER_FRAMES_SENT.labels(name).value
+        }
+    return tiers
+
+def run_benchmark(args):
+    """Run one benchmark and return its report"""
+    root = Path(tempfile.mkdtemp(prefix="watchdog_benchmark_"))
+    sys.path.insert(0, os.fspath(Path(__file__).parent))
+    import watchdog_app
+    configure_paths(watchdog_app, root / "heygem_data")
+    watchdog_app.RECORD_STREAMS = args.record
+    watchdog_app.FRAME_WORKERS = args.frame_workers
+    pipeline = watchdog_app.start_frame_pipeline()
+
+    segments, fps = split_segments(SAMPLE_VIDEO, root / "segments", args.frames_per_segment, args.loops)
+    if args.segments:
+        segments = segments[:args.segments]
+    audio_path = root / "audio.wav"
+    # Audio matches the emitted video, so the expected segment count is right
+    write_looped_wav(SAMPLE_AUDIO, audio_path, args.loops,
+        len(segments) * args.frames_per_segment / fps if args.segments else None)
+    print(f"Benchmark: {len(segments)} segments at {args.rate}/s, jitter {args.jitter}, " \
+        f"{args.viewers} MJPEG and {args.wav_viewers} WAV viewers")
+
+    observer = watchdog_app.Observer()
+    observer.schedule(watchdog_app.TempFileHandler(), watchdog_app.VIDEO_TEMP_PATH, recursive=True)
+    observer.start()
+    if args.async_server is None:
+        args.async_server = watchdog_app.ASYNC_SERVER
+    server = serve(watchdog_app, args.host, args.port, args.async_server)
+
+    session_prefix = f"/{args.session}" if args.session else ""
+    emulator = Emulator(watchdog_app.VIDEO_TEMP_PATH, segments, audio_path, args.rate, args.jitter,
+        args.session, args.seed)
+    render_time = len(segments) / args.rate
+    play_time = len(segments) * args.frames_per_segment / fps
+    connect_time = 1.0
+    start_time = time.time() + connect_time
+    stop_time = start_time + max(render_time, play_time) + args.linger + args.tail
+
+    # Viewers connect first, audio listeners once temp.wav has been captured
+    # Clients run in their own process, so their CPU isn't counted as server CPU
+    context = multiprocessing.get_context("spawn")
+    queue = context.Queue()
+    clients = context.Process(target=run_clients, args=(args.host, args.port,
+        f"/video_feed{session_prefix}" + (f"?tier={args.tier}" if args.tier else ""),
+        f"/wav{session_prefix}", args.viewers, args.wav_viewers,
+        start_time + 0.5, stop_time, queue), daemon=True)
+    clients.start()
+
+    memory = []
+    cpu_start = get_cpu_time() + get_workers_cpu_time(pipeline)
+    wall_start = time.time()
+    sampling = threading.Event()
+    def sample_memory():
+        while not sampling.wait(args.sample_interval):
+            memory.append((time.time() - wall_start, get_rss()))
+    sampler = threading.Thread(target=sample_memory, daemon=True)
+    sampler.start()
+
+    time.sleep(connect_time)
+    emulator.run(args.linger)
+    client_results = queue.get(timeout=max(stop_time - time.time(), 0) + 30)
+    clients.join(5)
+    cpu_time = get_cpu_time() + get_workers_cpu_time(pipeline) - cpu_start
+    wall_time = time.time() - wall_start
+    sampling.set()
+
+    server.shutdown()
+    observer.stop()
+    observer.join()
+    watchdog_app.CAPTURER.shutdown()
+    if pipeline:
+        pipeline.stop()
+        watchdog_app.FRAME_PIPELINE = None
+
+    session = watchdog_app.SESSIONS.get_or_create(args.session or "default")
+    report = {
+        'config': vars(args),
+        'segments': len(segments),
+        'fps': fps,
+        'wall_time': wall_time,
+        'cpu_time': cpu_time,
+        # Server CPU includes decoding and encoding, which don't scale with viewers.
+        # Compare runs with different viewer counts instead of dividing by them
+        'cpu_percent': 100.0 * cpu_time / wall_time,
+        'viewers': {'mjpeg': args.viewers, 'wav': args.wav_viewers},
+        'server': 'async' if args.async_server else 'threaded',
+        'memory_rss': {
+            'start': memory[0][1] if memory else get_rss(),
+            'end': memory[-1][1] if memory else get_rss(),
+            'max': max(rss for _, rss in memory) if memory else get_rss(),
+            'samples': memory
+        },
+        'mjpeg': report_viewers(client_results['video'], emulator, fps, args.frames_per_segment),
+        'wav': {
+            'first_byte': summarize([results['first_byte'] - emulator.audio_time
+                for results in client_results['wav'] if results.get('first_byte')]),
+            'bytes': [results.get('bytes', 0) for results in client_results['wav']]
+        },
+        'session': session.to_dict(),
+        'tiers': report_tiers(),
+        'capture_lag_avg': watchdog_app.CAPTURER.average_lag()
+    }
+    shutil.rmtree(root, ignore_errors=True)
+    return report
+
+def run_soak(args):
+    """Play args.soak segments through one camera, sampling resources. Returns the report"""
+    root = Path(tempfile.mkdtemp(prefix="watchdog_soak_"))
+    sys.path.insert(0, os.fspath(Path(__file__).parent))
+    import metrics
+    from camera import VideoCamera, CameraStatus
+    from frame_pipeline import FramePipeline
+    segments, fps = split_segments(SAMPLE_VIDEO, root / "segments", args.frames_per_segment, args.loops)
+    print(f"Soak: {args.soak} segments from {len(segments)} files, reuse capture: {args.reuse_capture}, " \
+        f"frame workers: {args.frame_workers}")
+
+    camera = VideoCamera("soak")
+    camera.log_progress = False
+    camera.reuse_capture = args.reuse_capture
+    # Playing, so the pipeline prefetches queued segments like it does for a watched session
+    camera.status = CameraStatus.PLAYING
+    pipeline = FramePipeline(args.frame_workers, camera.tiers[0]).start() if args.frame_workers else None
+    camera.pipeline = pipeline
+    samples = []
+    frame_times = []
+    played = 0
+    frames = 0
+    start_time = time.time()
+    cpu_start = get_cpu_time() + get_workers_cpu_time(pipeline)
+    while played < args.soak:
+        # Batches like one job, played to the end of stream
+        batch = [segments[(played + i) % len(segments)] for i in range(min(args.soak_batch, args.soak - played))]
+        camera.load_videos(batch, time.time())
+        # Sampled while segments are playing, and again once the batch has drained
+        captures_playing = 0
+        fds_playing = None
+        batch_frames = 0
+        while True:
+            frame_start = time.time()
+            success, _, _, _ = camera.get_frame()
+            if not success and (camera.video or camera.video_queue):
+                # Late pipeline frame, the camera repeats the last one
+                continue
+            if not success:
+                break
+            frame_times.append(time.time() - frame_start)
+            frames += 1
+            batch_frames += 1
+            captures_playing = max(captures_playing, metrics.OPEN_CAPTURES.get())
+            if batch_frames == len(batch): # About halfway through the batch
+                fds_playing = get_open_fds()
+        played += len(batch)
+        samples.append({
+            'segments': played,
+            'open_captures_playing': captures_playing,
+            'open_fds_playing': fds_playing if fds_playing is not None else get_open_fds(),
+            'open_captures': metrics.OPEN_CAPTURES.get(),
+            'open_fds': get_open_fds(),
+            'rss': get_rss()
+        })
+    wall_time = time.time() - start_time
+    cpu_time = get_cpu_time() + get_workers_cpu_time(pipeline) - cpu_start
+    camera.clear_videos()
+    camera.release_frame_ring()
+    if pipeline:
+        pipeline.stop()
+    shutil.rmtree(root, ignore_errors=True)
+
+    # Growth after warm-up: decoder buffers and allocator pools settle in the first batches
+    baseline = samples[min(len(samples) // 4, len(samples) - 1)]
+    end = samples[-1]
+    fd_growth = max(end['open_fds'] - baseline['open_fds'],
+        end['open_fds_playing'] - baseline['open_fds_playing'])
+    rss_growth = end['rss'] - baseline['rss']
+    # One capture while a segment plays, none once the batch has drained
+    captures_playing = max(sample['open_captures_playing'] for sample in samples)
+    passed = captures_playing <= 1 and end['open_captures'] == 0 and fd_growth <= args.soak_max_fds \
+        and rss_growth <= args.soak_max_rss * 2**20
+    return {
+        'config': vars(args),
+        'segments': played,
+        'frames': frames,
+        'fps': fps,
+        'wall_time': wall_time,
+        'segments_per_second': played / wall_time if wall_time > 0 else 0.0,
+        'frames_per_second': frames / wall_time if wall_time > 0 else 0.0,
+        'frame_latency': summarize(frame_times),
+        'cpu_time': cpu_time,
+        'captures_opened': metrics.CAPTURES_OPENED.get(),
+        'open_captures_playing': captures_playing,
+        'open_captures_end': end['open_captures'],
+        'open_fds_growth': fd_growth,
+        'rss_growth': rss_growth,
+        'samples': samples,
+        'passed': passed
+    }
+
+def print_soak_report(report:dict):
+    """Readable soak summary"""
+    samples = report['samples']
+    print(f"Played {report['segments']} segments, {report['frames']} frames in {report['wall_time']:.1f}s " \
+        f"({report['segments_per_second']:.0f} segments/s, {report['frames_per_second']:.0f} frames/s)")
+    latency = report['frame_latency']
+    print(f"Frame latency: mean {latency.get('mean', 0) * 1000:.2f}ms, p50 {latency.get('p50', 0) * 1000:.2f}ms, " \
+        f"p95 {latency.get('p95', 0) * 1000:.2f}ms. CPU: {report['cpu_time']:.1f}s")
+    print(f"Open captures: max while playing {report['open_captures_playing']:.0f}, " \
+        f"end {report['open_captures_end']:.0f}")
+    print(f"Open fds while playing: start {samples[0]['open_fds_playing']}, end {samples[-1]['open_fds_playing']}")
+    print(f"Open fds: start {samples[0]['open_fds']}, end {samples[-1]['open_fds']}, " \
+        f"growth after warm-up {report['open_fds_growth']}")
+    print(f"Memory RSS: start {samples[0]['rss'] / 2**20:.1f}MB, end {samples[-1]['rss'] / 2**20:.1f}MB, " \
+        f"growth after warm-up {report['rss_growth'] / 2**20:.1f}MB")
+    print("Soak passed: resources are flat" if report['passed'] else "Soak FAILED: resources grow")
+
+def print_report(report:dict):
+    """Readable summary"""
+    mjpeg = report['mjpeg']
+    def ms(stats:dict, key:str):
+        return f"{stats.get(key, 0) * 1000:.1f}ms"
+    print(f"Wall: {report['wall_time']:.2f}s, CPU: {report['cpu_percent']:.1f}% total " \
+        f"with {report['viewers']['mjpeg']} MJPEG and {report['viewers']['wav']} WAV viewers, " \
+        f"{report['server']} server")
+    print(f"Memory RSS: start {report['memory_rss']['start'] / 2**20:.1f}MB, " \
+        f"end {report['memory_rss']['end'] / 2**20:.1f}MB, max {report['memory_rss']['max'] / 2**20:.1f}MB")
+    print(f"Audio to first frame: p50 {ms(mjpeg['audio_to_first_frame'], 'p50')}, " \
+        f"p95 {ms(mjpeg['audio_to_first_frame'], 'p95')}")
+    print(f"Segment to frame: p50 {ms(mjpeg['segment_to_frame'], 'p50')}, " \
+        f"p95 {ms(mjpeg['segment_to_frame'], 'p95')}")
+    print(f"Frame interval: mean {ms(mjpeg['frame_interval'], 'mean')}, " \
+        f"stdev {mjpeg['frame_interval_stdev'] * 1000:.1f}ms, " \
+        f"pacing error p95 {ms(mjpeg['pacing_error'], 'p95')}")
+    print(f"Frames received: {mjpeg['frames_received']}")
+    if mjpeg['errors']:
+        print(f"Viewer errors: {mjpeg['errors']}")
+    print(f"WAV first byte: p50 {ms(report['wav']['first_byte'], 'p50')}, bytes: {report['wav']['bytes']}")
+    for name, tier in report['tiers'].items():
+        print(f"Tier {name}: encoded {tier['frames_encoded']}, sent {tier['frames_sent']:.0f}, " \
+            f"encode mean {tier['encode_mean'] * 1000:.2f}ms, {tier['bytes_mean'] / 1024:.1f}KB per frame")
+    print(f"Run report: {report['session'].get('run_report')}")
+
+def parse_args(argv:list=None):
+    """Command line options"""
+    parser = argparse.ArgumentParser(description="Replay-driven benchmark for the watchdog camera pipeline")
+    parser.add_argument('--viewers', type=int, default=1, help="MJPEG viewers")
+    parser.add_argument('--wav-viewers', type=int, default=None, help="WAV listeners, defaults to --viewers")
+    parser.add_argument('--rate', type=float, default=14.0, help="Segments written per second")
+    parser.add_argument('--jitter', type=float, default=0.1, help="Segment interval stdev, as a fraction of it")
+    parser.add_argument('--frames-per-segment', type=int, default=2)
+    parser.add_argument('--segments', type=int, default=0, help="Limit segments, 0 for all")
+    parser.add_argument('--loops', type=int, default=1, help="Repeat the sample video and audio")
+    parser.add_argument('--session', type=str, default=None, help="Write under temp/<session>/output")
+    parser.add_argument('--linger', type=float, default=1.0, help="Seconds before output is deleted")
+    parser.add_argument('--tail', type=float, default=2.0, help="Seconds viewers stay after playback")
+    parser.add_argument('--record', action='store_true', help="Enable the stream recorder")
+    parser.add_argument('--tier', type=str, default=None, help="MJPEG tier viewers ask for, automatic by default")
+    parser.add_argument('--sample-interval', type=float, default=0.5, help="Memory sampling seconds")
+    server = parser.add_mutually_exclusive_group()
+    server.add_argument('--async', dest='async_server', action='store_true', default=None,
+        help="Serve with the asyncio stream server. Defaults to watchdog_app.ASYNC_SERVER")
+    server.add_argument('--threaded', dest='async_server', action='store_false',
+        help="Serve with werkzeug threads, one per viewer")
+    parser.add_argument('--host', type=str, default="127.0.0.1")
+    parser.add_argument('--port', type=int, default=5055)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', type=str, default=None, help="Write the full report as json")
+    parser.add_argument('--soak', type=int, default=0, help="Soak run: play this many segments through one camera")
+    parser.add_argument('--soak-batch', type=int, default=100, help="Segments queued at a time in the soak run")
+    parser.add_argument('--soak-max-fds', type=int, default=2, help="File descriptor growth allowed in the soak run")
+    parser.add_argument('--soak-max-rss', type=float, default=32, help="Memory growth allowed in the soak run, MB")
+    parser.add_argument('--reuse-capture', action='store_true', help="Reopen one capture object per camera")
+    parser.add_argument('--frame-workers', type=int, default=0,
+        help="Decode and encode in this many worker processes, 0 for the single process path")
+    args = parser.parse_args(argv)
+    if args.wav_viewers is None:
+        args.wav_viewers = args.viewers
+    return args
+
+def main(argv:list=None):
+    """Run the benchmark from the command line"""
+    args = parse_args(argv)
+    if args.soak:
+        report = run_soak(args)
+        print_soak_report(report)
+    else:
+        report = run_benchmark(args)
+        print_report(report)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2, default=str)
+        print(f"Report written to: {args.output}")
+    if args.soak and not report['passed']:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
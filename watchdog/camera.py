@@ -1,8 +1,16 @@
 """Module to get camera feed from video file queue"""
 import os
+import math
+import time
+import threading
 from enum import Enum
 import cv2
 import numpy as np
+from jitter import JitterBuffer
+from recorder import BackgroundWriter
+from tiers import EncodeTier, TierLadder, TieredFrame
+from frame_pipeline import EncodedFrame, PipelineCapture
+import metrics
 
 class CameraStatus(Enum) :
     """Status options for camera"""
@@ -17,7 +25,7 @@ class CameraStatus(Enum) :
 
 class VideoCamera(object):
     """Use opencv to read from video files and create stream"""
-    def __init__(self):
+    def __init__(self, name:str="default"):
         # Using OpenCV to capture from device 0. If you have trouble capturing
         # from a webcam, comment the line below out and use a video file
         # instead.
@@ -25,10 +33,25 @@ class VideoCamera(object):
         # If you decide to use video.mp4, you must have this file in the folder
         # as the main.py.
 
+        self.name = name
+        # Captures are opened, read and released by playback, capture callback and
+        # request threads. One lock for all of it, held while a frame is read
+        self.lock = threading.RLock()
         self.status = CameraStatus.OFF
         self.framenum = 0
         self.video_queue = []
         self.video_index = 0
+        # Reopen a released capture on the next segment, instead of creating a new one
+        self.reuse_capture = False
+        self.spare_capture = None
+        # Optional FramePipeline decoding and encoding segments in worker processes, into
+        # a ring of this camera. While playing, up to `pipeline_prefetch` queued segments
+        # are submitted ahead, as long as their frames fill at most half of the ring
+        self.pipeline = None
+        self.pipeline_prefetch = 4
+        self.frame_ring = None
+        # Average size of a pipeline frame, 0 until one is played
+        self.frame_bytes = 0.0
         self.video = {
             'index': 0,
             'capture': None,
@@ -43,20 +66,40 @@ class VideoCamera(object):
         self.video_start = 0
         self.last_video_load_time = -1
         self.video_rate  = 0
+        # Rate control
+        self.jitter = JitterBuffer()
+        self.default_fps = 0.0
+        self.audio_length = 0.0
+        self.expected_frames = 0
+        self.expected_videos = 0
+        self.videos_received = 0
+        self.run_report = {}
+        self.render_complete = False
+        # Recording, optional StreamRecorder fed with every played frame
+        self.recorder = None
         # Debugging
         self.write_output_images = False
         self.output_frames_dir = "frames"
+        self.frame_writer = None
         # Logging
         self.log_progress = True
+        # Encoding. The top tier is encoded for every frame, others when a viewer asks
+        self.tiers = TierLadder([EncodeTier("full")])
         # Testing
         placeholder_image = np.zeros((400, 600, 3), dtype=np.uint8)
-        _, self.latest_frame_jpeg = cv2.imencode('.jpg', placeholder_image)
+        _, placeholder_jpeg = cv2.imencode('.jpg', placeholder_image)
+        self.latest_frame_jpeg = placeholder_jpeg.tobytes()
+        self.latest_frame = TieredFrame(placeholder_image, self.tiers, self.latest_frame_jpeg)
 
     def __str__(self):
         return f"Camera object. Status: {self.status} Video queue: {len(self.video_queue)}. Current video: {self.video}"
 
     def __del__(self):
-        self.video['capture'].release()
+        self.release_video()
+        for video in getattr(self, 'video_queue', []):
+            if video.get('job'):
+                video['job'].cancel()
+        self.release_frame_ring()
 
     def set_status(self, status:CameraStatus):
         """ Set camera status""" 
@@ -64,87 +107,311 @@ class VideoCamera(object):
         if self.log_progress:
             print(f"Set camera status to {status}")
 
+    def set_tiers(self, tiers:TierLadder):
+        """Set the encode tiers. The top tier is what get_frame returns"""
+        with self.lock:
+            self.tiers = tiers
+            self.latest_frame_jpeg = tiers[0].encode(self.latest_frame.image)
+            self.latest_frame = TieredFrame(self.latest_frame.image, tiers, self.latest_frame_jpeg)
+
     def set_frame_output_dir(self, output_frames_dir: os.PathLike):
         """Set frame directory to save each video frame for testing"""
         self.output_frames_dir = output_frames_dir
         if self.write_output_images:
             os.makedirs(self.output_frames_dir, exist_ok=True)
+            if self.frame_writer is None:
+                self.frame_writer = BackgroundWriter()
 
     def get_frame(self):
-        """Use opencv get get frame image from a loaded video, otherwise load video in queue"""
-        if self.status == CameraStatus.IDLE:
-            return False, self.latest_frame_jpeg.tobytes(), self.framenum, self.video
-        if not self.video or not self.video['capture']: # load next video in queue
-            self.next_video()
-        if not self.video: # If still no next video, return last frame
-            return False, self.latest_frame_jpeg.tobytes(), self.framenum, self.video
-
-        success, image = self.video['capture'].read()
-        # We are using Motion JPEG, but OpenCV defaults to capture raw images,
-        # so we must encode it into JPEG in order to correctly display the
-        # video stream.
-        current_frame = self.framenum
-        if success: # Always on, even if static
-            # Get jpeg into memory buffer
-            ret, self.latest_frame_jpeg = cv2.imencode('.jpg', image)
-            frame_filepath = self.output_frames_dir + "/" +  \
-                os.path.basename(self.video['path']) + "_"+ \
-                str(self.video['current_frame']).zfill(2) + "_"+ \
-                str(self.framenum).zfill(4) + ".jpg"
-            if self.write_output_images:
-                with open(frame_filepath, 'wb') as f:
-                    # Write the encoded image data (which is a NumPy array of bytes)
-                    f.write(self.latest_frame_jpeg)
-                    if self.log_progress:
-                        print(f"Wrote frame {self.framenum} to: {frame_filepath}")
+        """Advance to the next frame. Returns (success, top tier jpeg, frame number, video)"""
+        success, frame, framenum, video = self.get_tiered_frame()
+        return success, frame.get(0), framenum, video
 
-            self.framenum += 1
-            self.video['current_frame'] += 1
-        else:
-            self.video = None
-        return success, self.latest_frame_jpeg.tobytes(), current_frame, self.video
+    def get_tiered_frame(self):
+        """Use opencv get get frame image from a loaded video, otherwise load video in queue.
+        Returns (success, TieredFrame, frame number, video). Viewers encode their tier from
+        the returned frame, latest_frame may already be the next one"""
+        with self.lock:
+            if self.status == CameraStatus.IDLE:
+                return False, self.latest_frame, self.framenum, self.video
+            if not self.video or not self.video['capture']: # load next video in queue
+                self.next_video()
+            if not self.video: # If still no next video, return last frame
+                return False, self.latest_frame, self.framenum, self.video
+
+            read_start = time.time()
+            success, image = self.video['capture'].read()
+            if not success and self.frame_pending():
+                # Frames of the segment are late, not over. Repeat the last frame meanwhile
+                return False, self.latest_frame, self.framenum, self.video
+            if not success: # End of segment, continue with next one
+                self.next_video()
+                if self.video:
+                    success, image = self.video['capture'].read()
+                    if not success and self.frame_pending():
+                        return False, self.latest_frame, self.framenum, self.video
+            pipelined = isinstance(image, EncodedFrame)
+            if not pipelined: # Pipeline workers report their own read and encode times
+                metrics.FRAME_READ.observe(time.time() - read_start)
+            # We are using Motion JPEG, but OpenCV defaults to capture raw images,
+            # so we must encode it into JPEG in order to correctly display the
+            # video stream.
+            current_frame = self.framenum
+            if success: # Always on, even if static
+                if pipelined:
+                    # Already encoded. Copied out of the ring once, viewers keep the copy
+                    self.frame_bytes = 0.9 * self.frame_bytes + 0.1 * len(image) \
+                        if self.frame_bytes else float(len(image))
+                    self.latest_frame_jpeg = image.take()
+                    self.latest_frame = TieredFrame(None, self.tiers, self.latest_frame_jpeg)
+                else:
+                    # Get jpeg into memory buffer
+                    encode_start = time.time()
+                    self.latest_frame_jpeg = self.tiers[0].encode(image)
+                    self.latest_frame = TieredFrame(image, self.tiers, self.latest_frame_jpeg)
+                    metrics.FRAME_ENCODE.observe(time.time() - encode_start)
+                # Pipelined frames are decoded on the recorder thread, not under the camera lock
+                if self.recorder and not self.recorder.push(self.latest_frame):
+                    metrics.FRAMES_DROPPED.labels("recorder").inc()
+                if self.write_output_images and self.frame_writer:
+                    frame_filepath = self.output_frames_dir + "/" +  \
+                        os.path.basename(self.video['path']) + "_"+ \
+                        str(self.video['current_frame']).zfill(2) + "_"+ \
+                        str(self.framenum).zfill(4) + ".jpg"
+                    # Written on a background thread
+                    if not self.frame_writer.write(frame_filepath, self.latest_frame_jpeg):
+                        metrics.FRAMES_DROPPED.labels("frame_dump").inc()
+
+                self.framenum += 1
+                self.video['current_frame'] += 1
+                # Once per played frame, however many viewers read the rate
+                self.jitter.update(self.buffered_frames(), self.is_rendering())
+            else:
+                self.release_video()
+                if self.is_rendering():
+                    if not self.jitter.in_underrun:
+                        metrics.UNDERRUNS.labels(self.name).inc()
+                    self.jitter.on_underrun()
+                elif self.render_complete and self.status == CameraStatus.PLAYING:
+                    self.finish()
+            return success, self.latest_frame, current_frame, self.video
+
+    def set_audio_length(self, audio_length:float, default_fps:float):
+        """Set expected frames and videos from the audio length. Uses the real video fps once known"""
+        self.audio_length = audio_length
+        self.default_fps = default_fps
+        self.update_expected()
+
+    def update_expected(self):
+        """Expected frames and videos for the current audio, at current fps"""
+        fps = self.jitter.fps or self.default_fps
+        self.expected_frames = max(int(fps * self.audio_length) - 1, 0)
+        self.expected_videos = math.ceil(self.expected_frames / self.jitter.frames_per_segment())
+
+    def get_frame_rate(self):
+        """Real fps of the current video, or last known fps"""
+        video = self.video
+        if video and video['frame_rate'] > 0:
+            return video['frame_rate']
+        return self.jitter.fps or self.default_fps
+
+    def is_rendering(self):
+        """Segments are still expected for the current audio"""
+        if self.status != CameraStatus.PLAYING or not self.expected_videos or self.render_complete:
+            return False
+        return self.jitter.segments_loaded < self.expected_videos
+
+    def buffered_frames(self):
+        """Frames ready to be played: rest of the current video and queued videos"""
+        frames = 0
+        video = self.video
+        if video:
+            frames += max(video['frame_count'] - video['current_frame'], 0)
+        return frames + len(self.video_queue) * self.jitter.frames_per_segment()
+
+    def playback_rate(self):
+        """Playback rate multiplier from the jitter buffer, as of the last played frame"""
+        return self.jitter.rate
+
+    def finish(self):
+        """All rendered videos have been played"""
+        self.set_status(CameraStatus.FINISHED)
+        if self.recorder:
+            self.recorder.stop()
 
     def clear_videos(self):
-        """Clear video render queue"""
-        self.video_queue = []
+        """Clear video render queue, and the video being played"""
+        with self.lock:
+            for video in self.video_queue:
+                if video.get('job'):
+                    video['job'].cancel()
+            self.video_queue = []
+            self.render_complete = False
+            if self.recorder:
+                self.recorder.stop()
+            self.release_video()
+            self.videos_received = 0
+            self.run_report = {}
+            self.jitter.reset()
 
-    def load_videos(self, video_list:list, load_time:float):
-        """Load multiple videos into queue"""
-        for video in video_list:
-            self.add_video(video, load_time)
+    def load_videos(self, video_list:list, load_time:float, start_frame:int=0):
+        """Load multiple videos into queue. The first video starts at start_frame"""
+        with self.lock:
+            for i, video in enumerate(video_list):
+                self.add_video(video, load_time, start_frame if i == 0 else 0)
 
-    def add_video(self, path: os.PathLike, load_time:float):
+    def add_video(self, path: os.PathLike, load_time:float, start_frame:int=0):
         """Add videos, from watchdog or bulk add"""
-        prev_video = self.video_queue[-1] if self.video_queue else {}
-        prev_load_time = prev_video['load_time'] if prev_video else self.video_start
-        self.video_queue.append({'path':path, 'load_time': load_time})
-        self.last_video_load_time = load_time
-
-        video_queue_length = len(self.video_queue)
-        if not self.video or not self.video['capture']: # load next video in queue
-            if video_queue_length == 0:
-                self.next_video()
+        with self.lock:
+            prev_video = self.video_queue[-1] if self.video_queue else {}
+            prev_load_time = prev_video['load_time'] if prev_video else self.video_start
+            self.video_queue.append({'path':path, 'load_time': load_time, 'start_frame': start_frame})
+            self.last_video_load_time = load_time
+            self.videos_received += 1
+            self.jitter.on_segment_arrival(load_time)
 
-        if self.log_progress:
-            latency = load_time - prev_load_time
-            print(f"Video [{ len(self.video_queue) - 1 }] added: {os.path.basename(path)}. load_time: {load_time-self.video_start} latency:{latency}")
+            video_queue_length = len(self.video_queue)
+            # Only queued here. The playback thread opens captures, in get_frame
+            self.prefetch_videos()
 
-    def next_video(self):
-        """Load new videos from top of queue if available"""
-        if len(self.video_queue) > 0:
-            video = self.video_queue[0]
-            vidcap = cv2.VideoCapture(video['path'])
-            self.last_video_load_time = -1
-            self.video = {
-                'index': self.video_index,
-                'capture': vidcap,
-                'path': video['path'],
-                'frame_count': int(vidcap.get(cv2.CAP_PROP_FRAME_COUNT)),
-                'frame_rate': vidcap.get(cv2.CAP_PROP_FPS),
-                'current_frame': 0,
-                'load_time': video['load_time']
-            }
-            self.video_index += 1
-            self.video_queue.pop(0)
+            if self.log_progress:
+                latency = load_time - prev_load_time
+                print(f"Video [{ video_queue_length - 1 }] added: {os.path.basename(path)}. load_time: {load_time-self.video_start} latency:{latency}")
+
+    def get_frame_ring(self):
+        """Ring the frame pipeline writes the segments of this camera into"""
+        if self.frame_ring is None:
+            self.frame_ring = self.pipeline.attach()
+        return self.frame_ring
+
+    def release_frame_ring(self):
+        """Remove the pipeline ring of this camera, once its jobs are cancelled"""
+        with self.lock:
+            frame_ring = getattr(self, 'frame_ring', None)
+            self.frame_ring = None
+        if frame_ring is not None:
+            frame_ring.detach()
+
+    def submit_video(self, video:dict):
+        """Submit a queued video to the frame pipeline, if not submitted yet"""
+        if not video.get('job'):
+            video['job'] = self.pipeline.submit(self.get_frame_ring(), video['path'], video['start_frame'])
+
+    def prefetch_videos(self):
+        """Submit the first queued videos to the frame pipeline while playing, so they are
+        decoded ahead. Cameras not playing don't fill their ring"""
+        if self.pipeline is None or self.status != CameraStatus.PLAYING:
+            return
+        segment_bytes = self.frame_bytes * self.jitter.frames_per_segment()
+        max_bytes = self.get_frame_ring().ring.capacity // 2
+        for count, video in enumerate(self.video_queue[:self.pipeline_prefetch], 1):
+            # Frames of the video playing are in the ring too
+            if (count + 1) * segment_bytes > max_bytes:
+                break
+            self.submit_video(video)
+
+    def frame_pending(self):
+        """The pipeline hasn't written the next frame of the current video yet, or stalled
+        on it and it's submitted again. False at the real end of the video"""
+        vidcap = self.video['capture']
+        if not isinstance(vidcap, PipelineCapture):
+            return False
+        return vidcap.late() or self.retry_stalled_video()
+
+    def video_ready(self, video:dict):
+        """The frame pipeline has opened a queued video, so loading it doesn't wait on the
+        worker under the camera lock. A job the worker lost is submitted again"""
+        job = video.get('job')
+        if job is None or job.wait_meta():
+            return True
+        if job.is_lost():
+            print(f"Frame pipeline lost {os.path.basename(video['path'])}, submitting it again")
+            metrics.PIPELINE_STALLS.labels(self.name).inc()
+            video.pop('job').cancel()
+            self.submit_video(video)
+        return False
+
+    def retry_stalled_video(self):
+        """Submit the rest of the current video again, if the pipeline stalled on it.
+        False at the real end of the video"""
+        vidcap = self.video['capture']
+        if not isinstance(vidcap, PipelineCapture) or not vidcap.incomplete():
+            return False
+        print(f"Frame pipeline stalled on {os.path.basename(self.video['path'])} " \
+            f"at frame {self.video['current_frame']}, submitting it again")
+        metrics.PIPELINE_STALLS.labels(self.name).inc()
+        # The ring is written in play order. Prefetched videos may be what fills it,
+        # they are submitted again after the rest of this one
+        for video in self.video_queue:
+            if video.get('job'):
+                video.pop('job').cancel()
+        vidcap.resubmit(self.pipeline, self.video['current_frame'])
+        return True
+
+    def open_capture(self, path: os.PathLike, job=None):
+        """Open a capture on a video file, reusing the spare capture if enabled.
+        Videos submitted to the frame pipeline are read from their job"""
+        if job is not None:
+            vidcap = PipelineCapture(job)
+        elif self.reuse_capture and self.spare_capture is not None:
+            vidcap = self.spare_capture
+            self.spare_capture = None
+            vidcap.open(os.fspath(path))
+            metrics.CAPTURES_REUSED.inc()
         else:
+            vidcap = cv2.VideoCapture(os.fspath(path))
+        metrics.CAPTURES_OPENED.inc()
+        metrics.OPEN_CAPTURES.inc()
+        return vidcap
+
+    def release_video(self):
+        """Release the capture of the current video, and drop the video"""
+        with self.lock:
+            video = getattr(self, 'video', None)
             self.video = None
+            if not video or video['capture'] is None:
+                return
+            vidcap = video['capture']
+            video['capture'] = None
+            vidcap.release()
+            metrics.OPEN_CAPTURES.dec()
+            if self.reuse_capture and not isinstance(vidcap, PipelineCapture):
+                # Released captures hold no file or decoder, only the object is kept
+                self.spare_capture = vidcap
+
+    def next_video(self):
+        """Load new videos from top of queue if available. The previous video is released"""
+        with self.lock:
+            self.release_video()
+            if len(self.video_queue) > 0:
+                video = self.video_queue[0]
+                if self.pipeline is not None:
+                    self.submit_video(video)
+                    if not self.video_ready(video):
+                        # Not opened by the worker yet, loaded on a later frame
+                        return
+                vidcap = self.open_capture(video['path'], video.get('job'))
+                if video.get('start_frame'): # Seek
+                    vidcap.set(cv2.CAP_PROP_POS_FRAMES, video['start_frame'])
+                self.last_video_load_time = -1
+                self.video = {
+                    'index': self.video_index,
+                    'capture': vidcap,
+                    'path': video['path'],
+                    'frame_count': int(vidcap.get(cv2.CAP_PROP_FRAME_COUNT)),
+                    'frame_rate': vidcap.get(cv2.CAP_PROP_FPS),
+                    'current_frame': video.get('start_frame', 0),
+                    'load_time': video['load_time']
+                }
+                self.video_index += 1
+                self.video_queue.pop(0)
+                self.prefetch_videos()
+                previous_fps = self.jitter.fps
+                self.jitter.on_segment_loaded(self.video['frame_count'], self.video['frame_rate'])
+                if self.audio_length and self.jitter.fps != previous_fps:
+                    self.update_expected()
+                    if self.log_progress:
+                        print(f"Video fps: {self.jitter.fps}. Expected: Frames: {self.expected_frames}, " \
+                            f"Videos: {self.expected_videos}")
+            else:
+                self.video = None
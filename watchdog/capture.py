@@ -0,0 +1,173 @@
+"""Module to capture files written by the gen-video service off the watchdog observer thread"""
+import os
+import time
+import shutil
+import fnmatch
+import threading
+from collections import deque
+from enum import Enum
+from concurrent.futures import ThreadPoolExecutor
+
+class CaptureAction(Enum):
+    """What to do with a closed file"""
+    IGNORE = 0
+    COPY = 1
+    HARDLINK = 2
+
+class CapturePolicy(object):
+    """Ordered list of (pattern, action) rules. The first matching pattern wins"""
+    def __init__(self, rules:list, default:CaptureAction=CaptureAction.COPY):
+        self.rules = [(pattern, CaptureAction[action.upper()] if isinstance(action, str) else action)
+            for pattern, action in rules]
+        self.default = default
+
+    def __str__(self):
+        rules = ", ".join(f"{pattern}:{action.name}" for pattern, action in self.rules)
+        return f"Capture policy. Rules: [{rules}] Default: {self.default.name}"
+
+    def action_for(self, rpath: os.PathLike):
+        """Returns the capture action for a path relative to the watched directory"""
+        rpath = str(rpath).replace(os.sep, "/")
+        for pattern, action in self.rules:
+            if fnmatch.fnmatch(rpath, pattern):
+                return action
+        return self.default
+
+class FileCapturer(object):
+    """Hardlink files on the calling thread, and copy them with a worker pool.
+    Completion callbacks are called in submission order, once each file is safely captured"""
+    def __init__(self, policy:CapturePolicy, max_workers:int=4):
+        self.policy = policy
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="capture")
+        self.pending = deque()
+        self.lock = threading.Lock()
+        # Callbacks run one batch at a time, in order, without holding self.lock
+        self.callback_lock = threading.Lock()
+        # Lag stats
+        self.captured = 0
+        self.failed = 0
+        self.ignored = 0
+        self.total_lag = 0.0
+        self.max_lag = 0.0
+        self.last_lag = 0.0
+        # Logging
+        self.log_progress = False
+
+    def __str__(self):
+        return f"File capturer. Captured: {self.captured}, Failed: {self.failed}, " \
+            f"Ignored: {self.ignored}, Pending: {len(self.pending)}, " \
+            f"Lag avg: {self.average_lag():.4f}s max: {self.max_lag:.4f}s"
+
+    def average_lag(self):
+        """Average time from close event to captured file"""
+        return self.total_lag / self.captured if self.captured else 0.0
+
+    def submit(self, src: os.PathLike, dst: os.PathLike, rpath: os.PathLike, on_captured=None):
+        """Queue a closed file for capture. Returns False if the policy ignores it.
+        on_captured(dst, lag) is called once the file has been captured"""
+        action = self.policy.action_for(rpath)
+        if action == CaptureAction.IGNORE:
+            self.ignored += 1
+            return False
+        job = {
+            'src': src,
+            'dst': dst,
+            'rpath': rpath,
+            'action': action,
+            'closed_time': time.time(),
+            'on_captured': on_captured,
+            'done': False,
+            'success': False,
+            'lag': 0.0
+        }
+        with self.lock:
+            self.pending.append(job)
+        if action == CaptureAction.HARDLINK and self._link(job):
+            # Linked before the writer can delete the source
+            self._complete(job)
+        else:
+            self.executor.submit(self._capture, job)
+        return True
+
+    def when_flushed(self, callback):
+        """Call callback() once every file submitted so far has been captured, or has failed.
+        It runs in order with the capture callbacks, right after those of the earlier files"""
+        marker = {
+            'rpath': None,
+            'action': None,
+            'on_captured': callback,
+            'done': True,
+            'success': True,
+            'marker': True
+        }
+        with self.lock:
+            self.pending.append(marker)
+        self._notify_completed()
+
+    def shutdown(self, wait:bool=True):
+        """Stop the worker pool"""
+        self.executor.shutdown(wait=wait)
+
+    def _link(self, job:dict):
+        """Hardlink a file on the calling thread. False if it has to be copied instead"""
+        try:
+            os.makedirs(os.path.dirname(job['dst']), exist_ok=True)
+            if os.path.exists(job['dst']):
+                os.remove(job['dst'])
+            os.link(job['src'], job['dst'])
+        except OSError:
+            # Across devices, or the source is already gone. The copy reports the failure
+            return False
+        job['success'] = True
+        return True
+
+    def _capture(self, job:dict):
+        """Worker: copy a single file"""
+        try:
+            os.makedirs(os.path.dirname(job['dst']), exist_ok=True)
+            shutil.copy(job['src'], job['dst'])
+            job['success'] = True
+        except OSError as e:
+            # The source may be deleted before we get to it
+            print(f"Capture failed for {job['rpath']}: {e}")
+        self._complete(job)
+
+    def _complete(self, job:dict):
+        """Mark a job captured, or failed, and run the callbacks that are ready"""
+        job['lag'] = time.time() - job['closed_time']
+        job['done'] = True
+        self._notify_completed()
+
+    def _notify_completed(self):
+        """Run callbacks of completed jobs, keeping the order files were closed in.
+        Callbacks run outside self.lock, so they can submit files"""
+        with self.callback_lock:
+            completed = []
+            with self.lock:
+                while self.pending and self.pending[0]['done']:
+                    job = self.pending.popleft()
+                    if job.get('marker'):
+                        completed.append(job)
+                        continue
+                    if not job['success']:
+                        self.failed += 1
+                        continue
+                    self.captured += 1
+                    self.total_lag += job['lag']
+                    self.max_lag = max(self.max_lag, job['lag'])
+                    self.last_lag = job['lag']
+                    completed.append(job)
+            for job in completed:
+                if job.get('marker'):
+                    try:
+                        job['on_captured']()
+                    except Exception as e: # pylint: disable=broad-exception-caught
+                        print(f"Capture flush callback failed: {e}")
+                    continue
+                if self.log_progress:
+                    print(f"Captured {job['action'].name}: {job['rpath']}. lag: {job['lag']:.4f}s")
+                if job['on_captured']:
+                    try:
+                        job['on_captured'](job['dst'], job['lag'])
+                    except Exception as e: # pylint: disable=broad-exception-caught
+                        print(f"Capture callback failed for {job['rpath']}: {e}")
@@ -0,0 +1,463 @@
+"""Module to decode and encode video segments in worker processes.
+
+Each camera has a ring buffer in shared memory, written by one worker process. Cameras
+submit segments as they are played, the worker decodes them and writes the jpeg of every
+frame into the camera ring, and the camera copies each frame out once as it plays it.
+Decoding and encoding then run outside the serving process and its GIL, and a camera
+nobody reads only fills its own ring"""
+import os
+import time
+import struct
+import threading
+import itertools
+import multiprocessing
+from collections import deque
+from multiprocessing import shared_memory
+import cv2
+import metrics
+
+# Ring header: bytes written by the worker, bytes released by the camera process
+RING_HEADER = struct.Struct("<QQ")
+# Seconds between checks of a full ring, or of a frame not decoded yet
+RING_POLL = 0.001
+# Seconds without a report from the worker before a segment it hasn't finished is lost
+WORKER_TIMEOUT = 10.0
+# Seconds a camera waits for a frame or a segment's meta. It waits holding its lock,
+# a frame not ready by then is late and the camera repeats the last one
+READ_TIMEOUT = 0.01
+# Seconds a worker waits for space in a full camera ring before it gives up the segment,
+# so a camera that isn't read doesn't hold up the other cameras of the worker. Once given up,
+# later segments of the ring don't wait at all until it has space again
+RING_STALL_TIMEOUT = 0.5
+
+class RingMemory(shared_memory.SharedMemory):
+    """Shared memory whose frames may still be referenced when it's closed"""
+    def close(self):
+        try:
+            super().close()
+        except BufferError:
+            # Views of frames are still alive, the mapping goes with them
+            pass
+
+class FrameRing(object):
+    """Single producer, single consumer byte ring in shared memory.
+    Positions only grow, the offset in the ring is position modulo capacity"""
+    def __init__(self, name:str=None, capacity:int=32 * 1024 * 1024):
+        create = name is None
+        self.shm = RingMemory(name=name, create=create,
+            size=RING_HEADER.size + capacity if create else 0)
+        # Attached mappings may be rounded up to a page, so the capacity is passed along
+        self.capacity = capacity
+        self.data = self.shm.buf[RING_HEADER.size:RING_HEADER.size + self.capacity]
+        self.closed = False
+        if create:
+            RING_HEADER.pack_into(self.shm.buf, 0, 0, 0)
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    def positions(self):
+        """(written, released) positions"""
+        return RING_HEADER.unpack_from(self.shm.buf, 0)
+
+    def write(self, payload, stop_event=None, timeout:float=None):
+        """Producer: copy a payload into the ring, waiting for space.
+        Returns its position, or None if stopped or out of time"""
+        length = len(payload)
+        if length > self.capacity // 2:
+            # Frames never wrap, a larger one may not fit wherever the ring stands
+            raise ValueError(f"Frame of {length} bytes doesn't fit a ring of {self.capacity}")
+        written, _ = self.positions()
+        position = written
+        if position % self.capacity + length > self.capacity:
+            # Frames never wrap, skip to the start of the ring
+            position += self.capacity - position % self.capacity
+        deadline = time.time() + timeout if timeout is not None else None
+        while position + length - self.positions()[1] > self.capacity:
+            if stop_event is not None and stop_event.is_set():
+                return None
+            if deadline is not None and time.time() > deadline:
+                return None
+            time.sleep(RING_POLL)
+        offset = position % self.capacity
+        self.data[offset:offset + length] = payload
+        struct.pack_into("<Q", self.shm.buf, 0, position + length)
+        return position
+
+    def view(self, position:int, length:int):
+        """Consumer: memoryview of a payload"""
+        offset = position % self.capacity
+        return self.data[offset:offset + length]
+
+    def release_to(self, position:int):
+        """Consumer: space before position can be reused"""
+        if not self.closed:
+            struct.pack_into("<Q", self.shm.buf, 8, position)
+
+    def close(self, unlink:bool=False):
+        """Detach, and remove the shared memory if unlink"""
+        self.closed = True
+        self.data.release()
+        self.shm.close()
+        if unlink:
+            self.shm.unlink()
+
+def worker_main(tasks, results, tier, stop_event):
+    """Worker process: decode segments and write their frames into the ring of their camera"""
+    rings = {}
+    # Names of rings that were full the last time they were written
+    full_rings = set()
+    try:
+        while True:
+            task = tasks.get()
+            if task is None or stop_event.is_set():
+                break
+            if task[0] == 'detach':
+                full_rings.discard(task[1])
+                ring = rings.pop(task[1], None)
+                if ring is not None:
+                    ring.close()
+                continue
+            _, job_id, path, start_frame, ring_name, capacity = task
+            stalled = False
+            vidcap = cv2.VideoCapture(os.fspath(path))
+            try:
+                ring = rings.get(ring_name)
+                if ring is None:
+                    ring = rings[ring_name] = FrameRing(ring_name, capacity)
+                if start_frame:
+                    vidcap.set(cv2.CAP_PROP_POS_FRAMES, start_frame)
+                results.put(('meta', job_id, int(vidcap.get(cv2.CAP_PROP_FRAME_COUNT)),
+                    vidcap.get(cv2.CAP_PROP_FPS)))
+                while True:
+                    read_start = time.time()
+                    success, image = vidcap.read()
+                    if not success:
+                        break
+                    encode_start = time.time()
+                    jpeg = tier.encode_image(image)
+                    encode_time = time.time() - encode_start
+                    position = ring.write(jpeg, stop_event,
+                        0 if ring_name in full_rings else RING_STALL_TIMEOUT)
+                    if position is None:
+                        # The rest of the segment is submitted again once the camera reads
+                        stalled = not stop_event.is_set()
+                        full_rings.add(ring_name)
+                        break
+                    full_rings.discard(ring_name)
+                    results.put(('frame', job_id, position, len(jpeg), encode_start - read_start, encode_time))
+            except Exception as e:
+                # Also a ring already removed, of a camera that was cleaned
+                print(f"Frame worker error on {path}: {e}")
+            finally:
+                vidcap.release()
+                results.put(('end', job_id, stalled))
+    finally:
+        for ring in rings.values():
+            ring.close()
+
+class CameraRing(object):
+    """Ring of one camera, the worker writing into it, and the order its frames must be released in"""
+    def __init__(self, pipeline, worker, capacity:int):
+        self.pipeline = pipeline
+        self.worker = worker
+        self.ring = FrameRing(capacity=capacity)
+        # Frames not released yet, in ring order
+        self.outstanding = deque()
+        self.lock = threading.Lock()
+
+    def release(self):
+        """Free ring space up to the oldest frame still in use"""
+        with self.lock:
+            position = None
+            while self.outstanding and self.outstanding[0].released:
+                oldest = self.outstanding.popleft()
+                position = oldest.position + oldest.length
+            if position is not None:
+                self.ring.release_to(position)
+
+    def detach(self):
+        """The camera is gone. Remove the ring"""
+        self.pipeline.detach(self)
+
+class EncodedFrame(object):
+    """A jpeg in a camera ring. Its data is valid until released"""
+    def __init__(self, camera_ring:CameraRing, position:int, length:int):
+        self.camera_ring = camera_ring
+        self.position = position
+        self.length = length
+        self.data = camera_ring.ring.view(position, length)
+        self.released = False
+
+    def __len__(self):
+        return self.length
+
+    def take(self):
+        """Copy the jpeg out of the ring, and release its space. Returns the jpeg bytes"""
+        data = bytes(self.data)
+        self.release()
+        return data
+
+    def release(self):
+        """The camera is done with the frame"""
+        if not self.released:
+            self.released = True
+            self.data.release()
+            self.camera_ring.release()
+
+class SegmentJob(object):
+    """Frames of one segment, as the worker reports them"""
+    def __init__(self, job_id:int, camera_ring:CameraRing, path: os.PathLike, start_frame:int=0):
+        self.job_id = job_id
+        self.camera_ring = camera_ring
+        self.path = path
+        self.start_frame = start_frame
+        self.frame_count = 0
+        self.fps = 0.0
+        self.frames = deque()
+        self.has_meta = False
+        self.ended = False
+        # The worker gave up on a full ring, frames after the last one reported are missing
+        self.stalled = False
+        self.cancelled = False
+        # Time of the last report of the worker, or of the submit
+        self.last_report = time.time()
+        self.condition = threading.Condition()
+
+    def next_frame(self, timeout:float=READ_TIMEOUT):
+        """Next frame, or None at end of segment, or when the worker doesn't report one in time"""
+        with self.condition:
+            self.condition.wait_for(lambda: self.frames or self.ended, timeout)
+            return self.frames.popleft() if self.frames else None
+
+    def wait_meta(self, timeout:float=READ_TIMEOUT):
+        """Wait for frame count and fps. Returns False if the worker hasn't reported them yet"""
+        with self.condition:
+            return self.condition.wait_for(lambda: self.has_meta or self.ended, timeout)
+
+    def is_lost(self):
+        """The worker hasn't reported on the unfinished segment for WORKER_TIMEOUT, it died"""
+        with self.condition:
+            return not self.ended and time.time() - self.last_report > WORKER_TIMEOUT
+
+    def is_late(self):
+        """No frame is left, but the worker is still decoding the segment"""
+        with self.condition:
+            return not self.frames and not self.ended and not self.is_lost()
+
+    def is_incomplete(self):
+        """No frame is left, but the segment isn't over: the worker stalled or was lost"""
+        with self.condition:
+            return not self.frames and (self.stalled or self.is_lost())
+
+    def cancel(self):
+        """Drop frames not read yet, and those still to come"""
+        with self.condition:
+            self.cancelled = True
+            frames = list(self.frames)
+            self.frames.clear()
+        for frame in frames:
+            frame.release()
+
+class PipelineCapture(object):
+    """Stands in for cv2.VideoCapture in the camera. read() returns EncodedFrames"""
+    def __init__(self, job:SegmentJob):
+        self.job = job
+
+    def get(self, prop:int):
+        """Frame count and fps, once the worker has opened the segment. Cameras check
+        ready() first, 0 if the worker hasn't reported them yet"""
+        self.job.wait_meta()
+        if prop == cv2.CAP_PROP_FRAME_COUNT:
+            return self.job.frame_count
+        if prop == cv2.CAP_PROP_FPS:
+            return self.job.fps
+        return 0
+
+    def set(self, prop:int, value):
+        """Seeking is done by the worker, from the start frame of the job"""
+        return prop == cv2.CAP_PROP_POS_FRAMES and value == self.job.start_frame
+
+    def read(self):
+        """(success, EncodedFrame). Not successful at the end of the segment,
+        when the frame is late(), or when it's incomplete(): frames are missing, not over"""
+        frame = self.job.next_frame()
+        return frame is not None, frame
+
+    def late(self):
+        """The last read failed because the worker hasn't written the frame yet"""
+        return self.job.is_late()
+
+    def incomplete(self):
+        """The last read failed because the worker stalled or was lost, not at the end of the segment"""
+        return self.job.is_incomplete()
+
+    def resubmit(self, pipeline, start_frame:int):
+        """Read the rest of the segment from a new job, from start_frame"""
+        self.job.cancel()
+        self.job = pipeline.submit(self.job.camera_ring, self.job.path, start_frame)
+
+    def release(self):
+        """Stop reading the segment"""
+        self.job.cancel()
+
+class FrameWorker(object):
+    """A worker process and the cameras whose rings it writes"""
+    def __init__(self, context, results, tier, stop_event):
+        self.context = context
+        self.results = results
+        self.tier = tier
+        self.stop_event = stop_event
+        self.tasks = None
+        self.process = None
+        self.cameras = 0
+        self.jobs = 0
+        self.restarts = 0
+        self._create()
+
+    def _create(self):
+        """New task queue and process. Rings are attached by the process as jobs come"""
+        self.tasks = self.context.Queue()
+        self.process = self.context.Process(target=worker_main,
+            args=(self.tasks, self.results, self.tier, self.stop_event),
+            name="frame-worker", daemon=True)
+
+    def start(self):
+        """Start the process"""
+        self.process.start()
+
+    def restart(self):
+        """Replace a process that died. Its queued jobs are lost, their cameras submit them again"""
+        self.restarts += 1
+        print(f"Frame worker {self.process.pid} exited with {self.process.exitcode}, restarting")
+        self._create()
+        self.start()
+
+class FramePipeline(object):
+    """Worker processes decoding and encoding segments for all cameras.
+    Each camera gets a ring of ring_size bytes, written by one worker"""
+    def __init__(self, workers:int=2, tier=None, ring_size:int=16 * 1024 * 1024):
+        # Imported here, tiers imports metrics like this module
+        from tiers import EncodeTier
+        self.tier = tier or EncodeTier("full")
+        self.ring_size = ring_size
+        # Spawned, the serving process has threads and cv2 state a fork would copy
+        context = multiprocessing.get_context("spawn")
+        self.results = context.Queue()
+        self.stop_event = context.Event()
+        self.workers = [FrameWorker(context, self.results, self.tier, self.stop_event)
+            for _ in range(workers)]
+        self.rings = []
+        self.jobs = {}
+        self.job_ids = itertools.count()
+        self.lock = threading.Lock()
+        self.collector = threading.Thread(target=self._collect, name="frame-collector", daemon=True)
+        self.started = False
+
+    def __str__(self):
+        return f"Frame pipeline. Workers: {len(self.workers)}, Cameras: {len(self.rings)}, Jobs: {len(self.jobs)}"
+
+    def start(self):
+        """Start the worker processes"""
+        if not self.started:
+            for worker in self.workers:
+                worker.start()
+            self.collector.start()
+            self.started = True
+        return self
+
+    def stop(self):
+        """Stop the workers and remove the rings"""
+        self.stop_event.set()
+        for worker in self.workers:
+            worker.tasks.put(None)
+        for worker in self.workers:
+            worker.process.join(5)
+        self.results.put(None)
+        with self.lock:
+            rings, self.rings = self.rings, []
+        for camera_ring in rings:
+            with camera_ring.lock:
+                camera_ring.ring.close(unlink=True)
+
+    def attach(self):
+        """Ring for a new camera, on the worker with the fewest cameras"""
+        with self.lock:
+            worker = min(self.workers, key=lambda worker: worker.cameras)
+            worker.cameras += 1
+            camera_ring = CameraRing(self, worker, self.ring_size)
+            self.rings.append(camera_ring)
+        return camera_ring
+
+    def detach(self, camera_ring:CameraRing):
+        """Remove the ring of a camera. Its worker lets go of it after its queued jobs"""
+        with self.lock:
+            if camera_ring not in self.rings:
+                return
+            self.rings.remove(camera_ring)
+            camera_ring.worker.cameras -= 1
+        camera_ring.worker.tasks.put(('detach', camera_ring.ring.name))
+        with camera_ring.lock:
+            camera_ring.ring.close(unlink=True)
+
+    def submit(self, camera_ring:CameraRing, path: os.PathLike, start_frame:int=0):
+        """Queue a segment for decoding into a camera ring. Returns its job"""
+        worker = camera_ring.worker
+        with self.lock:
+            if self.started and not worker.process.is_alive() and not self.stop_event.is_set():
+                worker.restart()
+            job_id = next(self.job_ids)
+            worker.jobs += 1
+            job = SegmentJob(job_id, camera_ring, path, start_frame)
+            self.jobs[job_id] = job
+        worker.tasks.put(('job', job_id, os.fspath(path), start_frame, camera_ring.ring.name,
+            camera_ring.ring.capacity))
+        return job
+
+    def _collect(self):
+        """Collector thread: hand worker reports to their jobs"""
+        while True:
+            message = self.results.get()
+            if message is None:
+                break
+            kind, job_id = message[0], message[1]
+            with self.lock:
+                job = self.jobs.get(job_id)
+            if job is None:
+                continue
+            camera_ring = job.camera_ring
+            with job.condition:
+                job.last_report = time.time()
+            if kind == 'meta':
+                with job.condition:
+                    job.frame_count, job.fps = message[2], message[3]
+                    job.has_meta = True
+                    job.condition.notify_all()
+            elif kind == 'frame':
+                _, _, position, length, read_time, encode_time = message
+                metrics.FRAME_READ.observe(read_time)
+                metrics.FRAME_ENCODE.observe(encode_time)
+                self.tier.record(encode_time, length)
+                with camera_ring.lock:
+                    if camera_ring.ring.closed:
+                        # The camera was cleaned while the worker was writing
+                        continue
+                    frame = EncodedFrame(camera_ring, position, length)
+                    camera_ring.outstanding.append(frame)
+                with job.condition:
+                    cancelled = job.cancelled
+                    if not cancelled:
+                        job.frames.append(frame)
+                        job.condition.notify_all()
+                if cancelled:
+                    frame.release()
+            elif kind == 'end':
+                with job.condition:
+                    job.ended = True
+                    job.stalled = message[2]
+                    job.has_meta = True
+                    job.condition.notify_all()
+                with self.lock:
+                    del self.jobs[job_id]
+                    camera_ring.worker.jobs -= 1
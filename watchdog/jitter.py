@@ -0,0 +1,120 @@
+"""Module to balance segment arrival rate against playback rate"""
+import time
+from collections import deque
+
+class JitterBuffer(object):
+    """Measure how fast segments arrive compared to how fast they are played,
+    and suggest a playback rate that keeps the buffer near its target"""
+    def __init__(self, target_buffer:float=0.5, max_rate_adjust:float=0.05, gain:float=0.5,
+                 underrun_growth:float=1.5, max_target_buffer:float=5.0, window:int=30,
+                 smoothing:float=0.1):
+        # Seconds of video we try to keep queued ahead of playback
+        self.target_buffer = target_buffer
+        self.max_target_buffer = max_target_buffer
+        self.underrun_growth = underrun_growth
+        # Playback speed stays within 1 +/- max_rate_adjust
+        self.max_rate_adjust = max_rate_adjust
+        self.gain = gain
+        # Rate changes are smoothed, buffered frames change in whole segments
+        self.smoothing = smoothing
+        self.arrivals = deque(maxlen=window)
+        self.fps = 0.0
+        self.segments_loaded = 0
+        self.frames_loaded = 0
+        self.rate = 1.0
+        self.logged_rate = 1.0
+        # Underruns
+        self.underruns = 0
+        self.in_underrun = False
+        self.underrun_start = 0
+        self.underrun_time = 0.0
+        self.rate_adjustments = 0
+        # Logging
+        self.log_progress = True
+
+    def __str__(self):
+        return f"Jitter buffer. Target: {self.target_buffer:.2f}s, Rate: {self.rate:.3f}, " \
+            f"Arrival fps: {self.arrival_fps():.2f}, Playback fps: {self.fps:.2f}, " \
+            f"Underruns: {self.underruns} ({self.underrun_time:.2f}s)"
+
+    def reset(self):
+        """Forget previous run arrivals. Keep learned fps and target buffer"""
+        self.arrivals.clear()
+        self.segments_loaded = 0
+        self.frames_loaded = 0
+        self.rate = 1.0
+        self.logged_rate = 1.0
+        self.in_underrun = False
+
+    def on_segment_arrival(self, arrival_time:float):
+        """A segment was added to the queue"""
+        self.arrivals.append(arrival_time)
+
+    def on_segment_loaded(self, frame_count:int, fps:float):
+        """A segment was opened, we now know its real frame count and fps"""
+        if fps > 0:
+            self.fps = fps
+        self.segments_loaded += 1
+        self.frames_loaded += max(frame_count, 0)
+
+    def frames_per_segment(self, default:float=2.0):
+        """Average frames per loaded segment"""
+        if not self.segments_loaded or not self.frames_loaded:
+            return default
+        return self.frames_loaded / self.segments_loaded
+
+    def segment_rate(self):
+        """Segments per second produced, from recent arrivals. 0 if unknown"""
+        if len(self.arrivals) < 2:
+            return 0.0
+        elapsed = self.arrivals[-1] - self.arrivals[0]
+        if elapsed <= 0:
+            return 0.0
+        return (len(self.arrivals) - 1) / elapsed
+
+    def arrival_fps(self):
+        """Frames per second produced, from recent arrivals. 0 if unknown"""
+        return self.segment_rate() * self.frames_per_segment()
+
+    def start_delay(self):
+        """Seconds of video to buffer before starting playback"""
+        return self.target_buffer
+
+    def update(self, buffered_frames:float, rendering:bool=True):
+        """Returns the playback rate multiplier for the next frame"""
+        if self.in_underrun:
+            self.in_underrun = False
+            self.underrun_time += time.time() - self.underrun_start
+        if self.fps <= 0:
+            return self.rate
+        rate = 1.0
+        if rendering:
+            # Follow the producer, and correct towards the target buffer
+            arrival_fps = self.arrival_fps()
+            if arrival_fps > 0:
+                rate = arrival_fps / self.fps
+            buffered = buffered_frames / self.fps
+            error = (buffered - self.target_buffer) / self.target_buffer
+            rate *= 1.0 + self.gain * error
+        rate = min(max(rate, 1.0 - self.max_rate_adjust), 1.0 + self.max_rate_adjust)
+        self.rate += self.smoothing * (rate - self.rate)
+        if abs(self.rate - self.logged_rate) >= 0.02:
+            self.rate_adjustments += 1
+            if self.log_progress:
+                print(f"Playback rate adjusted: {self.logged_rate:.3f} -> {self.rate:.3f}. " \
+                    f"Buffered: {buffered_frames:.0f} frames, {self}")
+            self.logged_rate = self.rate
+        return self.rate
+
+    def on_underrun(self):
+        """Playback ran out of frames while segments were still expected"""
+        if self.in_underrun:
+            return
+        self.in_underrun = True
+        self.underrun_start = time.time()
+        self.underruns += 1
+        previous_target = self.target_buffer
+        self.target_buffer = min(self.target_buffer * self.underrun_growth, self.max_target_buffer)
+        if self.log_progress:
+            print(f"Underrun {self.underruns}. Target buffer: {previous_target:.2f}s -> " \
+                f"{self.target_buffer:.2f}s. Arrival fps: {self.arrival_fps():.2f}")
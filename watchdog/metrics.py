@@ -0,0 +1,291 @@
+"""Module with stream health metrics, exposed in Prometheus text format"""
+import os
+import math
+import threading
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.0, 5.0, 10.0, 20.0, 30.0, 60.0, 120.0)
+BYTES_BUCKETS = (4096, 8192, 16384, 32768, 65536, 131072, 262144, 524288, 1048576)
+
+def format_labels(label_names:tuple, label_values:tuple, extra:dict=None):
+    """Prometheus label set: {name="value",...}"""
+    labels = list(zip(label_names, label_values)) + list((extra or {}).items())
+    if not labels:
+        return ""
+    escaped = [(name, str(value).replace('\\', '\\\\').replace('"', '\\"')) for name, value in labels]
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+def format_value(value:float):
+    """Prometheus number"""
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value))
+
+class Metric(object):
+    """Base metric, with one child per set of label values"""
+    kind = "untyped"
+
+    def __init__(self, name:str, documentation:str, label_names:tuple=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.children = {}
+        self.lock = threading.Lock()
+
+    def labels(self, *label_values):
+        """Child metric for label values"""
+        label_values = tuple(str(value) for value in label_values)
+        with self.lock:
+            child = self.children.get(label_values)
+            if child is None:
+                child = self._new_child()
+                self.children[label_values] = child
+            return child
+
+    def remove(self, *label_values):
+        """Drop a child, e.g. of a cleaned session"""
+        with self.lock:
+            self.children.pop(tuple(str(value) for value in label_values), None)
+
+    def remove_matching(self, label_name:str, value):
+        """Drop every child whose label_name is value"""
+        if label_name not in self.label_names:
+            return
+        position = self.label_names.index(label_name)
+        with self.lock:
+            for label_values in [label_values for label_values in self.children
+                    if label_values[position] == str(value)]:
+                del self.children[label_values]
+
+    def _default(self):
+        """Child without labels"""
+        return self.labels()
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def render(self):
+        """Prometheus text lines"""
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with self.lock:
+            children = list(self.children.items())
+        for label_values, child in children:
+            lines.extend(child.render(self.name, self.label_names, label_values))
+        return lines
+
+class _Value(object):
+    """Counter or gauge value"""
+    def __init__(self):
+        self.value = 0.0
+        self.lock = threading.Lock()
+
+    def inc(self, amount:float=1.0):
+        """Increase value"""
+        with self.lock:
+            self.value += amount
+
+    def dec(self, amount:float=1.0):
+        """Decrease value"""
+        with self.lock:
+            self.value -= amount
+
+    def set(self, value:float):
+        """Set value"""
+        with self.lock:
+            self.value = value
+
+    def render(self, name:str, label_names:tuple, label_values:tuple):
+        """Prometheus text lines"""
+        return [f"{name}{format_labels(label_names, label_values)} {format_value(self.value)}"]
+
+class Counter(Metric):
+    """Monotonic counter"""
+    kind = "counter"
+
+    def _new_child(self):
+        return _Value()
+
+    def inc(self, amount:float=1.0):
+        """Increase counter without labels"""
+        self._default().inc(amount)
+
+    def get(self):
+        """Value of the counter without labels"""
+        return self._default().value
+
+class Gauge(Metric):
+    """Value that goes up and down"""
+    kind = "gauge"
+
+    def _new_child(self):
+        return _Value()
+
+    def set(self, value:float):
+        """Set gauge without labels"""
+        self._default().set(value)
+
+    def inc(self, amount:float=1.0):
+        """Increase gauge without labels"""
+        self._default().inc(amount)
+
+    def dec(self, amount:float=1.0):
+        """Decrease gauge without labels"""
+        self._default().dec(amount)
+
+    def get(self):
+        """Value of the gauge without labels"""
+        return self._default().value
+
+class _HistogramValue(object):
+    """Histogram buckets, sum and count"""
+    def __init__(self, buckets:tuple):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def observe(self, value:float):
+        """Record an observation"""
+        with self.lock:
+            self.sum += value
+            self.count += 1
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    self.counts[i] += 1
+
+    def render(self, name:str, label_names:tuple, label_values:tuple):
+        """Prometheus text lines, buckets are cumulative"""
+        with self.lock:
+            counts, total, count = list(self.counts), self.sum, self.count
+        lines = [f"{name}_bucket{format_labels(label_names, label_values, {'le': format_value(bound)})} {bucket_count}"
+            for bound, bucket_count in zip(self.buckets, counts)]
+        lines.append(f"{name}_bucket{format_labels(label_names, label_values, {'le': '+Inf'})} {count}")
+        lines.append(f"{name}_sum{format_labels(label_names, label_values)} {format_value(total)}")
+        lines.append(f"{name}_count{format_labels(label_names, label_values)} {count}")
+        return lines
+
+class Histogram(Metric):
+    """Distribution of observations in buckets"""
+    kind = "histogram"
+
+    def __init__(self, name:str, documentation:str, label_names:tuple=(), buckets:tuple=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, label_names)
+        self.buckets = tuple(sorted(buckets))
+
+    def _new_child(self):
+        return _HistogramValue(self.buckets)
+
+    def observe(self, value:float):
+        """Record an observation without labels"""
+        self._default().observe(value)
+
+def get_rss():
+    """Resident memory of this process in bytes"""
+    try:
+        with open("/proc/self/statm", "r", encoding="utf-8") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        import resource # Peak instead of current, where /proc is not available
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def get_open_fds():
+    """Open file descriptors of this process, or -1 where /proc is not available"""
+    try:
+        return len(os.listdir("/proc/self/fd"))
+    except OSError:
+        return -1
+
+class MetricsRegistry(object):
+    """Collection of metrics rendered together"""
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def register(self, metric:Metric):
+        """Add a metric. Names are unique"""
+        with self.lock:
+            if metric.name in self.metrics:
+                raise ValueError(f"Metric already registered: {metric.name}")
+            self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name:str, documentation:str, label_names:tuple=()):
+        """Register a counter"""
+        return self.register(Counter(name, documentation, label_names))
+
+    def gauge(self, name:str, documentation:str, label_names:tuple=()):
+        """Register a gauge"""
+        return self.register(Gauge(name, documentation, label_names))
+
+    def histogram(self, name:str, documentation:str, label_names:tuple=(), buckets:tuple=DEFAULT_BUCKETS):
+        """Register a histogram"""
+        return self.register(Histogram(name, documentation, label_names, buckets))
+
+    def remove_matching(self, label_name:str, value):
+        """Drop children of every metric whose label_name is value, e.g. all of a cleaned session"""
+        with self.lock:
+            metrics = list(self.metrics.values())
+        for metric in metrics:
+            metric.remove_matching(label_name, value)
+
+    def render(self):
+        """All metrics in Prometheus text format"""
+        with self.lock:
+            metrics = list(self.metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+# Watchdog stream metrics
+REGISTRY = MetricsRegistry()
+AUDIO_TO_FIRST_SEGMENT = REGISTRY.histogram("watchdog_audio_to_first_segment_seconds",
+    "Time from temp.wav being written to the first video segment", ("session",), LATENCY_BUCKETS)
+SEGMENT_INTERARRIVAL = REGISTRY.histogram("watchdog_segment_interarrival_seconds",
+    "Time between consecutive video segments being captured", ("session",))
+CAPTURE_LAG = REGISTRY.histogram("watchdog_capture_lag_seconds",
+    "Time from a file being closed to being captured")
+VIDEO_QUEUE_DEPTH = REGISTRY.gauge("watchdog_video_queue_depth",
+    "Video segments waiting in the camera queue", ("session",))
+FRAME_READ = REGISTRY.histogram("watchdog_frame_read_seconds",
+    "Time to decode a frame from a video segment")
+FRAME_ENCODE = REGISTRY.histogram("watchdog_frame_encode_seconds",
+    "Time to encode a frame as jpeg")
+PACING_ERROR = REGISTRY.histogram("watchdog_pacing_error_seconds",
+    "Absolute difference between actual and expected play time of a frame")
+FRAMES_PLAYED = REGISTRY.counter("watchdog_frames_played_total",
+    "Frames sent to viewers", ("session",))
+FRAMES_DROPPED = REGISTRY.counter("watchdog_frames_dropped_total",
+    "Frames dropped", ("stage",))
+FRAMES_DUPLICATED = REGISTRY.counter("watchdog_frames_duplicated_total",
+    "Frames repeated because no new frame was ready", ("session",))
+UNDERRUNS = REGISTRY.counter("watchdog_underruns_total",
+    "Times playback ran out of frames while rendering", ("session",))
+PIPELINE_STALLS = REGISTRY.counter("watchdog_pipeline_stalls_total",
+    "Segments submitted again because the frame pipeline stalled on them", ("session",))
+VIEWERS = REGISTRY.gauge("watchdog_viewers_connected",
+    "Connected viewers", ("session", "stream"))
+TIER_ENCODE = REGISTRY.histogram("watchdog_tier_encode_seconds",
+    "Time to scale and encode a frame into a tier", ("tier",))
+TIER_FRAME_BYTES = REGISTRY.histogram("watchdog_tier_frame_bytes",
+    "Encoded frame size of a tier", ("tier",), BYTES_BUCKETS)
+TIER_FRAMES_SENT = REGISTRY.counter("watchdog_tier_frames_sent_total",
+    "Frames sent to viewers, by tier", ("tier",))
+TIER_SWITCHES = REGISTRY.counter("watchdog_tier_switches_total",
+    "Automatic tier changes of lagging or recovered viewers", ("direction",))
+OPEN_CAPTURES = REGISTRY.gauge("watchdog_open_captures",
+    "Video captures currently open")
+CAPTURES_OPENED = REGISTRY.counter("watchdog_captures_opened_total",
+    "Video captures opened, one per played segment")
+CAPTURES_REUSED = REGISTRY.counter("watchdog_captures_reused_total",
+    "Video captures reopened on a new segment instead of created")
+PROCESS_OPEN_FDS = REGISTRY.gauge("watchdog_process_open_fds",
+    "Open file descriptors of the watchdog process")
+PROCESS_RSS = REGISTRY.gauge("watchdog_process_resident_memory_bytes",
+    "Resident memory of the watchdog process")
+
+def update_process_metrics():
+    """Sample process resources, before rendering"""
+    PROCESS_OPEN_FDS.set(get_open_fds())
+    PROCESS_RSS.set(get_rss())
@@ -0,0 +1,75 @@
+"""Module to start buffered playback as soon as the render can keep up"""
+import time
+from camera import VideoCamera, CameraStatus
+
+class PrerollPlanner(object):
+    """Project the remaining render time from the measured segment rate,
+    and start playback once it fits inside the playback time"""
+    def __init__(self, safety_margin:float=0.15, min_segments:int=3):
+        # Remaining render time is inflated by this fraction, for rate variations
+        self.safety_margin = safety_margin
+        # Segments needed before the production rate is trusted
+        self.min_segments = min_segments
+        # Logging
+        self.log_progress = True
+
+    def __str__(self):
+        return f"Pre-roll planner. Safety margin: {self.safety_margin}, Min segments: {self.min_segments}"
+
+    def projection(self, camera:VideoCamera, now:float):
+        """Projected render and playback times, if playback started now"""
+        jitter = camera.jitter
+        fps = camera.get_frame_rate()
+        remaining_videos = max(camera.expected_videos - camera.videos_received, 0)
+        segment_rate = jitter.segment_rate()
+        remaining_render = remaining_videos / segment_rate if segment_rate > 0 else float('inf')
+        # The last video is needed once everything before it has been played
+        play_until_last = max(camera.expected_videos - 1, 0) * jitter.frames_per_segment() / fps \
+            if fps > 0 else 0.0
+        return {
+            'time': now,
+            'videos_received': camera.videos_received,
+            'remaining_videos': remaining_videos,
+            'segment_rate': segment_rate,
+            'remaining_render': remaining_render,
+            'play_until_last': play_until_last,
+            'buffered': camera.buffered_frames() / fps if fps > 0 else 0.0,
+            'start_delay': jitter.start_delay()
+        }
+
+    def is_safe(self, projection:dict):
+        """Playback can start now without stalling"""
+        if projection['remaining_videos'] == 0:
+            return True
+        if projection['videos_received'] < self.min_segments:
+            return False
+        if projection['buffered'] < min(projection['start_delay'], projection['play_until_last']):
+            return False
+        return projection['remaining_render'] * (1.0 + self.safety_margin) <= projection['play_until_last']
+
+    def maybe_start(self, camera:VideoCamera, force:bool=False, on_start=None):
+        """Move a buffering camera to playing when safe. Returns True if started.
+        on_start(camera) is called right before playback starts"""
+        if camera.status != CameraStatus.BUFFERING:
+            return False
+        now = time.time()
+        projection = self.projection(camera, now)
+        if not force and not self.is_safe(projection):
+            return False
+        camera.run_report = {
+            'preroll': now - camera.video_start,
+            'latency': now - camera.audio_start,
+            'audio_to_first_video': camera.video_start - camera.audio_start,
+            'forced': force,
+            **projection
+        }
+        if on_start:
+            on_start(camera)
+        camera.set_status(CameraStatus.PLAYING)
+        if self.log_progress:
+            print(f"Auto start. Pre-roll: {camera.run_report['preroll']:.3f}s, " \
+                f"Audio to playback latency: {camera.run_report['latency']:.3f}s, " \
+                f"Videos: {projection['videos_received']}/{camera.expected_videos}, " \
+                f"Remaining render: {projection['remaining_render']:.2f}s, " \
+                f"Play until last: {projection['play_until_last']:.2f}s")
+        return True
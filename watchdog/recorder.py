@@ -0,0 +1,180 @@
+"""Module to archive the live stream on background workers, off the frame delivery path"""
+import os
+import time
+import queue
+import shutil
+import threading
+import subprocess
+import cv2
+
+class BackgroundWriter(object):
+    """Write files on a worker thread. Writes are dropped when the queue is full"""
+    def __init__(self, max_queue:int=256):
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.written = 0
+        self.dropped = 0
+        self.thread = threading.Thread(target=self._run, name="background-writer", daemon=True)
+        self.thread.start()
+
+    def write(self, path: os.PathLike, data:bytes):
+        """Queue data to be written to path. Returns False if dropped"""
+        try:
+            self.queue.put_nowait((path, data))
+            return True
+        except queue.Full:
+            self.dropped += 1
+            return False
+
+    def stop(self):
+        """Finish queued writes and stop the worker"""
+        self.queue.put((None, None))
+        self.thread.join()
+
+    def _run(self):
+        """Worker: write queued files"""
+        while True:
+            path, data = self.queue.get()
+            if path is None:
+                return
+            try:
+                with open(path, 'wb') as f:
+                    f.write(data)
+                self.written += 1
+            except OSError as e:
+                print(f"Background write failed for {path}: {e}")
+
+class StreamRecorder(object):
+    """Encode played frames into one mp4, aligned to the stream audio.
+    Frames are placed by the time they were played, so underruns and rate changes
+    are kept as they were seen, in sync with the audio"""
+    def __init__(self, output_path: os.PathLike, fps:float, audio_path: os.PathLike=None,
+                 audio_offset:float=0.0, max_queue:int=300, ffmpeg:str=None):
+        self.output_path = os.fspath(output_path)
+        self.fps = fps
+        self.audio_path = os.fspath(audio_path) if audio_path else None
+        self.audio_offset = audio_offset
+        self.ffmpeg = ffmpeg or shutil.which("ffmpeg")
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.start_time = 0
+        self.stopped = False
+        self.finished = False
+        # Stats
+        self.pushed = 0
+        self.written = 0
+        self.dropped = 0
+        self.duplicated = 0
+        self.skipped = 0
+        self.last_lag = 0.0
+        self.thread = threading.Thread(target=self._run, name="stream-recorder", daemon=True)
+
+    def __str__(self):
+        return f"Stream recorder: {self.output_path}. Written: {self.written}, " \
+            f"Dropped: {self.dropped}, Duplicated: {self.duplicated}, Lag: {self.lag():.3f}s"
+
+    def start(self):
+        """Start the encoding worker. Frame times are relative to now"""
+        self.start_time = time.time()
+        os.makedirs(os.path.dirname(self.output_path) or ".", exist_ok=True)
+        self.thread.start()
+        print(f"Recording stream to: {self.output_path}")
+        return self
+
+    def push(self, image, play_time:float=None):
+        """Queue a played frame, an image or a TieredFrame decoded on the recorder thread.
+        Never blocks, frames are dropped if the encoder falls behind"""
+        if self.stopped:
+            return False
+        play_time = time.time() if play_time is None else play_time
+        try:
+            self.queue.put_nowait((image, play_time))
+        except queue.Full:
+            self.dropped += 1
+            return False
+        self.pushed += 1
+        return True
+
+    def stop(self):
+        """Stop recording. Queued frames are still encoded, then audio is muxed"""
+        if self.stopped:
+            return
+        self.stopped = True
+        self.queue.put((None, None))
+
+    def join(self, timeout:float=None):
+        """Wait for the recording to be written"""
+        self.thread.join(timeout)
+
+    def lag(self):
+        """Seconds between the last encoded frame being played and being encoded"""
+        return self.last_lag
+
+    def stats(self):
+        """Recorder lag and counters"""
+        return {
+            'path': self.output_path,
+            'queued': self.queue.qsize(),
+            'lag': self.lag(),
+            'pushed': self.pushed,
+            'written': self.written,
+            'dropped': self.dropped,
+            'duplicated': self.duplicated,
+            'finished': self.finished
+        }
+
+    def _run(self):
+        """Worker: encode frames at the index matching their play time"""
+        video_path = os.path.splitext(self.output_path)[0] + ".video.mp4"
+        writer = None
+        last_image = None
+        while True:
+            image, play_time = self.queue.get()
+            if image is None:
+                break
+            self.last_lag = time.time() - play_time
+            frame_index = round((play_time - self.start_time) * self.fps)
+            if frame_index < self.written:
+                # Played faster than the recording fps
+                self.skipped += 1
+                continue
+            # Frames of the pipeline are only jpegs, decoded here off the camera lock
+            image = getattr(image, 'image', image)
+            if writer is None:
+                height, width = image.shape[:2]
+                writer = cv2.VideoWriter(video_path, cv2.VideoWriter_fourcc(*'mp4v'),
+                    self.fps, (width, height))
+            # Hold the previous frame over underruns
+            while last_image is not None and self.written < frame_index:
+                writer.write(last_image)
+                self.written += 1
+                self.duplicated += 1
+            writer.write(image)
+            self.written += 1
+            last_image = image
+        if writer is None:
+            print("Recording stopped without frames")
+            self.finished = True
+            return
+        writer.release()
+        self._mux(video_path)
+        self.finished = True
+        print(f"Recording finished. {self}")
+
+    def _mux(self, video_path: os.PathLike):
+        """Add the audio to the encoded video"""
+        if not self.audio_path or not os.path.exists(self.audio_path) or not self.ffmpeg:
+            if self.audio_path:
+                print("Recording saved without audio. ffmpeg or audio file not found")
+            os.replace(video_path, self.output_path)
+            return
+        command = [self.ffmpeg, "-y", "-loglevel", "error",
+            "-i", video_path,
+            "-ss", str(self.audio_offset), "-i", self.audio_path,
+            "-map", "0:v:0", "-map", "1:a:0",
+            "-c:v", "libx264", "-pix_fmt", "yuv420p", "-c:a", "aac",
+            "-shortest", "-movflags", "+faststart", self.output_path]
+        result = subprocess.run(command, capture_output=True, check=False)
+        if result.returncode != 0:
+            print(f"Recording audio mux failed, saved without audio: {result.stderr.decode(errors='ignore')}")
+            os.replace(video_path, self.output_path)
+            return
+        os.remove(video_path)
@@ -0,0 +1,194 @@
+"""Module to keep a persistent index of captured video segments"""
+import os
+import json
+import threading
+import cv2
+
+SEGMENT_INDEX_FILE = "segments.jsonl"
+
+def get_segment_number(path: os.PathLike):
+    """Returns the numeric index of a segment file (`12.avi` -> 12), or None"""
+    name, _ = os.path.splitext(os.path.basename(path))
+    return int(name) if name.isdigit() else None
+
+def probe_video(path: os.PathLike):
+    """Returns (frame_count, fps) of a video file"""
+    vidcap = cv2.VideoCapture(os.fspath(path))
+    try:
+        return int(vidcap.get(cv2.CAP_PROP_FRAME_COUNT)), vidcap.get(cv2.CAP_PROP_FPS)
+    finally:
+        vidcap.release()
+
+class SegmentIndex(object):
+    """Append-only JSON lines record of captured segments and their audio.
+    Written during capture so replay doesn't need to walk and probe the copied files"""
+    def __init__(self, index_path: os.PathLike):
+        self.index_path = os.fspath(index_path)
+        self.segments = {}
+        self.audio = None
+        self.lock = threading.Lock()
+        # Running start frame, for start PTS of the next segment
+        self.next_start_frame = 0
+        self.last_number = -1
+
+    def __str__(self):
+        return f"Segment index: {self.index_path}. Segments: {len(self.segments)}, " \
+            f"Gaps: {len(self.gaps())}, Duration: {self.duration():.3f}s"
+
+    def __len__(self):
+        return len(self.segments)
+
+    def reset(self):
+        """Forget all segments, for a new run"""
+        with self.lock:
+            self.segments = {}
+            self.audio = None
+            self.next_start_frame = 0
+            self.last_number = -1
+
+    def add_audio(self, path: os.PathLike, duration:float):
+        """Record the audio of the run"""
+        record = {'kind': 'audio', 'path': os.fspath(path), 'duration': duration}
+        with self.lock:
+            self.audio = record
+            self._append(record)
+        return record
+
+    def add_segment(self, path: os.PathLike, frame_count:int=None, fps:float=None):
+        """Record a captured segment. Frame count and fps are probed if not given"""
+        number = get_segment_number(path)
+        if number is None:
+            return None
+        if frame_count is None or fps is None:
+            frame_count, fps = probe_video(path)
+        with self.lock:
+            if number > self.last_number:
+                # Missing segments in between are assumed to have average length
+                missing = number - self.last_number - 1
+                start_frame = self.next_start_frame + round(missing * self.frames_per_segment())
+            else:
+                # Arrived out of order
+                start_frame = round(number * self.frames_per_segment())
+            record = {
+                'kind': 'segment',
+                'index': number,
+                'path': os.fspath(path),
+                'frame_count': frame_count,
+                'fps': fps,
+                'start_frame': start_frame,
+                'start_pts': start_frame / fps if fps > 0 else 0.0
+            }
+            self.segments[number] = record
+            if number > self.last_number:
+                self.last_number = number
+                self.next_start_frame = start_frame + frame_count
+            self._append(record)
+        return record
+
+    def _append(self, record:dict):
+        """Append a record to the index file"""
+        os.makedirs(os.path.dirname(self.index_path) or ".", exist_ok=True)
+        with open(self.index_path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(record) + "\n")
+
+    @classmethod
+    def load(cls, index_path: os.PathLike):
+        """Read an index file. Later records of the same segment win"""
+        index = cls(index_path)
+        if not os.path.exists(index.index_path):
+            return index
+        with open(index.index_path, "r", encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # Partial last line, if the writer was interrupted
+                    continue
+                if record.get('kind') == 'audio':
+                    index.audio = record
+                elif record.get('kind') == 'segment':
+                    index.segments[record['index']] = record
+        if index.segments:
+            last = index.segments[max(index.segments)]
+            index.last_number = last['index']
+            index.next_start_frame = last['start_frame'] + last['frame_count']
+        return index
+
+    @classmethod
+    def build(cls, index_path: os.PathLike, video_dir: os.PathLike, audio_path: os.PathLike=None,
+              audio_duration:float=None):
+        """Create an index from existing segment files, for copies made without one"""
+        if os.path.exists(index_path):
+            os.remove(index_path)
+        index = cls(index_path)
+        if audio_path:
+            index.add_audio(audio_path, audio_duration)
+        video_files = [os.path.join(video_dir, f) for f in os.listdir(video_dir)] \
+            if os.path.isdir(video_dir) else []
+        video_files = [f for f in video_files if get_segment_number(f) is not None]
+        video_files.sort(key=get_segment_number)
+        for path in video_files:
+            index.add_segment(path)
+        return index
+
+    def ordered(self):
+        """Segments in numeric order"""
+        return [self.segments[number] for number in sorted(self.segments)]
+
+    def gaps(self):
+        """Missing segment numbers, up to the last captured one"""
+        if not self.segments:
+            return []
+        return sorted(set(range(max(self.segments) + 1)) - set(self.segments))
+
+    def fps(self, default:float=0.0):
+        """Frame rate of the captured segments"""
+        for record in self.segments.values():
+            if record['fps'] > 0:
+                return record['fps']
+        return default
+
+    def frames_per_segment(self, default:float=2.0):
+        """Average frames per captured segment"""
+        frames = sum(record['frame_count'] for record in self.segments.values())
+        return frames / len(self.segments) if frames else default
+
+    def duration(self):
+        """Seconds of video, from start PTS of the last segment"""
+        if not self.segments:
+            return 0.0
+        last = self.segments[max(self.segments)]
+        fps = last['fps'] or self.fps()
+        return last['start_pts'] + (last['frame_count'] / fps if fps > 0 else 0.0)
+
+    def playlist(self, fill_gaps:bool=True):
+        """Segments in numeric order. Gaps are filled by repeating the previous segment,
+        which keeps later segments in sync with the audio"""
+        playlist = []
+        previous = None
+        for number in range(max(self.segments) + 1 if self.segments else 0):
+            record = self.segments.get(number)
+            if record is None:
+                if fill_gaps and previous:
+                    playlist.append({**previous, 'index': number, 'filled': True})
+                continue
+            playlist.append(record)
+            previous = record
+        return playlist
+
+    def seek(self, playlist:list, start:float):
+        """Returns (playlist position, frame offset in that segment) for a start time in seconds"""
+        fps = self.fps()
+        if start <= 0 or not playlist or fps <= 0:
+            return 0, 0
+        position_frame = 0
+        for position, record in enumerate(playlist):
+            # Filled gaps don't have their own start PTS
+            segment_start = record['start_frame'] if not record.get('filled') else position_frame
+            if start * fps < segment_start + record['frame_count']:
+                return position, max(int(start * fps) - segment_start, 0)
+            position_frame = segment_start + record['frame_count']
+        return len(playlist), 0
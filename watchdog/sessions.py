@@ -0,0 +1,170 @@
+"""Module to keep one camera and copy area per synthesis job"""
+import os
+import time
+import shutil
+import threading
+from pathlib import Path
+from camera import VideoCamera, CameraStatus
+from segment_index import SegmentIndex, SEGMENT_INDEX_FILE
+import metrics
+
+DEFAULT_SESSION = "default"
+OUTPUT_DIR = "output"
+
+def is_valid_key(key:str):
+    """Session keys name a single directory under the sessions copy path"""
+    return bool(key) and key not in (".", "..") and not any(c in key for c in "/\\\0")
+
+class Session(object):
+    """Camera and copied files of a single synthesis job"""
+    def __init__(self, key:str, copy_path: os.PathLike):
+        self.key = key
+        self.copy_path = Path(copy_path)
+        self.camera = VideoCamera(key)
+        self.index = SegmentIndex(self.copy_path / SEGMENT_INDEX_FILE)
+        self.created = time.time()
+        self.started = 0
+        self.finished = 0
+        self.cleanup_timer = None
+
+    def __str__(self):
+        return f"Session {self.key}. Copy path: {self.copy_path}. {self.camera}"
+
+    def is_finished(self):
+        """Render is done"""
+        return self.finished > 0
+
+    def to_dict(self):
+        """Session summary for display"""
+        return {
+            'session': self.key,
+            'status': self.camera.status.name,
+            'video_queue': len(self.camera.video_queue),
+            'playback_rate': self.camera.jitter.rate,
+            'target_buffer': self.camera.jitter.target_buffer,
+            'underruns': self.camera.jitter.underruns,
+            'started': self.started,
+            'finished': self.finished,
+            'run_report': self.camera.run_report,
+            'recorder': self.camera.recorder.stats() if self.camera.recorder else None
+        }
+
+class SessionRegistry(object):
+    """Sessions keyed by the watched directory holding the job `output` directory.
+    Files in `<VIDEO_TEMP_PATH>/output` belong to the default session,
+    files in `<VIDEO_TEMP_PATH>/<task>/output` belong to session `<task>`.
+    Deeper task directories, and a task named like the default session, are ignored"""
+    def __init__(self, default_copy_path: os.PathLike, sessions_copy_path: os.PathLike,
+                 retention:float=600):
+        self.default_copy_path = Path(default_copy_path)
+        self.sessions_copy_path = Path(sessions_copy_path)
+        self.retention = retention
+        self.sessions = {}
+        self.lock = threading.RLock()
+        # The default session always exists, for the single job setup and offline loading
+        self.get_or_create(DEFAULT_SESSION)
+
+    def __str__(self):
+        return f"Sessions: {list(self.sessions)}"
+
+    def __iter__(self):
+        with self.lock:
+            return iter(list(self.sessions.values()))
+
+    def split_path(self, rpath: os.PathLike):
+        """Split a watched relative path into session key and path relative to the session.
+        Returns (None, rpath) for files outside of any `output` directory"""
+        parts = Path(rpath).parts
+        if OUTPUT_DIR not in parts:
+            return None, rpath
+        output_index = parts.index(OUTPUT_DIR)
+        if output_index > 1 or parts[:output_index] == (DEFAULT_SESSION,):
+            # Joining nested directories would map different tasks to one session
+            print(f"Ignoring files of nested or reserved task directory: {Path(*parts[:output_index])}")
+            return None, rpath
+        key = parts[0] if output_index else DEFAULT_SESSION
+        if not is_valid_key(key):
+            print(f"Ignoring files of invalid session key: {key}")
+            return None, rpath
+        return key, Path(*parts[output_index:]).as_posix()
+
+    def get(self, key:str):
+        """Get existing session, or None"""
+        with self.lock:
+            return self.sessions.get(key)
+
+    def get_or_create(self, key:str):
+        """Get session, creating it if needed. Only watchdog events create sessions,
+        viewers get existing ones. Raises ValueError for keys outside the sessions copy path"""
+        with self.lock:
+            session = self.sessions.get(key)
+            if session is None:
+                copy_path = self.default_copy_path if key == DEFAULT_SESSION \
+                    else self.sessions_copy_path / key
+                if not is_valid_key(key) or (key != DEFAULT_SESSION and \
+                        copy_path.resolve().parent != self.sessions_copy_path.resolve()):
+                    raise ValueError(f"Invalid session key: {key}")
+                session = Session(key, copy_path)
+                self.sessions[key] = session
+                print(f"Created session: {key}")
+            return session
+
+    def start(self, key:str):
+        """Job `output` directory was created. Clean previous files of the session"""
+        with self.lock:
+            session = self.get_or_create(key)
+            if session.cleanup_timer:
+                session.cleanup_timer.cancel()
+                session.cleanup_timer = None
+            session.started = time.time()
+            session.finished = 0
+        print(f"Cleaning previous copied files of session: {key}")
+        if os.path.exists(session.copy_path):
+            shutil.rmtree(session.copy_path)
+        session.index.reset()
+        session.camera.clear_videos()
+        return session
+
+    def finish(self, key:str):
+        """Job `output` directory was deleted. Schedule cleanup once playback drains"""
+        session = self.get(key)
+        if session is None or session.is_finished():
+            return session
+        session.finished = time.time()
+        session.camera.render_complete = True
+        print(f"Session finished: {key}. Render time: {session.finished - session.started:.2f}s")
+        if session.camera.run_report:
+            print(f"Session {key} run report: Pre-roll: {session.camera.run_report['preroll']:.3f}s, " \
+                f"Audio to playback latency: {session.camera.run_report['latency']:.3f}s, " \
+                f"Underruns: {session.camera.jitter.underruns}")
+        # The default session keeps its files for offline loading, until the next job starts
+        if key != DEFAULT_SESSION and self.retention is not None:
+            self._schedule_cleanup(session, self.retention)
+        return session
+
+    def cleanup(self, key:str):
+        """Remove session copy area and camera"""
+        with self.lock:
+            session = self.sessions.get(key)
+            if session is None or key == DEFAULT_SESSION:
+                return
+            camera = session.camera
+            if camera.status == CameraStatus.PLAYING and (camera.video_queue or camera.video):
+                # Still being watched, try again later
+                self._schedule_cleanup(session, self.retention)
+                return
+            del self.sessions[key]
+        camera.set_status(CameraStatus.OFF)
+        camera.clear_videos()
+        camera.release_frame_ring()
+        # Sessions are per task, their metrics would pile up
+        metrics.REGISTRY.remove_matching("session", key)
+        if os.path.exists(session.copy_path):
+            shutil.rmtree(session.copy_path, ignore_errors=True)
+        print(f"Cleaned session: {key}")
+
+    def _schedule_cleanup(self, session:Session, delay:float):
+        """Run cleanup after a delay"""
+        session.cleanup_timer = threading.Timer(delay, self.cleanup, args=(session.key,))
+        session.cleanup_timer.daemon = True
+        session.cleanup_timer.start()
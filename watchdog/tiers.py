@@ -0,0 +1,150 @@
+"""Module with MJPEG quality and resolution tiers for viewers of different bandwidth.
+
+Each played frame keeps its decoded image, and is encoded into a tier the first time
+a viewer asks for it, so a tier is encoded at most once per frame whatever the number
+of viewers. Viewers pick a tier, or start at the top and step down while they fall behind"""
+import time
+import threading
+import cv2
+import numpy as np
+import metrics
+
+# Viewers that don't ask for a tier are switched automatically
+AUTO_TIER = "auto"
+
+class EncodeTier(object):
+    """Resolution scale and jpeg encode parameters of a tier"""
+    def __init__(self, name:str, scale:float=1.0, quality:int=95, optimize:bool=False, progressive:bool=False):
+        self.name = name
+        self.scale = scale
+        self.quality = quality
+        self.optimize = optimize
+        self.progressive = progressive
+
+    def __str__(self):
+        return f"Tier {self.name}. Scale: {self.scale}, Quality: {self.quality}"
+
+    def encode_params(self):
+        """cv2.imencode parameters"""
+        return [cv2.IMWRITE_JPEG_QUALITY, self.quality,
+            cv2.IMWRITE_JPEG_OPTIMIZE, int(self.optimize),
+            cv2.IMWRITE_JPEG_PROGRESSIVE, int(self.progressive)]
+
+    def encode(self, image):
+        """Scale and encode an image, recording its metrics. Returns the jpeg bytes"""
+        start = time.time()
+        data = self.encode_image(image)
+        self.record(time.time() - start, len(data))
+        return data
+
+    def encode_image(self, image):
+        """Scale and encode an image. Returns the jpeg bytes"""
+        if self.scale != 1.0:
+            height, width = image.shape[:2]
+            size = (max(int(width * self.scale), 1), max(int(height * self.scale), 1))
+            # Area averaging is only cheap for integer ratios, and linear is close enough between them
+            integer_ratio = (1.0 / self.scale).is_integer()
+            image = cv2.resize(image, size, interpolation=cv2.INTER_AREA if integer_ratio else cv2.INTER_LINEAR)
+        _, jpeg = cv2.imencode('.jpg', image, self.encode_params())
+        return jpeg.tobytes()
+
+    def record(self, seconds:float, size:int):
+        """Encode metrics of one frame, also for frames encoded by pipeline workers"""
+        metrics.TIER_ENCODE.labels(self.name).observe(seconds)
+        metrics.TIER_FRAME_BYTES.labels(self.name).observe(size)
+
+class TierLadder(object):
+    """Tiers from best to worst quality"""
+    def __init__(self, tiers:list):
+        if not tiers:
+            raise ValueError("A tier ladder needs at least one tier")
+        self.tiers = list(tiers)
+
+    def __str__(self):
+        return "Tier ladder: " + ", ".join(str(tier) for tier in self.tiers)
+
+    def __len__(self):
+        return len(self.tiers)
+
+    def __getitem__(self, index:int):
+        return self.tiers[index]
+
+    def index(self, name:str):
+        """Position of a tier by name, or None"""
+        for i, tier in enumerate(self.tiers):
+            if tier.name == name:
+                return i
+        return None
+
+    @classmethod
+    def from_config(cls, config:list):
+        """Ladder from (name, scale, quality) tuples"""
+        return cls([EncodeTier(name, scale, quality) for name, scale, quality in config])
+
+class TieredFrame(object):
+    """A decoded frame and its encodings, made on first request.
+    Without an image, it's decoded from the top tier jpeg when needed"""
+    def __init__(self, image, ladder:TierLadder, top_jpeg:bytes=None):
+        self.decoded = image
+        self.ladder = ladder
+        self.encoded = [None] * len(ladder)
+        self.encoded[0] = top_jpeg
+        self.locks = [threading.Lock() for _ in range(len(ladder))]
+
+    @property
+    def image(self):
+        """Decoded frame"""
+        if self.decoded is None:
+            self.decoded = cv2.imdecode(np.frombuffer(self.encoded[0], dtype=np.uint8), cv2.IMREAD_COLOR)
+        return self.decoded
+
+    def cached(self, index:int):
+        """Encoding of a tier if it's been made, or None"""
+        return self.encoded[index]
+
+    def get(self, index:int):
+        """Jpeg bytes of a tier. Viewers asking at the same time wait for one encode"""
+        data = self.encoded[index]
+        if data is not None:
+            return data
+        with self.locks[index]:
+            if self.encoded[index] is None:
+                self.encoded[index] = self.ladder[index].encode(self.image)
+            return self.encoded[index]
+
+class TierSelector(object):
+    """Tier of one viewer. A fixed tier, or automatic: steps down when the viewer falls
+    more than `max_behind` frames behind, and back up after `recover_frames` on time"""
+    def __init__(self, ladder:TierLadder, tier:str=AUTO_TIER, max_behind:float=2.0,
+                 recover_frames:int=100):
+        self.ladder = ladder
+        self.auto = tier == AUTO_TIER or ladder.index(tier) is None
+        self.index = 0 if self.auto else ladder.index(tier)
+        self.max_behind = max_behind
+        self.recover_frames = recover_frames
+        self.on_time = 0
+        self.switches = 0
+
+    def __str__(self):
+        return f"Tier selector. Tier: {self.ladder[self.index].name}, Auto: {self.auto}, Switches: {self.switches}"
+
+    def update(self, frames_behind:float):
+        """Tier index for the next frame, given how far behind the viewer is"""
+        if not self.auto:
+            return self.index
+        if frames_behind > self.max_behind:
+            self.on_time = 0
+            if self.index < len(self.ladder) - 1:
+                self._switch(self.index + 1)
+        else:
+            self.on_time += 1
+            if self.on_time >= self.recover_frames and self.index > 0:
+                self.on_time = 0
+                self._switch(self.index - 1)
+        return self.index
+
+    def _switch(self, index:int):
+        """Change tier"""
+        metrics.TIER_SWITCHES.labels("down" if index > self.index else "up").inc()
+        self.index = index
+        self.switches += 1
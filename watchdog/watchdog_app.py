@@ -1,17 +1,27 @@
 """Module to handle file watchdog functions and stream to web"""
 import os
 import time
-import math
 import wave
+import struct
 import contextlib
+from concurrent.futures import ThreadPoolExecutor
 
 # File utilities
 import shutil
 from pathlib import Path
 
 # Flask display
-from flask import Flask, render_template, Response, jsonify
+from flask import Flask, render_template, Response, jsonify, request, abort
 from camera import VideoCamera, CameraStatus
+from capture import CapturePolicy, FileCapturer
+from sessions import SessionRegistry, Session, DEFAULT_SESSION
+from preroll import PrerollPlanner
+from segment_index import SegmentIndex
+from recorder import StreamRecorder
+from async_server import AsyncStreamServer
+from tiers import TierLadder, TierSelector, AUTO_TIER
+from frame_pipeline import FramePipeline
+import metrics
 
 # Watchdog
 from watchdog.observers import Observer
@@ -21,11 +31,58 @@ VOICE_DATA_PATH   = Path(os.path.expanduser(r"~/heygem_data/voice/data"))
 VIDEO_TEMP_PATH   = Path(os.path.expanduser(r"~/heygem_data/face2face/temp"))
 COPIED_VIDEO_PATH = Path(os.path.expanduser(r"~/heygem_data/face2face/copy"))
 FRAMEIMAGE_PATH   = Path(os.path.expanduser(r"~/heygem_data/face2face/frameimages"))
-
-CAMERA     = VideoCamera()
+SESSIONS_PATH     = Path(os.path.expanduser(r"~/heygem_data/face2face/sessions"))
+RECORDINGS_PATH   = Path(os.path.expanduser(r"~/heygem_data/face2face/recordings"))
+
+# One camera and copy area per job. Seconds to keep a finished session's copied files
+SESSION_RETENTION = 600
+SESSIONS   = SessionRegistry(COPIED_VIDEO_PATH, SESSIONS_PATH, SESSION_RETENTION)
+# Start playing buffered videos once the projected render time fits in the playback time
+AUTO_START = True
+PREROLL    = PrerollPlanner()
+# Archive each live stream and its audio to one mp4 in RECORDINGS_PATH
+RECORD_STREAMS = False
+# Serve live streams from an asyncio event loop, one paced publisher per session
+# shared by all viewers, instead of one thread per connection
+ASYNC_SERVER = False
+ASYNC_DECODE_WORKERS = 4
+# Threads running other requests through the Flask app on the async server
+ASYNC_WSGI_WORKERS = 16
+# Reopen one capture object per camera on each segment, instead of creating one per segment
+REUSE_CAPTURES = False
+# MJPEG tiers from best to worst: (name, resolution scale, jpeg quality).
+# Viewers pick one with `?tier=<name>`, otherwise they start at the top and
+# step down while more than TIER_MAX_BEHIND frames behind
+STREAM_TIERS = [
+    ("full", 1.0, 95),
+    ("medium", 0.75, 80),
+    ("low", 0.5, 60)
+]
+TIER_MAX_BEHIND = 2.0
+TIER_RECOVER_FRAMES = 100
+# Worker processes decoding and encoding segments into shared memory rings, 0 to do it
+# in the serving process. Each camera has its own ring, for the segments prefetched while playing
+FRAME_WORKERS = 0
+FRAME_RING_SIZE = 16 * 1024 * 1024
+FRAME_PIPELINE = None
 DEBUG_FILE_EVENTS = False
 DEBUG_TIMING      = False
 DEFAULT_FPS       = 28.18
+# Offline replay repeats the previous segment for missing ones, instead of skipping them
+FILL_SEGMENT_GAPS = True
+
+# Which closed files get captured into COPIED_VIDEO_PATH. First matching pattern wins.
+# Actions: copy, hardlink (falls back to copy across devices), ignore
+CAPTURE_RULES = [
+    ("output/png/*",  "ignore"),
+    ("output/*.npy",  "ignore"),
+    ("output/avi/*",  "hardlink"),
+    ("output/temp.wav", "copy"),
+]
+CAPTURE_WORKERS = 4
+CAPTURER = FileCapturer(CapturePolicy(CAPTURE_RULES), max_workers=CAPTURE_WORKERS)
+# Segments are probed and indexed in capture order, off the capture callback thread
+INDEXER = ThreadPoolExecutor(max_workers=1, thread_name_prefix="segment-index")
 
 def rel_vidpath(abs_path:str):
     """Returns relative path from watched directory, for easier display"""
@@ -45,6 +102,7 @@ class TempFileHandler(FileSystemEventHandler):
         return super().on_modified(event)
 
     def on_deleted(self, event):
+        handle_deleted_directories(rel_vidpath(event.src_path))
         print_file_event("Deleted", rel_vidpath(event.src_path), event.is_directory)
         return super().on_deleted(event)
 
@@ -57,30 +115,55 @@ class TempFileHandler(FileSystemEventHandler):
 def print_file_event(action:str, rpath:str, is_directory:bool):
     """Print what filesystem event happened"""
     if DEBUG_FILE_EVENTS:
-        print(f"{action} {"Directory" if is_directory else "File" } : {rpath}")
+        kind = "Directory" if is_directory else "File"
+        print(f"{action} {kind} : {rpath}")
 
 
 def handle_created_directories(rpath: os.PathLike):
     """Handler when directories are created"""
-    global CAMERA
-    if rpath == 'output':
-        # Clean previous files
-        print ("Cleaning previous copied files")
-        if os.path.exists(COPIED_VIDEO_PATH):
-            shutil.rmtree(COPIED_VIDEO_PATH)
+    key, session_rpath = SESSIONS.split_path(rpath)
+    if key is None:
+        return
+    if session_rpath == 'output':
         # Clean previous run
-        CAMERA.clear_videos()
-    os.makedirs(COPIED_VIDEO_PATH / rpath, exist_ok=True)
-    print (f"Creating copied directory: {rpath}")
+        session = SESSIONS.start(key)
+        configure_camera(session.camera)
+    else:
+        session = SESSIONS.get_or_create(key)
+    os.makedirs(session.copy_path / session_rpath, exist_ok=True)
+    print (f"Creating copied directory: {session.key}: {session_rpath}")
+
+def handle_deleted_directories(rpath: os.PathLike):
+    """Handler when directories are deleted. Job is done when its `output` is deleted"""
+    key, session_rpath = SESSIONS.split_path(rpath)
+    if key is not None and session_rpath == 'output':
+        # Copies still in flight are segments of this render, queue them first
+        CAPTURER.when_flushed(lambda: finish_session(key))
+
+def finish_session(key:str):
+    """Render is done and all its files have been captured"""
+    session = SESSIONS.finish(key)
+    # Nothing left to wait for
+    if session and AUTO_START:
+        PREROLL.maybe_start(session.camera, force=True, on_start=lambda camera: start_recording(session))
 
 
 def handle_closed_files(action:str, rpath: os.PathLike, is_directory:bool, fpath: os.PathLike):
-    """Handler when created or modified files have been closed"""
-    global CAMERA, DEFAULT_FPS
+    """Handler when created or modified files have been closed.
+    Runs on the observer thread, so files are only queued for capture here"""
     print_file_event(action, rpath, is_directory)
+    key, session_rpath = SESSIONS.split_path(rpath)
+    session = SESSIONS.get_or_create(key or DEFAULT_SESSION)
     # Copy files before they're gone
-    shutil.copy(fpath, COPIED_VIDEO_PATH / rpath)
-
+    CAPTURER.submit(fpath, session.copy_path / session_rpath, rpath,
+        lambda cpath, lag: handle_captured_files(session, session_rpath, cpath, lag))
+
+def handle_captured_files(session:Session, rpath: os.PathLike, cpath: os.PathLike, lag:float):
+    """Handler when closed files have been captured, called in the order they were closed.
+    rpath is relative to the session directory"""
+    global DEFAULT_FPS
+    camera = session.camera
+    metrics.CAPTURE_LAG.observe(lag)
     # Handle file progress (output subdir).
     # 1. Start with saved audio file: temp.wav and numpy audio_data.npy
     # 2. Creates a directory png, and avi
@@ -92,187 +175,429 @@ def handle_closed_files(action:str, rpath: os.PathLike, is_directory:bool, fpath
     # 1. Start with saved audio file: temp.wav and numpy audio_data.npy
     if rpath == "output/temp.wav":
         # The audio file has been writen. We are ready to start receiving video files
-        audio_length = get_audio_length(fpath)
-        expected_frames = int(DEFAULT_FPS * audio_length) - 1
-        expected_videos = math.ceil(expected_frames / 2)
-        print(f"Audio: {audio_length}s, Expected: Frames: {expected_frames}, Videos: {expected_videos}")
+        audio_length = get_audio_length(cpath)
         # Clear previous run
-        CAMERA.clear_videos()
-        CAMERA.set_status(CameraStatus.WAITING_VIDEO)
-        CAMERA.audio_start = time.time()
-        CAMERA.video_start = -1
+        camera.clear_videos()
+        # Uses the last known video fps, updated once the first video is loaded
+        camera.set_audio_length(audio_length, DEFAULT_FPS)
+        session.index.add_audio(cpath, audio_length)
+        print(f"Audio: {audio_length}s, Expected: Frames: {camera.expected_frames}, " \
+            f"Videos: {camera.expected_videos}")
+        camera.set_status(CameraStatus.WAITING_VIDEO)
+        camera.audio_start = time.time() - lag
+        camera.video_start = -1
         return
 
     # 3. As video generation runs, png files and .avi video files are saved
     synthesis_vid_dir = "output/avi/"
     if rpath.startswith(synthesis_vid_dir):
         # Add to camera video queue
-        if CAMERA.video_start <= 0:
-            CAMERA.set_status(CameraStatus.BUFFERING)
-            CAMERA.video_start = time.time()
-            print(f"Audio to Video latency: {CAMERA.video_start - CAMERA.audio_start}s")
-        CAMERA.add_video(COPIED_VIDEO_PATH / rpath, time.time())
+        if camera.video_start <= 0:
+            camera.set_status(CameraStatus.BUFFERING)
+            camera.video_start = time.time() - lag
+            print(f"{session.key}: Audio to Video latency: {camera.video_start - camera.audio_start}s")
+            metrics.AUDIO_TO_FIRST_SEGMENT.labels(session.key).observe(camera.video_start - camera.audio_start)
+        elif camera.jitter.arrivals:
+            metrics.SEGMENT_INTERARRIVAL.labels(session.key).observe(time.time() - camera.jitter.arrivals[-1])
+        if DEBUG_TIMING:
+            print(f"Capture lag: {lag:.4f}s. {CAPTURER}")
+        INDEXER.submit(index_segment, session, cpath)
+        camera.add_video(cpath, time.time())
+        if AUTO_START:
+            PREROLL.maybe_start(camera, on_start=lambda camera: start_recording(session))
         return
 
-def gen(camera:VideoCamera, frame_rate = DEFAULT_FPS):
-    """Get frames from camera class"""
+def index_segment(session:Session, cpath: os.PathLike):
+    """Probe a captured segment and add it to the session index"""
+    if not os.path.exists(cpath):
+        # Cleaned by a new run of the session
+        return
+    try:
+        session.index.add_segment(cpath)
+    except Exception as e: # pylint: disable=broad-exception-caught
+        print(f"Indexing failed for {cpath}: {e}")
+
+def get_session(key:str):
+    """Existing session of a viewer route, or 404. Sessions are created by watchdog events"""
+    session = SESSIONS.get(key)
+    if session is None:
+        abort(404, description=f"Unknown session: {key}")
+    return session
+
+def start_playback(session:Session):
+    """Move a session camera to playing. Live renders are recorded from here on"""
+    camera = session.camera
+    if camera.status == CameraStatus.PLAYING:
+        return
+    start_recording(session)
+    camera.set_status(CameraStatus.PLAYING)
+
+def start_recording(session:Session):
+    """Record the live stream of a session that starts playing"""
+    camera = session.camera
+    if not RECORD_STREAMS or camera.status not in (CameraStatus.WAITING_VIDEO, CameraStatus.BUFFERING):
+        # Disabled, or not a live render, like loaded videos
+        return
+    if camera.recorder and not camera.recorder.stopped:
+        return
+    output_path = RECORDINGS_PATH / f"{session.key}_{time.strftime('%Y%m%d_%H%M%S')}.mp4"
+    camera.recorder = StreamRecorder(output_path, camera.get_frame_rate(),
+        session.copy_path / "output/temp.wav").start()
+
+def configure_camera(camera:VideoCamera):
+    """Apply capture and encode settings to a camera"""
+    camera.reuse_capture = REUSE_CAPTURES
+    camera.pipeline = FRAME_PIPELINE
+    if [(tier.name, tier.scale, tier.quality) for tier in camera.tiers] != STREAM_TIERS:
+        camera.set_tiers(TierLadder.from_config(STREAM_TIERS))
+
+def gen(camera:VideoCamera, frame_rate = DEFAULT_FPS, tier:str=AUTO_TIER):
+    """Get frames from camera class, encoded in the viewer tier"""
     # Set Initial state.
     # Notice that IS_PLAYING=True might not work due to browser
     # restrictions on unwanted audio play without user intervention
     print(f"frame_rate = {frame_rate}")
     avg_frame_duration = 0
-    sleep_time = 1.0 / frame_rate
     delta_time = 0
     play_time = 0
-
-    while True:
-        if camera.status == CameraStatus.PLAYING:
-            # Time retrieval time
-            frame_start = time.time()
-            success, frame, framenum, video,  = camera.get_frame()
-            retrieval_duration = time.time() - frame_start
-            if success:
-
-                frameprint_start = time.time()
-                videofilename_without_ext, _ = os.path.splitext(os.path.basename(video['path']))
-                avg_frame_duration = ((avg_frame_duration * framenum) + sleep_time) / (framenum + 1)
-                # Time print
-                if DEBUG_TIMING:
-                    print(f"Frame: {framenum:03d}. Video Queue: {video['index']:03d}, " \
-                        f"Video File: {videofilename_without_ext}, " \
-                        f"Vid.Frame: {video['current_frame']}, " \
-                        f"delta_time:{delta_time:.7f} Avg Frame Duration: {avg_frame_duration:.8f}")
-                frameprint_duration = time.time() - frameprint_start
-
-                # Time actual sleep
-                sleep_start = time.time()
-                elapsed_time = retrieval_duration + frameprint_duration + delta_time
-                requested_sleep = sleep_time - elapsed_time
-                time.sleep(max(requested_sleep, 0))
-                sleep_duration = time.time() - sleep_start
-                delta_sleep = sleep_duration - requested_sleep
-
-                # Meet timing expectations
-                expected_play_time = framenum / frame_rate
-                if DEBUG_TIMING:
-                    print(f"Times: expected:{expected_play_time:.7f}, play: {play_time:.7f}, " \
-                        f"sleep: {sleep_duration:.7f}, delta_sleep: {delta_sleep:.7f}")
-                frame_duration = time.time() - frame_start # Includes any debug print statements
-                play_time += frame_duration
-                delta_time = play_time - expected_play_time # Carries on to next frame sleep request
-
-            yield (b'--frame\r\n'
-                b'Content-Type: image/jpeg\r\n\r\n' + frame + b'\r\n\r\n')
-
-def load_camera(video_list:list, frame_rate=DEFAULT_FPS):
+    expected_play_time = 0
+    # Wall clock time the frame schedule starts from, None while not playing
+    play_start = None
+    selector = TierSelector(camera.tiers, tier, TIER_MAX_BEHIND, TIER_RECOVER_FRAMES)
+
+    viewers = metrics.VIEWERS.labels(camera.name, "mjpeg")
+    viewers.inc()
+    try:
+        while True:
+            # Real video fps once known, adjusted by the jitter buffer while playing
+            sleep_time = 1.0 / (camera.get_frame_rate() or frame_rate)
+            if camera.status == CameraStatus.PLAYING:
+                # Time retrieval time
+                frame_start = time.time()
+                if play_start is None:
+                    play_start = frame_start
+                    expected_play_time = 0
+                # Lateness against the schedule, on the wall clock. It includes the time
+                # blocked in the last yield, while the viewer was taking the previous frame
+                delta_time = frame_start - play_start - expected_play_time
+                frames_behind = delta_time / sleep_time
+                if frames_behind > TIER_MAX_BEHIND:
+                    # Don't burst frames to catch up, the viewer couldn't take them.
+                    # The tier selector steps down instead
+                    play_start += delta_time
+                    delta_time = 0
+                success, tiered, framenum, video = camera.get_tiered_frame()
+                retrieval_duration = time.time() - frame_start
+                if success:
+                    sleep_time = sleep_time / camera.playback_rate()
+
+                    frameprint_start = time.time()
+                    videofilename_without_ext, _ = os.path.splitext(os.path.basename(video['path']))
+                    avg_frame_duration = ((avg_frame_duration * framenum) + sleep_time) / (framenum + 1)
+                    # Time print
+                    if DEBUG_TIMING:
+                        print(f"Frame: {framenum:03d}. Video Queue: {video['index']:03d}, " \
+                            f"Video File: {videofilename_without_ext}, " \
+                            f"Vid.Frame: {video['current_frame']}, " \
+                            f"delta_time:{delta_time:.7f} Avg Frame Duration: {avg_frame_duration:.8f}")
+                    frameprint_duration = time.time() - frameprint_start
+
+                    # Time actual sleep
+                    sleep_start = time.time()
+                    elapsed_time = retrieval_duration + frameprint_duration + delta_time
+                    requested_sleep = sleep_time - elapsed_time
+                    time.sleep(max(requested_sleep, 0))
+                    sleep_duration = time.time() - sleep_start
+                    delta_sleep = sleep_duration - requested_sleep
+
+                    # Meet timing expectations
+                    expected_play_time += sleep_time
+                    play_time = time.time() - play_start
+                    if DEBUG_TIMING:
+                        print(f"Times: expected:{expected_play_time:.7f}, play: {play_time:.7f}, " \
+                            f"sleep: {sleep_duration:.7f}, delta_sleep: {delta_sleep:.7f}")
+                    metrics.PACING_ERROR.observe(abs(play_time - expected_play_time))
+                    metrics.FRAMES_PLAYED.labels(camera.name).inc()
+                else:
+                    # Underrun or end of stream. Repeat last frame
+                    time.sleep(max(sleep_time - retrieval_duration - delta_time, 0))
+                    expected_play_time += sleep_time
+                    metrics.FRAMES_DUPLICATED.labels(camera.name).inc()
+
+                # Late frames mean the viewer can't take them as fast as they play
+                index = selector.update(frames_behind)
+                # The frame this viewer played, other viewers may have advanced the camera since
+                frame = tiered.get(index)
+                metrics.TIER_FRAMES_SENT.labels(tiered.ladder[index].name).inc()
+                yield (b'--frame\r\n'
+                    b'Content-Type: image/jpeg\r\n\r\n' + frame + b'\r\n\r\n')
+            else:
+                # Wait for playback without busy looping
+                play_start = None
+                time.sleep(sleep_time)
+    finally:
+        # Viewer disconnected
+        viewers.dec()
+
+def reset_camera(camera:VideoCamera, video_list:list=(), start_frame:int=0):
     """Initialize camera object from cv2.VideoCapture with video queue"""
-    global CAMERA, FRAMEIMAGE_PATH
-    CAMERA.clear_videos()
-    CAMERA.set_status(CameraStatus.IDLE)
+    global FRAMEIMAGE_PATH
+    camera.clear_videos()
+    configure_camera(camera)
+    camera.set_status(CameraStatus.IDLE)
     if os.path.exists(FRAMEIMAGE_PATH):
         shutil.rmtree(FRAMEIMAGE_PATH)
-    CAMERA.set_frame_output_dir(FRAMEIMAGE_PATH.as_posix())
-    CAMERA.load_videos(video_list, time.time())
-    print("load_camera:", CAMERA)
+    camera.set_frame_output_dir(FRAMEIMAGE_PATH.as_posix())
+    camera.load_videos(list(video_list), time.time(), start_frame)
+    print("load_camera:", camera)
     if video_list:
-        CAMERA.set_status(CameraStatus.READY)
-    return Response(gen(CAMERA, frame_rate),
+        camera.set_status(CameraStatus.READY)
+
+def attach_camera(camera:VideoCamera, restart:bool=False):
+    """Prepare a camera for a new viewer. Viewers join the stream of the camera as it is,
+    it's only reset when it never streamed, or when the viewer restarts it"""
+    if restart or camera.status == CameraStatus.OFF:
+        reset_camera(camera)
+    else:
+        configure_camera(camera)
+
+def load_camera(camera:VideoCamera, video_list:list, frame_rate=DEFAULT_FPS, start_frame:int=0,
+                tier:str=AUTO_TIER):
+    """Initialize camera with video queue, and stream it"""
+    reset_camera(camera, video_list, start_frame)
+    return Response(gen(camera, frame_rate, tier),
         mimetype='multipart/x-mixed-replace; boundary=frame')
 
-def generate_wav(filepath: os.PathLike):
+def generate_wav(camera:VideoCamera, filepath: os.PathLike):
     """Generate audio stream from .wav"""
-    with open(filepath, "rb") as fwav:
-        data = fwav.read(1024)
-        while data:
-            if CAMERA.status == CameraStatus.PLAYING:
-                yield data
-                data = fwav.read(1024)
+    viewers = metrics.VIEWERS.labels(camera.name, "wav")
+    viewers.inc()
+    try:
+        with open(filepath, "rb") as fwav:
+            data = fwav.read(1024)
+            while data:
+                if camera.status == CameraStatus.PLAYING:
+                    yield data
+                    data = fwav.read(1024)
+    finally:
+        viewers.dec()
 
 def get_audio_length(filepath: os.PathLike):
     """Get length of audio file"""
-    with contextlib.closing(wave.open(filepath,'r')) as f:
+    with contextlib.closing(wave.open(os.fspath(filepath),'r')) as f:
         frames = f.getnframes()
         rate = f.getframerate()
         duration = frames / float(rate)
     return duration
 
-def get_videofile_index(videofilepath: os.PathLike):
-    """Returns corresponding index integer for synthetic video"""
-    vidfile = os.path.basename(videofilepath)
-    vidfile_without_ext, _ = os.path.splitext(vidfile)
-    return int(vidfile_without_ext)
+def wav_header(channels:int, sample_width:int, frame_rate:int, nframes:int):
+    """PCM .wav header for nframes of audio"""
+    data_size = nframes * channels * sample_width
+    return struct.pack('<4sI4s4sIHHIIHH4sI',
+        b'RIFF', 36 + data_size, b'WAVE',
+        b'fmt ', 16, 1, channels, frame_rate, frame_rate * channels * sample_width,
+        channels * sample_width, sample_width * 8,
+        b'data', data_size)
+
+def generate_wav_from(camera:VideoCamera, filepath: os.PathLike, start:float):
+    """Generate audio stream from .wav, starting at start seconds"""
+    viewers = metrics.VIEWERS.labels(camera.name, "wav")
+    viewers.inc()
+    try:
+        with contextlib.closing(wave.open(os.fspath(filepath),'rb')) as fwav:
+            frame_rate = fwav.getframerate()
+            start_frame = min(int(start * frame_rate), fwav.getnframes())
+            fwav.setpos(start_frame)
+            data = wav_header(fwav.getnchannels(), fwav.getsampwidth(), frame_rate,
+                fwav.getnframes() - start_frame)
+            frames_per_chunk = max(1024 // (fwav.getnchannels() * fwav.getsampwidth()), 1)
+            while data:
+                if camera.status == CameraStatus.PLAYING:
+                    yield data
+                    data = fwav.readframes(frames_per_chunk)
+    finally:
+        viewers.dec()
+
+def load_segment_index(session:Session):
+    """Segment index of a session. Built from the copied files if the copy has no index file.
+    An index without segments yet belongs to a live run, and is kept"""
+    if not os.path.exists(session.index.index_path):
+        print(f"No segment index found, building: {session.index.index_path}")
+        audio_path = session.copy_path / "output/temp.wav"
+        audio_duration = get_audio_length(audio_path) if os.path.exists(audio_path) else None
+        index = SegmentIndex.build(session.index.index_path, session.copy_path / 'output/avi',
+            audio_path if audio_duration else None, audio_duration)
+        return index
+    return SegmentIndex.load(session.index.index_path)
+
+def get_replay_audio(session:Session, index:SegmentIndex):
+    """Audio for offline replay"""
+    source_audio = VIDEO_TEMP_PATH / "source_audio_wav.wav"
+    if session.key == DEFAULT_SESSION and os.path.exists(source_audio):
+        return source_audio
+    if index.audio:
+        return index.audio['path']
+    return session.copy_path / "output/temp.wav"
 
 
 # Flask functions
 app = Flask(__name__)
 
-@app.route('/')
-def index():
+@app.route('/', defaults={'session': DEFAULT_SESSION})
+@app.route('/session/<session>')
+def index(session):
     """Render main flask page"""
-    return render_template('index.html', audioAutoPlay = '')
-
-@app.route('/load')
-def load():
-    """Render video load flask page"""
-    return render_template('load.html', audioAutoPlay = '')
-
-
-@app.route('/video_load')
-def video_load():
-    """Get camera and load existing videos"""
-    video_files = [
-        os.path.join(dirpath,f)
-            for (dirpath, dirnames, filenames) in os.walk(COPIED_VIDEO_PATH / 'output/avi')
-        for f in filenames]
-    video_files.sort()
-    # Get existing audio file
-    audio_duration = get_audio_length((VIDEO_TEMP_PATH / "source_audio_wav.wav").as_posix())
-    # There might be missing videos. Use last video's index as reference
-    last_item_index = get_videofile_index(video_files[-1])
-    # Two frames per expected video. Last video only has 1 frame.
-    num_frames = ((last_item_index + 1) * 2) - 1
-    print (f"Video files: {len(video_files)}. Expected: {last_item_index + 1}. Frames: {num_frames}")
-    print (f"Audio_duration: {audio_duration}")
-    framerate = num_frames / audio_duration
-    framerate = DEFAULT_FPS # Override
+    return render_template('index.html', audioAutoPlay = '', session = session)
+
+@app.route('/sessions')
+def sessions():
+    """List known sessions"""
+    return jsonify([session.to_dict() for session in SESSIONS])
+
+@app.route('/load', defaults={'session': DEFAULT_SESSION})
+@app.route('/load/<session>')
+def load(session):
+    """Render video load flask page. Query parameter `start` seeks to a time in seconds"""
+    start = request.args.get('start', 0.0, type=float)
+    return render_template('load.html', audioAutoPlay = '', session = session, start = start)
+
+
+@app.route('/video_load', defaults={'session': DEFAULT_SESSION})
+@app.route('/video_load/<session>')
+def video_load(session):
+    """Get camera and load existing videos from the segment index.
+    Query parameter `start` seeks to a time in seconds"""
+    session = get_session(session)
+    start = request.args.get('start', 0.0, type=float)
+    index = load_segment_index(session)
+    gaps = index.gaps()
+    if gaps:
+        print(f"Missing videos: {gaps}. {'Filled with previous video' if FILL_SEGMENT_GAPS else 'Skipped'}")
+    playlist = index.playlist(FILL_SEGMENT_GAPS)
+    position, start_frame = index.seek(playlist, start)
+    video_files = [record['path'] for record in playlist[position:]]
+    framerate = index.fps(DEFAULT_FPS)
+    print (f"{index}. Start: {start}s, video {position}, frame {start_frame}")
     print (f"Framerate: {framerate}")
-    return load_camera(video_files, framerate)
-
-@app.route('/video_feed')
-def video_feed():
-    """Get camera with empty video queue"""
-    return load_camera([])
+    return load_camera(session.camera, video_files, framerate, start_frame,
+        request.args.get('tier', AUTO_TIER))
+
+@app.route('/segments', defaults={'session': DEFAULT_SESSION})
+@app.route('/segments/<session>')
+def segments(session):
+    """Report indexed segments and gaps of a session"""
+    session = get_session(session)
+    index = load_segment_index(session)
+    return jsonify({
+        'session': session.key,
+        'segments': len(index),
+        'gaps': index.gaps(),
+        'fps': index.fps(),
+        'duration': index.duration(),
+        'audio': index.audio
+    })
+
+@app.route('/video_feed', defaults={'session': DEFAULT_SESSION})
+@app.route('/video_feed/<session>')
+def video_feed(session):
+    """Stream the session camera. Query parameter `tier` picks an encode tier,
+    `restart=1` clears the camera for a new stream instead of joining the running one"""
+    camera = get_session(session).camera
+    attach_camera(camera, request.args.get('restart', 0, type=int) > 0)
+    return Response(gen(camera, tier=request.args.get('tier', AUTO_TIER)),
+        mimetype='multipart/x-mixed-replace; boundary=frame')
 
 
-@app.route("/start_loaded_videos", methods=['POST'])
-def start_loaded_videos():
+@app.route("/start_loaded_videos", defaults={'session': DEFAULT_SESSION}, methods=['POST'])
+@app.route("/start_loaded_videos/<session>", methods=['POST'])
+def start_loaded_videos(session):
     """Called from the `/load` page"""
-    global CAMERA
-    CAMERA.set_status(CameraStatus.PLAYING)
-    print(CAMERA)
+    session = get_session(session)
+    start_playback(session)
+    camera = session.camera
+    print(camera)
     return jsonify({'camera': 'Playing', 'mode': 'offline'})
 
-@app.route("/start_streaming", methods=['POST'])
-def start_streaming():
+@app.route("/start_streaming", defaults={'session': DEFAULT_SESSION}, methods=['POST'])
+@app.route("/start_streaming/<session>", methods=['POST'])
+def start_streaming(session):
     """Called from the `/` HTML page"""
-    global CAMERA
-    CAMERA.set_status(CameraStatus.WAITING_AUDIO)
-    print(CAMERA)
-    return jsonify({'camera': 'Playing', 'mode': 'streaming'})
-
-@app.route("/wav")
-def wav():
+    session = get_session(session)
+    if session.camera.status == CameraStatus.BUFFERING:
+        # Segments of a live render are queued already, start without the pre-roll
+        start_playback(session)
+    else:
+        session.camera.set_status(CameraStatus.WAITING_AUDIO)
+    print(session)
+    return jsonify({'camera': 'Playing', 'mode': 'streaming', 'session': session.key})
+
+@app.route("/wav", defaults={'session': DEFAULT_SESSION})
+@app.route("/wav/<session>")
+def wav(session):
     """Get audio file and synchronize it to the images being displayed"""
-    return Response(generate_wav(COPIED_VIDEO_PATH / "output/temp.wav"), mimetype="audio/x-wav")
-
-@app.route("/wav_load")
-def wav_load():
-    """Get audio file and synchronize it to the images being displayed"""
-    return Response(generate_wav(VIDEO_TEMP_PATH / "source_audio_wav.wav"), mimetype="audio/x-wav")
+    session = get_session(session)
+    return Response(generate_wav(session.camera, session.copy_path / "output/temp.wav"),
+        mimetype="audio/x-wav")
+
+@app.route("/wav_load", defaults={'session': DEFAULT_SESSION})
+@app.route("/wav_load/<session>")
+def wav_load(session):
+    """Get audio file and synchronize it to the images being displayed.
+    Query parameter `start` seeks to a time in seconds"""
+    session = get_session(session)
+    start = request.args.get('start', 0.0, type=float)
+    audio_path = get_replay_audio(session, SegmentIndex.load(session.index.index_path))
+    if start > 0:
+        return Response(generate_wav_from(session.camera, audio_path, start), mimetype="audio/x-wav")
+    return Response(generate_wav(session.camera, audio_path), mimetype="audio/x-wav")
+
+@app.route("/capture_stats")
+def capture_stats():
+    """Report file capture lag, from close event to captured copy"""
+    return jsonify({
+        'captured': CAPTURER.captured,
+        'failed': CAPTURER.failed,
+        'ignored': CAPTURER.ignored,
+        'pending': len(CAPTURER.pending),
+        'lag_avg': CAPTURER.average_lag(),
+        'lag_max': CAPTURER.max_lag,
+        'lag_last': CAPTURER.last_lag
+    })
+
+@app.route("/recorder", defaults={'session': DEFAULT_SESSION})
+@app.route("/recorder/<session>")
+def recorder(session):
+    """Report recorder lag of a session"""
+    camera = get_session(session).camera
+    return jsonify(camera.recorder.stats() if camera.recorder else {'recording': False})
+
+@app.route("/metrics")
+def metrics_endpoint():
+    """Stream health metrics in Prometheus text format"""
+    session_keys = set()
+    for session in SESSIONS:
+        session_keys.add(session.key)
+        metrics.VIDEO_QUEUE_DEPTH.labels(session.key).set(len(session.camera.video_queue))
+    # Forget cleaned sessions
+    for (key,) in list(metrics.VIDEO_QUEUE_DEPTH.children):
+        if key not in session_keys:
+            metrics.VIDEO_QUEUE_DEPTH.remove(key)
+    metrics.update_process_metrics()
+    return Response(metrics.REGISTRY.render(), mimetype="text/plain; version=0.0.4")
 
 # Main function
+def start_frame_pipeline():
+    """Start the frame pipeline workers, if enabled. They encode in the top stream tier"""
+    global FRAME_PIPELINE
+    if FRAME_WORKERS > 0 and FRAME_PIPELINE is None:
+        FRAME_PIPELINE = FramePipeline(FRAME_WORKERS, TierLadder.from_config(STREAM_TIERS)[0],
+            FRAME_RING_SIZE).start()
+        print(FRAME_PIPELINE)
+    return FRAME_PIPELINE
+
 def main():
     """Main watchdog function to observe files created by heygem-gen-video docker service"""
+    start_frame_pipeline()
     # Watchdog subscribe
     observer = Observer()
     handler = TempFileHandler()
@@ -282,13 +607,24 @@ def main():
     print("Use Ctrl+C for KeyboardInterrupt.")
 
     # Run server
-    # debug ids False because otherwise server creates another interfering watchdog instance
-    app.run(host='0.0.0.0', debug=False)
+    if ASYNC_SERVER:
+        AsyncStreamServer(app, SESSIONS, attach_camera, DEFAULT_FPS,
+            host='0.0.0.0', port=5000, decode_workers=ASYNC_DECODE_WORKERS,
+            tier_max_behind=TIER_MAX_BEHIND, tier_recover_frames=TIER_RECOVER_FRAMES,
+            wsgi_workers=ASYNC_WSGI_WORKERS).serve_forever()
+    else:
+        # debug ids False because otherwise server creates another interfering watchdog instance
+        app.run(host='0.0.0.0', debug=False)
 
     # End when server ends
     print("Watchdog: Finished.")
     observer.stop()
     observer.join()
+    CAPTURER.shutdown()
+    INDEXER.shutdown()
+    print(CAPTURER)
+    if FRAME_PIPELINE:
+        FRAME_PIPELINE.stop()
 
 if __name__ == '__main__':
     main()